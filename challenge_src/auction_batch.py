@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batch runs over many instruction files, such as one per region per hour.
+
+Inputs are files, directories (every file in them) or glob patterns,
+taken in sorted order. By default each file is an independent auction
+house, files are processed concurrently across a pool of worker processes
+(one Server per file) and the summary report of each is written to
+<output dir>/<file path>.results, the file path taken relative to the
+directory the inputs share, so us/hour01.txt and eu/hour01.txt are
+reported to <output dir>/us/hour01.txt.results and
+<output dir>/eu/hour01.txt.results.
+
+With --merge the files are instead one logical stream (regions sharing
+items): the files, each in timestamp order, are combined by a k-way heap
+merge on timestamp and processed by a single Server, instructions with
+equal timestamps are taken in the order the files were given. The
+summary report is written to the merge file.
+
+Throughput is reported for each file (or the merged stream):
+
+   python auction_batch.py hourly/ 'extra/region_*.txt' --output-dir results --workers 4
+   python auction_batch.py hourly/ --merge merged.results
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import heapq
+from operator import attrgetter
+import os
+import time
+from auction_v2 import Server
+from auction_sharded import PROCESS_CONTEXT
+# -----------------------------------------
+
+RESULTS_SUFFIX = '.results'
+
+
+def expand_inputs(inputs):
+    """
+    Every file named by inputs, each a file, directory or glob pattern
+        - returns the files in sorted order, without duplicates
+    """
+    files = []
+    for name in inputs:
+        if os.path.isdir(name):
+            matches = [os.path.join(name, entry) for entry in os.listdir(name)]
+        else:
+            matches = glob.glob(name) or [name]
+        files.extend(sorted(match for match in matches if not os.path.isdir(match)))
+    return list(dict.fromkeys(files))
+
+
+def results_files(files, output_dir):
+    """
+    The report file of each input file, mirroring the paths of the files
+    below the directory they share so same named files in different
+    directories get different reports
+        - returns the report files in the order of files
+    """
+    paths = [os.path.abspath(file_name) for file_name in files]
+    if not paths:
+        return []
+    shared = os.path.commonpath([os.path.dirname(path) for path in paths])
+    return [os.path.join(output_dir, os.path.relpath(path, shared) + RESULTS_SUFFIX) for path in paths]
+
+
+def write_report(server, output_file):
+    with open(output_file, 'w') as output:
+        for line in server.complete_summary_report():
+            output.write(line + '\n')
+
+
+def process_file(file_name, output_file, memory_map=False, keep_bid_history=False):
+    """
+    Worker, run one file through its own Server writing its summary report
+    to output_file
+        - returns (file_name, instructions processed, seconds taken)
+    """
+    started = time.perf_counter()
+    server = Server(file_name, keep_bid_history=keep_bid_history)
+    processed = server.process_instruction_stream(file_name, memory_map=memory_map)
+    write_report(server, output_file)
+    return file_name, processed, time.perf_counter() - started
+
+
+def run_files(files, output_dir, workers=None, memory_map=False, keep_bid_history=False):
+    """
+    Process independent files concurrently, one Server per file
+        - workers: worker processes, one per cpu by default
+        - returns (file_name, instructions, seconds) for each file, in the order given
+    """
+    output_files = results_files(files, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    for directory in sorted({os.path.dirname(output_file) for output_file in output_files}):
+        os.makedirs(directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=PROCESS_CONTEXT) as pool:
+        runs = [pool.submit(process_file, file_name, output_file, memory_map, keep_bid_history)
+                for file_name, output_file in zip(files, output_files)]
+        return [run.result() for run in runs]
+
+
+def merged_instructions(server, files, memory_map=False):
+    """
+    Generator merging the instructions of timestamp ordered files into one
+    timestamp ordered stream, ties are taken in the order of files
+    """
+    streams = [server.stream_instructions(file_name, memory_map=memory_map) for file_name in files]
+    return heapq.merge(*streams, key=attrgetter('timestamp'))
+
+
+def run_merged(files, output_file, memory_map=False, keep_bid_history=False):
+    """
+    Process the merged stream of files through a single Server
+        - returns (description of the files, instructions, seconds)
+    """
+    started = time.perf_counter()
+    server = Server(keep_bid_history=keep_bid_history)
+    processed = 0
+    for instruction in merged_instructions(server, files, memory_map):
+        server.process_instruction(instruction)
+        processed += 1
+    write_report(server, output_file)
+    return '{0} files merged'.format(len(files)), processed, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Auction program, processing many instruction files')
+    parser.add_argument('inputs', nargs='+', help='instruction files, directories of them or glob patterns')
+    parser.add_argument('--output-dir', type=str, default='results',
+                        help='directory the <file>.results reports are written to, below it the paths of '
+                             'the files relative to the directory they share, default(results)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes for independent files, default one per cpu')
+    parser.add_argument('--merge', type=str, default='', metavar='OUTPUT',
+                        help='merge the timestamp ordered files into one stream, writing its report to OUTPUT')
+    parser.add_argument('--mmap', action='store_true',
+                        help='parse the files through a memory map rather than csv.reader')
+    parser.add_argument('--keep-bid-history', action='store_true',
+                        help='retain every bid on each listing rather than running statistics only')
+    args = parser.parse_args()
+
+    files = expand_inputs(args.inputs)
+    if not files:
+        parser.error('no input files found')
+    started = time.perf_counter()
+    if args.merge:
+        runs = [run_merged(files, args.merge, args.mmap, args.keep_bid_history)]
+    else:
+        runs = run_files(files, args.output_dir, args.workers or None, args.mmap, args.keep_bid_history)
+    #file|instructions|seconds|instructions per second
+    for name, processed, seconds in runs:
+        print('{0}|{1}|{2:.3f}|{3:.0f}'.format(name, processed, seconds, processed / seconds if seconds else 0.0))
+    total = sum(processed for _, processed, _ in runs)
+    elapsed = time.perf_counter() - started
+    print('total|{0}|{1:.3f}|{2:.0f}'.format(total, elapsed, total / elapsed if elapsed else 0.0))
+
+
+if __name__ == '__main__':
+    main()
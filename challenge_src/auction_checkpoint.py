@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoint and resume of a Server part way through an instruction file.
+
+The file is read through a memory map a chunk of whole lines at a time
+(see auction_mmap), after a chunk has been processed and at least
+checkpoint_every instructions have passed since the last snapshot a
+snapshot is taken for the byte offset at the end of the chunk.
+
+A checkpoint directory holds two files:
+
+   changes.log     - append only, one length prefixed pickle per snapshot of
+                     the listings changed since the previous snapshot (listed,
+                     bid on or closed, see Server.changed_listings) and the
+                     item codes first seen since then
+   snapshot.pickle - the latest snapshot of the rest of the auction state:
+                     input offset, listing sequence, rejected bid counts and
+                     the size of changes.log it goes with, replaced atomically
+
+Snapshots are incremental, only the changed listings are pickled, on the
+processing thread so they are consistent, the pause is proportional to
+the activity since the last snapshot rather than to every open listing.
+They are written by a background thread. The queue to the writer holds a
+single snapshot, when the writer is still busy the snapshot is skipped and
+its changed listings carried over to the next one so processing never
+waits on the disk.
+
+On resume changes.log is truncated to the size recorded in the snapshot
+and replayed, the latest state of each listing wins. The listings are
+rebuilt in the order they were listed, the open ones scheduled to close,
+and processing continues from the offset. Auctions which closed after the
+snapshot was taken are closed (and written to the output) again.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import heapq
+import logging
+import os
+import pickle
+import queue
+import struct
+import threading
+from auction_mmap import read_mapped_chunks, CHUNK_SIZE
+from auction_records import ItemDictionary
+# -----------------------------------------
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+CHANGES_LOG_FILE = 'changes.log'
+SNAPSHOT_VERSION = 5
+RECORD_HEADER = struct.Struct('>Q')
+
+
+class Checkpointer:
+    """
+    Takes snapshots of a Server and restores it from the latest one
+        - server: Server being checkpointed
+        - checkpoint_dir: directory holding the snapshot and changed listings log
+        - file_name: input file the snapshots are offsets into
+    """
+    def __init__(self, server, checkpoint_dir, file_name):
+        self.server = server
+        self.checkpoint_dir = checkpoint_dir
+        self.file_name = file_name
+        self.logger = logging.getLogger('auctionLogger')
+        self.snapshot_path = os.path.join(checkpoint_dir, SNAPSHOT_FILE)
+        self.changes_log_path = os.path.join(checkpoint_dir, CHANGES_LOG_FILE)
+        #item codes already handed to the writer
+        self.item_codes_written = 0
+        #instructions processed before the offset resumed from
+        self.processed = 0
+        self.snapshots_taken = 0
+        self.snapshots_skipped = 0
+        self.failed = False
+        self.writer_queue = queue.Queue(maxsize=1)
+        self.writer = None
+        #listings changed since they were last handed to the writer
+        server.changed_listings = set()
+
+    def start(self, resume=False):
+        """
+        Start the writer thread, restoring the server from the latest snapshot
+        when resume is set (and there is one) otherwise starting afresh
+            - returns the input byte offset to start processing from
+        """
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        offset = self.restore() if resume else None
+        if offset is None:
+            offset = 0
+            for stale_file in (self.snapshot_path, self.changes_log_path):
+                if os.path.exists(stale_file):
+                    os.remove(stale_file)
+        self.writer = threading.Thread(target=self.write_snapshots, name='auction-checkpoint', daemon=True)
+        self.writer.start()
+        return offset
+
+    def stop(self):
+        """
+        Wait for the last snapshot handed to the writer to be written
+        """
+        if self.writer is not None:
+            self.writer_queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def snapshot(self, offset, processed=0):
+        """
+        Hand a snapshot of the server at input offset to the writer
+            - processed: instructions processed before offset
+            - returns False if the writer was busy and the snapshot skipped
+        """
+        if self.failed or self.writer_queue.full():
+            self.snapshots_skipped += 1
+            return False
+        server = self.server
+        item_codes = server.item_ids.codes
+        changes = pickle.dumps({
+            'listings': list(server.changed_listings),
+            'item_codes': item_codes[self.item_codes_written:],
+        }, pickle.HIGHEST_PROTOCOL)
+        state = pickle.dumps({
+            'version': SNAPSHOT_VERSION,
+            'file_name': os.path.basename(self.file_name),
+            'offset': offset,
+            'processed': processed,
+            'listing_sequence': server.listing_sequence,
+            'invalid_bid_counts': server.invalid_bid_counts,
+            'invalid_bid_samples': server.invalid_bid_samples,
+            'invalid_bids_seen': server.invalid_bids_seen,
+        }, pickle.HIGHEST_PROTOCOL)
+        self.writer_queue.put_nowait((changes, state))
+        server.changed_listings.clear()
+        self.item_codes_written = len(item_codes)
+        self.snapshots_taken += 1
+        return True
+
+    def write_snapshots(self):
+        """
+        Writer thread, appends the changes of each snapshot to the log then atomically replaces the snapshot file, which starts with
+        the size of the log it goes with
+        """
+        while True:
+            queued = self.writer_queue.get()
+            if queued is None:
+                return
+            changes, state = queued
+            try:
+                with open(self.changes_log_path, 'ab') as changes_log:
+                    changes_log.write(RECORD_HEADER.pack(len(changes)))
+                    changes_log.write(changes)
+                    changes_log.flush()
+                    os.fsync(changes_log.fileno())
+                    changes_log_size = changes_log.tell()
+                temporary_path = self.snapshot_path + '.tmp'
+                with open(temporary_path, 'wb') as snapshot_file:
+                    snapshot_file.write(RECORD_HEADER.pack(changes_log_size))
+                    snapshot_file.write(state)
+                    snapshot_file.flush()
+                    os.fsync(snapshot_file.fileno())
+                os.replace(temporary_path, self.snapshot_path)
+            except Exception:
+                #later snapshots would be missing these changes
+                self.failed = True
+                self.logger.exception('Error writing checkpoint to %s, no further checkpoints will be taken',
+                                      self.checkpoint_dir)
+
+    def restore(self):
+        """
+        Restore the server from the latest snapshot
+            - returns the input byte offset of the snapshot, or None if there is none
+        """
+        if not os.path.exists(self.snapshot_path):
+            self.logger.info('No checkpoint in %s, starting from the beginning', self.checkpoint_dir)
+            return None
+        with open(self.snapshot_path, 'rb') as snapshot_file:
+            changes_log_size, = RECORD_HEADER.unpack(snapshot_file.read(RECORD_HEADER.size))
+            state = pickle.load(snapshot_file)
+        if state['version'] != SNAPSHOT_VERSION:
+            raise Exception('Unsupported checkpoint version {0}'.format(state['version']))
+        if state['file_name'] != os.path.basename(self.file_name):
+            raise Exception('Checkpoint in {0} is for {1}, not {2}'.format(
+                self.checkpoint_dir, state['file_name'], self.file_name))
+
+        server = self.server
+        #the latest state of each listing, by listing sequence
+        latest = {}
+        item_codes = []
+        with open(self.changes_log_path, 'r+b') as changes_log:
+            changes_log.truncate(changes_log_size)
+            while changes_log.tell() < changes_log_size:
+                size, = RECORD_HEADER.unpack(changes_log.read(RECORD_HEADER.size))
+                changes = pickle.loads(changes_log.read(size))
+                item_codes.extend(changes['item_codes'])
+                for listing in changes['listings']:
+                    latest[listing.sequence] = listing
+        self.processed = state['processed']
+        self.item_codes_written = len(item_codes)
+
+        server.listing_sequence = state['listing_sequence']
+        server.item_ids = ItemDictionary(item_codes)
+        server.invalid_bid_counts = state['invalid_bid_counts']
+        server.invalid_bid_samples = state['invalid_bid_samples']
+        server.invalid_bids_seen = state['invalid_bids_seen']
+        #items keep the position of their first listing and the value of their latest
+        listings = [latest[sequence] for sequence in sorted(latest)]
+        for listing in listings:
+            server.all_listed_items[listing.item_name] = listing
+        server.close_schedule = [(listing.item_data.close_time, listing.sequence, listing)
+                                 for listing in listings if listing.is_open]
+        heapq.heapify(server.close_schedule)
+        server.open_listings = {item: listing for item, listing in server.all_listed_items.items() if listing.is_open}
+        self.logger.info('Resumed from checkpoint at byte %d (%d instructions, %d listings)',
+                         state['offset'], state['processed'], len(listings))
+        return state['offset']
+
+
+def process_with_checkpoints(server, file_name, checkpoint_dir, checkpoint_every=100000,
+                             resume=False, chunk_size=CHUNK_SIZE):
+    """
+    Process file_name through server taking a snapshot whenever at least
+    checkpoint_every instructions have been processed since the last one
+        - resume: continue from the latest snapshot in checkpoint_dir
+        - returns the checkpointer, holding counts of the snapshots taken
+    """
+    checkpointer = Checkpointer(server, checkpoint_dir, file_name)
+    offset = checkpointer.start(resume=resume)
+    processed = last_snapshot = checkpointer.processed
+    try:
+        for end, instructions in read_mapped_chunks(file_name, server.classify_instruction, chunk_size, offset):
+            for instruction in instructions:
+                server.process_instruction(instruction)
+                processed += 1
+            if processed - last_snapshot >= checkpoint_every and checkpointer.snapshot(end, processed):
+                last_snapshot = processed
+    finally:
+        checkpointer.stop()
+    server.logger.info('Processed %d instructions, %d checkpoints taken, %d skipped',
+                       processed, checkpointer.snapshots_taken, checkpointer.snapshots_skipped)
+    return checkpointer
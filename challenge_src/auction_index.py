@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+Indexes over closed auction results, maintained as each listing closes
+(a Server closed_listing_handler, see ResultIndex.attach) so queries are
+answered mid-run without scanning the listings:
+
+   top_by_price(n)          - sold results with the highest price paid,
+                              highest first, earliest closed first on a tie
+   unsold_by_seller(user)   - unsold results of a seller, in close order
+   closed_between(start, end) - results with start <= close_time <= end,
+                              in close_time order
+
+Every closed listing is indexed, so an item listed again after closing
+has a result for each of its auctions. The price index keeps only the
+top_capacity best results in a bounded heap (O(log top_capacity) per
+close), the close_time index is appended to as listings close in
+close_time order, falling back to a bisect insert for anything earlier.
+
+The seller and close_time indexes cover the latest capacity results
+only, so a long running service (with closed listings retired to the
+results store, see auction_results) keeps a bounded index. Older results
+are dropped in batches once twice capacity are held, an amortised O(1)
+per close.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+import heapq
+# -----------------------------------------
+
+SOLD = 'SOLD'
+
+
+class ResultIndex:
+    """
+    Closed auction results with price, seller and close_time indexes
+        - top_capacity: most results top_by_price can return
+        - capacity: latest results unsold_by_seller and closed_between cover, 0 for every result
+    """
+    def __init__(self, top_capacity=1000, capacity=100000):
+        self.top_capacity = top_capacity
+        self.capacity = capacity
+        #results from first_position on in the order closed, the indexes hold positions
+        self.results = []
+        self.first_position = 0
+        self.next_position = 0
+        #min heap of (price_paid, -position, result), the best top_capacity sold results
+        self.top_prices = []
+        self.unsold_positions = defaultdict(list)
+        #close times in ascending order and the result position of each
+        self.close_times = []
+        self.close_time_positions = []
+
+    def attach(self, server):
+        """
+        Index the results of a server as its listings close
+        """
+        server.closed_listing_handlers.append(self.add_listing)
+        return self
+
+    def add_listing(self, listing):
+        """
+        Closed listing handler (see Server.closed_listing_handlers)
+        """
+        position = self.next_position
+        self.next_position += 1
+        result = listing.auction_result
+        self.results.append(result)
+        if listing.sale_status == SOLD:
+            entry = (listing.price_paid, -position, result)
+            if len(self.top_prices) < self.top_capacity:
+                heapq.heappush(self.top_prices, entry)
+            elif entry > self.top_prices[0]:
+                heapq.heapreplace(self.top_prices, entry)
+        else:
+            self.unsold_positions[listing.item_data.user_id].append(position)
+        close_time = listing.item_data.close_time
+        close_times = self.close_times
+        if not close_times or close_time >= close_times[-1]:
+            close_times.append(close_time)
+            self.close_time_positions.append(position)
+        else:
+            index = bisect_right(close_times, close_time)
+            close_times.insert(index, close_time)
+            self.close_time_positions.insert(index, position)
+        if self.capacity and len(self.results) >= 2 * self.capacity:
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        """
+        Drop every result but the latest capacity from the seller and close_time indexes
+        """
+        first_position = self.next_position - self.capacity
+        del self.results[:first_position - self.first_position]
+        self.first_position = first_position
+        kept = [(close_time, position) for close_time, position in zip(self.close_times, self.close_time_positions)
+                if position >= first_position]
+        self.close_times = [close_time for close_time, _ in kept]
+        self.close_time_positions = [position for _, position in kept]
+        for user_id, positions in list(self.unsold_positions.items()):
+            if positions[0] < first_position:
+                positions = [position for position in positions if position >= first_position]
+                if positions:
+                    self.unsold_positions[user_id] = positions
+                else:
+                    del self.unsold_positions[user_id]
+
+    def oldest_position(self):
+        """
+        Position of the oldest result the seller and close_time indexes cover
+        """
+        if self.capacity:
+            return max(self.first_position, self.next_position - self.capacity)
+        return self.first_position
+
+    def top_by_price(self, count):
+        """
+        The count sold results with the highest price paid
+            - raises ValueError if count is more than top_capacity
+        """
+        if count > self.top_capacity:
+            raise ValueError('at most {0} top results are kept'.format(self.top_capacity))
+        return [result for _, _, result in heapq.nlargest(count, self.top_prices)]
+
+    def unsold_by_seller(self, user_id):
+        results = self.results
+        oldest = self.oldest_position()
+        first_position = self.first_position
+        return [results[position - first_position] for position in self.unsold_positions.get(user_id, ())
+                if position >= oldest]
+
+    def closed_between(self, start, end):
+        """
+        Results with a close_time from start to end inclusive
+        """
+        results = self.results
+        oldest = self.oldest_position()
+        first_position = self.first_position
+        low = bisect_left(self.close_times, start)
+        high = bisect_right(self.close_times, end)
+        return [results[position - first_position] for position in self.close_time_positions[low:high]
+                if position >= oldest]
+
+    def __len__(self):
+        """
+        Results the seller and close_time indexes cover
+        """
+        return self.next_position - self.oldest_position()
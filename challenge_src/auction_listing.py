@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-
+from auction_records import format_money
 
 class AuctionListing:
     """
@@ -8,19 +8,48 @@ class AuctionListing:
         - auction_item_name: Name of item being auctioned
         - auction_listing_data: Named tuple in the following format
                                 data_structure('user_listing', 'timestamp user_id action item reserve_price close_time')
+        - keep_bid_history: Retain every bid in all_bids/valid_bids, by default
+                            only running statistics are kept (constant space)
+        - item_id: Dense integer id of the item (see Server.item_ids)
     """
-    def __init__(self, auction_item_name, auction_listing_data):
+    def __init__(self, auction_item_name, auction_listing_data, keep_bid_history=False, item_id=None):
         self.item_name = auction_item_name
+        self.item_id = item_id
         self.item_data = auction_listing_data
+        self.keep_bid_history = keep_bid_history
         self.all_bids = []
         self.valid_bids = []
-        self.price_paid = ''
+        #running statistics, updated as each bid is added, amounts are minor units (see auction_records)
+        self.bid_count = 0
+        self.valid_bid_count = 0
+        self.max_bid_amount = None
+        self.min_bid_amount = None
+        self.winning_bid = None
+        #best valid bid of a user other than the winner, sets the price paid
+        self.runner_up_bid = None
+        #best valid bid amount of each user, bids must beat the user's own best
+        self.user_best_bids = {}
+        #set when the listing closes
+        self.price_paid = None
         self.sale_status = 'UNSOLD'
         self.total_bid_count = ''
-        self.highest_bid = ''
-        self.lowest_bid = ''
-        self.lowest_valid_bid = ''
+        self.highest_bid = None
+        self.lowest_bid = None
         self.is_open = False
+        self.auction_result = None
+        self.sequence = 0
+        #rejected bids per reason, a Counter created by the Server on the first rejection
+        self.invalid_bid_counts = None
+
+    def __getstate__(self):
+        """
+        Pickled state (see auction_checkpoint), the per user best bids are
+        only needed to validate bids so are left out once the listing closes
+        """
+        state = self.__dict__
+        if not self.is_open and self.user_best_bids:
+            state = dict(state, user_best_bids={})
+        return state
 
     def get_auction_item_name(self):
         return self.item_name
@@ -29,10 +58,41 @@ class AuctionListing:
         return self.item_data
     
     def add_bid_to_all_bids_list(self, new_bid):
-        self.all_bids.append(new_bid)
+        """
+        Count a bid received within the auction time, tracking the
+        highest and lowest amounts
+        """
+        amount = new_bid.bid_amount
+        if self.bid_count == 0:
+            self.max_bid_amount = amount
+            self.min_bid_amount = amount
+        elif amount > self.max_bid_amount:
+            self.max_bid_amount = amount
+        elif amount < self.min_bid_amount:
+            self.min_bid_amount = amount
+        self.bid_count += 1
+        if self.keep_bid_history:
+            self.all_bids.append(new_bid)
 
     def add_bid_to_valid_bid_list(self, valid_bid):
-        self.valid_bids.append(valid_bid)
+        """
+        Count a valid bid, keeping the best bid of its user, the winning
+        bid and the runner up, the best bid of any other user (earliest bid
+        wins a tie as it is only replaced by a strictly higher amount)
+        """
+        amount = valid_bid.bid_amount
+        self.user_best_bids[valid_bid.user_id] = amount
+        winning_bid = self.winning_bid
+        if winning_bid is None or amount > winning_bid.bid_amount:
+            #a winner raising their own bid keeps the runner up from another user
+            if winning_bid is not None and winning_bid.user_id != valid_bid.user_id:
+                self.runner_up_bid = winning_bid
+            self.winning_bid = valid_bid
+        elif self.runner_up_bid is None or amount > self.runner_up_bid.bid_amount:
+            self.runner_up_bid = valid_bid
+        self.valid_bid_count += 1
+        if self.keep_bid_history:
+            self.valid_bids.append(valid_bid)
 
     def get_all_listing_bids(self):
         return self.all_bids
@@ -46,16 +106,32 @@ class AuctionListing:
                                                             self.item_name, 
                                                             self.item_data.user_id, 
                                                             self.sale_status, 
-                                                            self.price_paid, 
+                                                            self.format_amount(self.price_paid), 
                                                             self.total_bid_count, 
-                                                            self.highest_bid, 
-                                                            self.lowest_bid))
+                                                            self.format_amount(self.highest_bid), 
+                                                            self.format_amount(self.lowest_bid)))
+
+    @staticmethod
+    def format_amount(amount):
+        """
+        Output form of an amount, empty until the listing has closed
+        """
+        return format_money(amount) if amount is not None else ''
 
     def set_sale_status(self, status='SOLD'):
         self.sale_status = status
 
+    def get_user_best_bid(self, user_id):
+        return self.user_best_bids.get(user_id)
+
+    def get_winning_user_id(self):
+        return self.winning_bid.user_id if self.winning_bid is not None else ''
+
     def set_highest_bid(self):
-        self.highest_bid = str(self.valid_bids[-1]) if len(auction_item.valid_bids) > 1 else '0.00'
+        self.highest_bid = self.max_bid_amount if self.max_bid_amount is not None else 0
+
+    def set_lowest_bid(self):
+        self.lowest_bid = self.min_bid_amount if self.min_bid_amount is not None else 0
 
     def set_open_status(self, status=False):
         self.is_open = status
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""
+Built in instrumentation of a Server's processing loop.
+
+Once a Metrics is set as Server.metrics (see Metrics.instrument) the
+server reports these stages to it:
+
+   process_instruction     - count and latency histogram per instruction type
+   data_classification     - parsing a row as it is loaded into memory
+   valid_bid_check         - validation of a bid (Server.bid_rejection_reason)
+   close_listing           - closing a listing, including its result handlers
+   auction_summary_report,
+   complete_summary_report - building the report
+
+Every instruction is counted but only one in sample_every instructions
+and rows is timed (bids are validated under a timer when their
+instruction is timed, closing listings and the reports are always timed),
+so histogram counts are of the sampled calls. With the default of 16 the
+processing loop runs about 10% slower than without metrics. A timed call costs
+two perf_counter_ns calls and a bisect into fixed log spaced buckets.
+Gauges (open listings, close schedule size, item dictionary size, rejected
+bids by reason) are read from the server when the metrics are rendered, so
+cost nothing while processing.
+
+The metrics can be rendered as Prometheus text, served over HTTP on
+/metrics (GET /profile?seconds=N returns a sampling profile of the
+processing thread taken over N seconds), or logged every few seconds as
+a one line summary with the bid rate since the previous line.
+
+SamplingProfiler reads the stack of the processing thread every interval
+seconds from a background thread, counting collapsed stacks (the input of
+flamegraph.pl), so the processing thread itself is never slowed by tracing.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+from bisect import bisect_left
+from collections import Counter
+import logging
+import sys
+import threading
+import time
+from auction_records import UserListing, Bid, Heartbeat
+# -----------------------------------------
+
+#bucket upper bounds in nanoseconds, 1 microsecond to 1 second
+LATENCY_BUCKETS = (1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000,
+                   1000000, 2500000, 10000000, 100000000, 1000000000)
+INSTRUCTION_TYPES = ((UserListing, 'user_listing'), (Bid, 'bid'), (Heartbeat, 'heartbeat'))
+#rows are timed one in sample_every, bids while their instruction is timed, the rest always
+SAMPLED_STAGES = ('data_classification', 'valid_bid_check')
+TIMED_STAGES = SAMPLED_STAGES + ('close_listing', 'auction_summary_report', 'complete_summary_report')
+INSTRUCTION_NAMES = dict(INSTRUCTION_TYPES)
+MAX_PROFILE_SECONDS = 60
+perf_counter_ns = time.perf_counter_ns
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets
+        - bounds: ascending bucket upper bounds in nanoseconds
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        #the last count is for observations above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """
+        Upper bound in seconds of the bucket holding the given fraction of
+        observations, None when empty or above the last bucket
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return bound / 1e9
+        return None
+
+    def prometheus_lines(self, name, labels):
+        """
+        Cumulative _bucket, _sum and _count lines of the histogram
+            - labels: label text without braces, e.g. 'type="bid"'
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{{1},le="{2:g}"}} {3}'.format(name, labels, bound / 1e9, cumulative))
+        lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labels, self.count))
+        lines.append('{0}_sum{{{1}}} {2:.9f}'.format(name, labels, self.total / 1e9))
+        lines.append('{0}_count{{{1}}} {2}'.format(name, labels, self.count))
+        return lines
+
+
+class Metrics:
+    """
+    Instrumentation of a Server, see instrument
+        - server: Server being measured
+        - sample_every: time one in this many instructions and rows
+    """
+    def __init__(self, server, sample_every=16):
+        self.server = server
+        self.sample_every = sample_every
+        self.instruction_counts = dict.fromkeys((record_type for record_type, _ in INSTRUCTION_TYPES), 0)
+        self.logger = logging.getLogger('auctionLogger')
+        self.instruction_latency = {name: Histogram() for _, name in INSTRUCTION_TYPES}
+        self.stage_latency = {stage: Histogram() for stage in TIMED_STAGES}
+        #calls left until the next timed one, bids are only validated
+        #under a timer while sampling (during a timed instruction)
+        self.instruction_countdown = 1
+        self.stage_countdowns = dict.fromkeys(TIMED_STAGES, 1)
+        self.sampling = False
+        self.started = time.time()
+        #thread processing the instructions, the one profiled
+        self.processing_thread_id = None
+        self.stats_thread = None
+        self.stopping = threading.Event()
+        self.http_server = None
+        self.last_dump = (time.perf_counter(), 0)
+        #event time reorder buffer in front of the server, when set (see auction_reorder)
+        self.reorder_buffer = None
+
+    def instrument(self):
+        """
+        Set as the server's metrics, called from the thread which will
+        process the instructions
+        """
+        self.server.metrics = self
+        self.processing_thread_id = threading.get_ident()
+        return self
+
+    def instruction_started(self, instruction):
+        """
+        Count an instruction
+            - returns the start time when it is to be timed, otherwise 0
+        """
+        self.instruction_counts[type(instruction)] += 1
+        self.instruction_countdown -= 1
+        if self.instruction_countdown:
+            return 0
+        self.instruction_countdown = self.sample_every
+        self.sampling = True
+        return perf_counter_ns()
+
+    def instruction_finished(self, instruction, started):
+        self.instruction_latency[INSTRUCTION_NAMES[type(instruction)]].observe(perf_counter_ns() - started)
+        self.sampling = False
+
+    def stage_started(self, stage):
+        """
+        Returns the start time when this call of stage is to be timed, otherwise 0
+        """
+        countdown = self.stage_countdowns[stage] - 1
+        if countdown:
+            self.stage_countdowns[stage] = countdown
+            return 0
+        self.stage_countdowns[stage] = self.sample_every if stage in SAMPLED_STAGES else 1
+        return perf_counter_ns()
+
+    def stage_finished(self, stage, started):
+        self.stage_latency[stage].observe(perf_counter_ns() - started)
+
+    def instructions_processed(self, name=None):
+        """
+        Instructions processed, of every type or the one named (e.g. 'bid')
+        """
+        return sum(count for record_type, count in self.instruction_counts.items()
+                   if name is None or record_type.__name__ == name)
+
+    def render(self):
+        """
+        Prometheus text exposition of every metric
+        """
+        server = self.server
+        lines = ['# HELP auction_instructions_total Instructions processed by type',
+                 '# TYPE auction_instructions_total counter']
+        for _, name in INSTRUCTION_TYPES:
+            lines.append('auction_instructions_total{{type="{0}"}} {1}'.format(name, self.instructions_processed(name)))
+        lines.extend(['# HELP auction_instruction_seconds Time to process an instruction by type, sampled',
+                      '# TYPE auction_instruction_seconds histogram'])
+        for name, histogram in self.instruction_latency.items():
+            lines.extend(histogram.prometheus_lines('auction_instruction_seconds', 'type="{0}"'.format(name)))
+        lines.extend(['# HELP auction_stage_seconds Time spent in each stage of processing',
+                      '# TYPE auction_stage_seconds histogram'])
+        for stage, histogram in self.stage_latency.items():
+            lines.extend(histogram.prometheus_lines('auction_stage_seconds', 'stage="{0}"'.format(stage)))
+        lines.extend(['# HELP auction_invalid_bids_total Rejected bids by reason',
+                      '# TYPE auction_invalid_bids_total counter'])
+        for reason, count in sorted(server.invalid_bid_counts.items()):
+            lines.append('auction_invalid_bids_total{{reason="{0}"}} {1}'.format(reason, count))
+        lines.extend(['# HELP auction_open_listings Listings currently open',
+                      '# TYPE auction_open_listings gauge',
+                      'auction_open_listings {0}'.format(len(server.open_listings)),
+                      '# HELP auction_listings_in_memory Listings held in memory, open or closed',
+                      '# TYPE auction_listings_in_memory gauge',
+                      'auction_listings_in_memory {0}'.format(len(server.all_listed_items)),
+                      '# HELP auction_close_schedule_size Listings waiting in the close schedule',
+                      '# TYPE auction_close_schedule_size gauge',
+                      'auction_close_schedule_size {0}'.format(len(server.close_schedule)),
+                      '# HELP auction_item_dictionary_size Distinct item codes encoded, never released',
+                      '# TYPE auction_item_dictionary_size gauge',
+                      'auction_item_dictionary_size {0}'.format(len(server.item_ids)),
+                      '# HELP auction_start_time_seconds Time the metrics were started',
+                      '# TYPE auction_start_time_seconds gauge',
+                      'auction_start_time_seconds {0:.3f}'.format(self.started)])
+        if self.reorder_buffer is not None:
+            lines.extend(self.reorder_buffer.prometheus_lines())
+        return '\n'.join(lines) + '\n'
+
+    def stats_line(self):
+        """
+        One line summary of the metrics, the rates are since the previous line
+        """
+        now = time.perf_counter()
+        last_time, last_bids = self.last_dump
+        bids = self.instructions_processed('bid')
+        self.last_dump = (now, bids)
+        bid_rate = (bids - last_bids) / (now - last_time) if now > last_time else 0.0
+        latency = self.instruction_latency['bid']
+        p50, p99 = latency.quantile(0.5), latency.quantile(0.99)
+        line = ('{0} instructions, {1:.0f} bids/s, bid p50 {2} p99 {3}, {4} open listings, '
+                '{5} invalid bids, {6:.3f}s closing listings').format(
+                    self.instructions_processed(), bid_rate,
+                    '{0:g}s'.format(p50) if p50 is not None else '-',
+                    '{0:g}s'.format(p99) if p99 is not None else '-',
+                    len(self.server.open_listings), sum(self.server.invalid_bid_counts.values()),
+                    self.stage_latency['close_listing'].total / 1e9)
+        reorder_buffer = self.reorder_buffer
+        if reorder_buffer is not None:
+            line += ', {0} reordering (peak {1}), {2} late'.format(
+                reorder_buffer.buffered, reorder_buffer.peak_buffered, reorder_buffer.late)
+        return line
+
+    def log_stats_periodically(self, interval):
+        """
+        Log stats_line every interval seconds from a background thread, until stop
+        """
+        def dump():
+            while not self.stopping.wait(interval):
+                self.logger.info('Metrics: %s', self.stats_line())
+        self.stats_thread = threading.Thread(target=dump, name='auction-stats', daemon=True)
+        self.stats_thread.start()
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve /metrics and /profile over HTTP from a background thread
+            - returns the (host, port) being listened on
+        """
+        #only imported when serving, to keep the import of the server lean
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import urlparse, parse_qs
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                request = urlparse(self.path)
+                if request.path == '/metrics':
+                    body = metrics.render()
+                elif request.path == '/profile':
+                    try:
+                        seconds = float(parse_qs(request.query).get('seconds', ['5'])[0])
+                    except ValueError:
+                        self.send_error(400, 'seconds must be a number')
+                        return
+                    profiler = SamplingProfiler(metrics.processing_thread_id)
+                    profiler.start()
+                    time.sleep(min(max(seconds, 0), MAX_PROFILE_SECONDS))
+                    profiler.stop()
+                    body = profiler.collapsed()
+                else:
+                    self.send_error(404)
+                    return
+                encoded = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, format, *args):
+                metrics.logger.debug('Metrics request: ' + format, *args)
+
+        self.http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.http_server.daemon_threads = True
+        threading.Thread(target=self.http_server.serve_forever, name='auction-metrics', daemon=True).start()
+        address = self.http_server.server_address[:2]
+        self.logger.info('Serving metrics on http://%s:%d/metrics', *address)
+        return address
+
+    def stop(self):
+        """
+        Stop the stats thread and metrics server
+        """
+        self.stopping.set()
+        if self.stats_thread is not None:
+            self.stats_thread.join()
+            self.stats_thread = None
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of a thread from a background thread
+        - thread_id: thread to sample, threading.get_ident() of it
+        - interval: seconds between samples
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        self.sampler = threading.Thread(target=self.sample, name='auction-profiler', daemon=True)
+        self.sampler.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        return self
+
+    def sample(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """
+        Sampled stacks in collapsed format, one 'frame;frame;frame count' line
+        per stack with the most sampled first
+        """
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in self.stacks.most_common())
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory mapped instruction file reader.
+
+The file is mapped rather than read through a text file and csv.reader,
+each line is split on the pipe delimiter as raw bytes and the fields are
+converted straight into the typed records (see auction_records):
+
+   - timestamps, user ids and close times are parsed from the byte fields
+   - prices are decoded as ascii and parsed into minor units by parse_money
+   - item codes are decoded and interned once per distinct item, later
+     rows for the same item reuse the same string
+   - integers and item codes too wide for the binary formats are rejected
+     as parse_instruction rejects them (see auction_records)
+
+Lines the byte parser cannot handle (malformed fields, quotes, stray
+carriage returns, blank lines) are decoded and passed through csv.reader
+and the given classify function instead, so exactly the same rows are
+accepted and rejected (and logged) as with csv.reader.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import csv
+import io
+import mmap
+import sys
+from auction_records import UserListing, Bid, Heartbeat, SELL, BID
+from auction_records import check_integers, parse_instruction, parse_money, MAX_ITEM_BYTES
+# -----------------------------------------
+
+PIPE = b'|'
+QUOTE = b'"'
+CARRIAGE_RETURN = b'\r'
+NEW_LINE = b'\n'
+SELL_BYTES = SELL.encode('ascii')
+BID_BYTES = BID.encode('ascii')
+CHUNK_SIZE = 1 << 20
+#builds the records without the python level namedtuple __new__
+tuple_new = tuple.__new__
+
+
+def classify_row(data):
+    """
+    Default classify function, returns the typed record or None if the row is malformed
+    """
+    try:
+        return parse_instruction(data)
+    except ValueError:
+        return None
+
+
+def csv_rows(line):
+    """
+    Rows csv.reader gives for a raw line, decoded as the file would be
+    """
+    return csv.reader(io.StringIO(line.decode('utf-8'), newline=''), delimiter='|')
+
+
+def read_mapped_instructions(file_name, classify=classify_row, chunk_size=CHUNK_SIZE):
+    """
+    Generator reading file_name through a memory map
+        - classify: called with the csv row of each line the byte parser
+          cannot handle, returns the typed record or None to skip the row
+        - chunk_size: bytes split into lines at a time
+        - yields classified instructions (user_listing, bid, heartbeat)
+    """
+    for _, instructions in read_mapped_chunks(file_name, classify, chunk_size):
+        yield from instructions
+
+
+def read_mapped_chunks(file_name, classify=classify_row, chunk_size=CHUNK_SIZE, start=0):
+    """
+    Generator reading file_name through a memory map a chunk of whole lines at a time
+        - start: byte offset to start reading from, the start of a line
+        - yields (end, instructions), the byte offset just after the chunk and
+          a generator of its classified instructions, which must be consumed
+          before the next chunk is read
+    """
+    items = {}
+    with open(file_name, 'rb') as instruction_file:
+        try:
+            mapped_file = mmap.mmap(instruction_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            #empty files cannot be mapped
+            return
+        with mapped_file:
+            for lines, plain, end in mapped_lines(mapped_file, chunk_size, start):
+                yield end, parse_lines(lines, plain, items, classify)
+
+
+def parse_lines(lines, plain, items, classify=classify_row):
+    """
+    Generator converting the lines of a chunk into typed records
+        - plain: no line holds a quote or carriage return
+        - items: cache of interned item codes keyed on their bytes
+    """
+    for line in lines:
+        instruction = None
+        if plain or not (QUOTE in line or CARRIAGE_RETURN in line):
+            try:
+                instruction = parse_fields(line.split(PIPE), items)
+            except ValueError:
+                instruction = None
+        if instruction is not None:
+            yield instruction
+        else:
+            for data in csv_rows(line):
+                instruction = classify(data)
+                if instruction is not None:
+                    yield instruction
+
+
+def mapped_lines(mapped_file, chunk_size=CHUNK_SIZE, start=0):
+    """
+    Split a memory mapped file into lines a chunk at a time
+        - yields (lines, plain, end), plain is True when the chunk holds no
+          quotes or carriage returns so every line can go to the byte parser
+          and end is the byte offset just after the chunk
+    """
+    size = len(mapped_file)
+    position = start
+    while position < size:
+        end = mapped_file.rfind(NEW_LINE, position, min(position + chunk_size, size)) + 1
+        if end <= position:
+            #a line longer than the chunk, or the last line without a new line
+            end = mapped_file.find(NEW_LINE, position) + 1 or size
+        chunk = mapped_file[position:end]
+        position = end
+        lines = chunk.split(NEW_LINE)
+        if not lines[-1]:
+            lines.pop()
+        plain = QUOTE not in chunk and CARRIAGE_RETURN not in chunk
+        if not plain:
+            lines = [line[:-1] if line.endswith(CARRIAGE_RETURN) else line for line in lines]
+        yield lines, plain, end
+
+
+def parse_fields(fields, items):
+    """
+    Convert the byte fields of a row into its typed record
+        - items: cache of interned item codes keyed on their bytes
+        - raises ValueError if the row is not well formed
+    """
+    column_count = len(fields)
+    if column_count == 5:
+        if fields[2] != BID_BYTES:
+            raise ValueError('Expecting action BID')
+        price = parse_money(fields[4].decode('ascii'))
+        bid = tuple_new(Bid, (int(fields[0]), int(fields[1]), BID,
+                              items.get(fields[3]) or intern_item(fields[3], items), price))
+        check_integers(bid[0], bid[1], price)
+        return bid
+    if column_count == 6:
+        if fields[2] != SELL_BYTES:
+            raise ValueError('Expecting action SELL')
+        price = parse_money(fields[4].decode('ascii'))
+        listing = tuple_new(UserListing, (int(fields[0]), int(fields[1]), SELL,
+                                          items.get(fields[3]) or intern_item(fields[3], items), price,
+                                          int(fields[5])))
+        check_integers(listing[0], listing[1], price, listing[5])
+        return listing
+    if column_count == 1 and fields[0]:
+        heartbeat = tuple_new(Heartbeat, (int(fields[0]),))
+        check_integers(heartbeat[0])
+        return heartbeat
+    raise ValueError('Unexpected number of columns ({0}) in row'.format(column_count))
+
+
+def intern_item(item, items):
+    """
+    Decode and intern an item code the first time it is seen
+        - raises ValueError if it is longer than MAX_ITEM_BYTES
+    """
+    if len(item) > MAX_ITEM_BYTES:
+        raise ValueError('Item code longer than {0} bytes'.format(MAX_ITEM_BYTES))
+    item_code = items[item] = sys.intern(item.decode('utf-8'))
+    return item_code
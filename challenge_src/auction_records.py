@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+"""
+Typed records for the auction instructions.
+
+Each row of the input file is converted exactly once into one of the
+namedtuples below, timestamps, user ids and close times become integers
+and prices become integer minor units (see parse_money), so validating a
+bid is plain integer comparisons and prices are only formatted, to
+MONEY_DECIMAL_PLACES, when a result is output. Namedtuples declare empty __slots__ so each
+record is a plain tuple without a per instance __dict__.
+
+   user_listing - (timestamp|user_id|action|item|reserve_price|close_time)
+   bid          - (timestamp|user_id|action|item|bid_amount)
+   heartbeat    - (timestamp)
+
+Item codes are interned as they are parsed, ItemDictionary maps them to
+dense integer ids for per item state held in arrays.
+
+Integers (amounts included) must fit in a signed 64 bit integer and item
+codes in MAX_ITEM_BYTES of utf-8, the widths of the binary formats (write
+ahead log, result sinks, snapshots), anything larger is a malformed row.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+from collections import namedtuple as data_structure
+import sys
+# -----------------------------------------
+
+UserListing = data_structure('user_listing', 'timestamp user_id action item reserve_price close_time')
+Bid = data_structure('bid', 'timestamp user_id action item bid_amount')
+Heartbeat = data_structure('heartbeat', 'timestamp')
+AuctionResult = data_structure('auction_result', 'close_time item user_id status price_paid total_bid_count highest_bid lowest_bid')
+
+#records keep their lower case type names (see Server.data_classification),
+#the qualified names let pickle find them as attributes of this module
+UserListing.__qualname__ = 'UserListing'
+Bid.__qualname__ = 'Bid'
+Heartbeat.__qualname__ = 'Heartbeat'
+AuctionResult.__qualname__ = 'AuctionResult'
+
+SELL = 'SELL'
+BID = 'BID'
+#prices are integers of minor units (pence, cents), 10 ** MONEY_DECIMAL_PLACES to the unit
+MONEY_DECIMAL_PLACES = 2
+MINOR_UNITS = 10 ** MONEY_DECIMAL_PLACES
+#widest integer and item code the binary formats hold
+MIN_INTEGER = -(1 << 63)
+MAX_INTEGER = (1 << 63) - 1
+MAX_ITEM_BYTES = 65535
+
+
+class ItemDictionary:
+    """
+    Dictionary encoding of item codes, each distinct item code is interned
+    and given the next dense integer id (0, 1, 2...) when first seen
+        - codes: item codes to encode up front, in id order
+    Ids index arrays of per item state (settlement columns, the item
+    records of the write ahead log), the reverse table codes is only read
+    when writing output.
+    Ids are never released (the write ahead log and checkpoints record
+    them by position), so a dictionary grows with the distinct item codes
+    seen, roughly 110 bytes plus the code each. A long running service
+    holds one entry per item ever listed, its size is the
+    auction_item_dictionary_size gauge (see auction_metrics).
+    """
+    __slots__ = ('ids', 'codes')
+
+    def __init__(self, codes=()):
+        self.ids = {}
+        self.codes = []
+        for item in codes:
+            self.encode(item)
+
+    def encode(self, item):
+        """
+        Id of an item code, assigning the next id if it is new
+        """
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item = sys.intern(item)
+            item_id = self.ids[item] = len(self.codes)
+            self.codes.append(item)
+        return item_id
+
+    def get(self, item):
+        """
+        Id of an item code, None if it has not been seen
+        """
+        return self.ids.get(item)
+
+    def decode(self, item_id):
+        return self.codes[item_id]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __reduce__(self):
+        return (ItemDictionary, (self.codes,))
+
+
+def parse_money(value):
+    """
+    Convert a decimal price (text, or a number) into integer minor units, e.g. '12.5' -> 1250
+        - raises ValueError for anything which is not a plain decimal number
+          or has more decimal places than MONEY_DECIMAL_PLACES (other than
+          trailing zeros)
+    """
+    if type(value) is not str:
+        value = str(value)
+    whole, _, fraction = value.partition('.')
+    if len(fraction) == MONEY_DECIMAL_PLACES and whole.isdigit() and fraction.isdigit():
+        #the usual form, e.g. 12.50
+        return int(whole + fraction)
+    digits = value.strip()
+    negative = digits[:1] == '-'
+    if negative or digits[:1] == '+':
+        digits = digits[1:]
+    whole, _, fraction = digits.partition('.')
+    if len(fraction) > MONEY_DECIMAL_PLACES and not fraction[MONEY_DECIMAL_PLACES:].strip('0'):
+        fraction = fraction[:MONEY_DECIMAL_PLACES]
+    if (not whole and not fraction) or len(fraction) > MONEY_DECIMAL_PLACES \
+            or (whole and not whole.isdigit()) or (fraction and not fraction.isdigit()):
+        raise ValueError('Invalid price: {0!r}'.format(value))
+    amount = int(whole or 0) * MINOR_UNITS + int(fraction.ljust(MONEY_DECIMAL_PLACES, '0') or 0)
+    return -amount if negative else amount
+
+
+def format_money(amount):
+    """
+    Format integer minor units as a decimal to MONEY_DECIMAL_PLACES, e.g. 1250 -> '12.50'
+    """
+    whole, fraction = divmod(abs(amount), MINOR_UNITS)
+    sign = '-' if amount < 0 else ''
+    if not MONEY_DECIMAL_PLACES:
+        return '{0}{1}'.format(sign, whole)
+    return '{0}{1}.{2:0{3}d}'.format(sign, whole, fraction, MONEY_DECIMAL_PLACES)
+
+
+def check_integers(*values):
+    """
+    Check integers fit in a signed 64 bit integer
+        - raises ValueError for the first which does not
+    """
+    for value in values:
+        if not MIN_INTEGER <= value <= MAX_INTEGER:
+            raise ValueError('{0} does not fit in a 64 bit integer'.format(value))
+
+
+def check_item(item):
+    """
+    Check an item code is at most MAX_ITEM_BYTES once encoded as utf-8
+        - raises ValueError if it is longer
+    """
+    #utf-8 takes at most 4 bytes a character, only long codes need encoding
+    if len(item) * 4 > MAX_ITEM_BYTES and len(item.encode('utf-8')) > MAX_ITEM_BYTES:
+        raise ValueError('Item code longer than {0} bytes'.format(MAX_ITEM_BYTES))
+    return item
+
+
+def parse_user_listing(data):
+    """
+    Convert a user listing row into a user_listing record
+        - raises ValueError if the row is malformed
+    """
+    if data[2] != SELL:
+        raise ValueError('Expecting action SELL, got {0!r}'.format(data[2]))
+    listing = UserListing(int(data[0]), int(data[1]), SELL, sys.intern(check_item(data[3])),
+                          parse_money(data[4]), int(data[5]))
+    check_integers(listing[0], listing[1], listing[4], listing[5])
+    return listing
+
+
+def parse_bid(data):
+    """
+    Convert a bid row into a bid record
+        - raises ValueError if the row is malformed
+    """
+    if data[2] != BID:
+        raise ValueError('Expecting action BID, got {0!r}'.format(data[2]))
+    bid = Bid(int(data[0]), int(data[1]), BID, sys.intern(check_item(data[3])), parse_money(data[4]))
+    check_integers(bid[0], bid[1], bid[4])
+    return bid
+
+
+def parse_heartbeat(data):
+    """
+    Convert a heartbeat row into a heartbeat record
+        - raises ValueError if the row is malformed
+    """
+    heartbeat = Heartbeat(int(data[0]))
+    check_integers(heartbeat[0])
+    return heartbeat
+
+
+#row parsers keyed on the number of columns in a row
+ROW_PARSERS = {
+    1: parse_heartbeat,
+    5: parse_bid,
+    6: parse_user_listing,
+}
+
+
+def parse_instruction(data):
+    """
+    Convert a row of data into its typed record
+        - raises ValueError if the row cannot be classified
+    """
+    try:
+        row_parser = ROW_PARSERS[len(data)]
+    except KeyError:
+        raise ValueError('Unexpected number of columns ({0}) in row'.format(len(data)))
+    return row_parser(data)
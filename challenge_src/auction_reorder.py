@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event time ingestion for nearly ordered input, such as merged live feeds.
+
+The Server expects instructions strictly in timestamp order, a bid
+arriving after an instruction with a later timestamp would be judged
+against listings that have already closed. A ReorderBuffer sits in front
+of Server.process_instruction, holding instructions by timestamp (a heap
+of the distinct timestamps, each with its instructions in arrival order)
+and releasing them in timestamp order once the watermark has reached them:
+
+   watermark = highest timestamp seen - lateness
+
+Instructions are held for up to lateness seconds of event time, so any
+instruction arriving at most lateness behind the latest one is put back
+in order. Instructions with equal timestamps keep their arrival order.
+Listings close as the watermark passes their close time (bids on the
+closing second are accepted until the watermark moves past it), not when
+a single early instruction is seen. An instruction arriving below the
+watermark is too late to be put in order, it is counted and dropped
+rather than settling an auction incorrectly.
+
+At most max_buffered instructions are held, beyond that the earliest
+second held is released and the watermark raised to it (counted as forced), bounding
+memory at the cost of treating more instructions as late.
+
+Buffer occupancy, late and forced counts, the watermark and the wall
+clock time each second of instructions was held (from its first arrival
+to its release) are available as Prometheus lines, rendered with the
+server's metrics when the buffer is set as Metrics.reorder_buffer (see
+auction_metrics).
+
+   python auction_v2.py --filename feed.txt --stream --lateness 5
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import heapq
+import logging
+from time import perf_counter_ns
+from auction_metrics import Histogram
+# -----------------------------------------
+
+
+class ReorderBuffer:
+    """
+    Releases instructions to a server in timestamp order, see module docstring
+        - server: Server the instructions are processed by
+        - lateness: seconds of event time an instruction may arrive behind the latest
+        - max_buffered: instructions held before the earliest are forced out, 0 for no bound
+    """
+    def __init__(self, server, lateness=0, max_buffered=100000):
+        if lateness < 0:
+            raise ValueError('lateness must not be negative')
+        self.server = server
+        self.lateness = lateness
+        self.max_buffered = max_buffered
+        self.logger = logging.getLogger('auctionLogger')
+        #held instructions in arrival order per timestamp, and a heap of those timestamps
+        #(many instructions share each second, so the heap only orders the distinct seconds)
+        self.buckets = {}
+        self.timestamps = []
+        self.held_since = {}
+        self.buffered = 0
+        self.max_timestamp = None
+        self.watermark = None
+        self.released = 0
+        self.late = 0
+        self.forced = 0
+        self.peak_buffered = 0
+        self.hold_latency = Histogram()
+
+    def push(self, instruction):
+        """
+        Accept an instruction, processing every instruction the watermark has reached
+            - returns False if the instruction was too late and dropped
+        """
+        timestamp = instruction.timestamp
+        watermark = self.watermark
+        if watermark is not None and timestamp < watermark:
+            self.late += 1
+            self.logger.warning('Dropped late instruction %s, %d seconds behind the watermark %s',
+                                instruction, watermark - timestamp, watermark)
+            return False
+        bucket = self.buckets.get(timestamp)
+        if bucket is None:
+            self.buckets[timestamp] = [instruction]
+            heapq.heappush(self.timestamps, timestamp)
+            self.held_since[timestamp] = perf_counter_ns()
+        else:
+            bucket.append(instruction)
+        self.buffered += 1
+        if self.buffered > self.peak_buffered:
+            self.peak_buffered = self.buffered
+        if self.max_timestamp is None or timestamp > self.max_timestamp:
+            self.max_timestamp = timestamp
+            self.advance(timestamp - self.lateness)
+        if self.max_buffered and self.buffered > self.max_buffered:
+            self.forced += 1
+            earliest = self.timestamps[0]
+            if self.watermark is None or earliest > self.watermark:
+                self.advance(earliest)
+            else:
+                #the watermark is already at the earliest second, release it as it is
+                self.release(earliest)
+        return True
+
+    def advance(self, watermark):
+        """
+        Raise the watermark, processing the instructions it has reached and
+        closing listings whose close time it has passed
+        """
+        if self.watermark is not None and watermark <= self.watermark:
+            return
+        self.watermark = watermark
+        self.release(watermark)
+        #nothing earlier than the watermark can arrive, bids on the closing second still can
+        self.server.close_due_listings(watermark - 1)
+
+    def release(self, watermark=None):
+        """
+        Process the held instructions with a timestamp up to watermark, every one when None
+            - returns the number processed
+        """
+        timestamps = self.timestamps
+        process_instruction = self.server.process_instruction
+        released = 0
+        while timestamps and (watermark is None or timestamps[0] <= watermark):
+            timestamp = heapq.heappop(timestamps)
+            bucket = self.buckets.pop(timestamp)
+            for instruction in bucket:
+                process_instruction(instruction)
+            self.hold_latency.observe(perf_counter_ns() - self.held_since.pop(timestamp))
+            released += len(bucket)
+        self.buffered -= released
+        self.released += released
+        return released
+
+    def flush(self):
+        """
+        End of input, process every held instruction. Listings are only
+        closed by the instructions themselves, as with ordered input.
+            - returns the number processed
+        """
+        released = self.release()
+        if self.max_timestamp is not None:
+            self.watermark = self.max_timestamp
+        return released
+
+    def process(self, instructions):
+        """
+        Push every instruction of an iterable then flush
+            - returns the number of instructions processed, late ones excluded
+        """
+        push = self.push
+        for instruction in instructions:
+            push(instruction)
+        self.flush()
+        if self.late:
+            self.logger.warning('Dropped %d instructions arriving more than %s seconds late', self.late, self.lateness)
+        return self.released
+
+    def prometheus_lines(self):
+        lines = ['# HELP auction_reorder_buffered Instructions held in the reorder buffer',
+                 '# TYPE auction_reorder_buffered gauge',
+                 'auction_reorder_buffered {0}'.format(self.buffered),
+                 '# HELP auction_reorder_peak_buffered Most instructions held in the reorder buffer at once',
+                 '# TYPE auction_reorder_peak_buffered gauge',
+                 'auction_reorder_peak_buffered {0}'.format(self.peak_buffered),
+                 '# HELP auction_reorder_watermark Event time up to which instructions have been released',
+                 '# TYPE auction_reorder_watermark gauge',
+                 'auction_reorder_watermark {0}'.format(self.watermark if self.watermark is not None else 0),
+                 '# HELP auction_reorder_released_total Instructions released in timestamp order',
+                 '# TYPE auction_reorder_released_total counter',
+                 'auction_reorder_released_total {0}'.format(self.released),
+                 '# HELP auction_reorder_late_total Instructions dropped for arriving below the watermark',
+                 '# TYPE auction_reorder_late_total counter',
+                 'auction_reorder_late_total {0}'.format(self.late),
+                 '# HELP auction_reorder_forced_total Watermark advances forced by a full buffer',
+                 '# TYPE auction_reorder_forced_total counter',
+                 'auction_reorder_forced_total {0}'.format(self.forced),
+                 '# HELP auction_reorder_hold_seconds Wall clock time each second of instructions was held',
+                 '# TYPE auction_reorder_hold_seconds histogram']
+        lines.extend(self.hold_latency.prometheus_lines('auction_reorder_hold_seconds', 'lateness="{0}"'.format(self.lateness)))
+        return lines
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+On disk store of auction results, so closed listings need not stay in memory.
+
+Once a ResultsStore is set as Server.results_store each listing is retired
+as it closes: its result is added to the store and the listing is dropped
+from Server.all_listed_items, leaving only open listings resident.
+
+Results are kept in a sqlite table indexed on item, inserts are committed
+in batches of commit_every (and on flush/close), other connections only
+see committed results. Past results can be queried by item, or from the
+command line:
+
+   python auction_results.py results.db --item toaster_1
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+import sqlite3
+from auction_records import AuctionResult
+# -----------------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    sequence INTEGER NOT NULL,
+    close_time INTEGER,
+    item TEXT NOT NULL,
+    user_id,
+    status TEXT,
+    price_paid TEXT,
+    total_bid_count,
+    highest_bid TEXT,
+    lowest_bid TEXT
+);
+CREATE INDEX IF NOT EXISTS results_item ON results (item, sequence);
+"""
+RESULT_COLUMNS = 'close_time, item, user_id, status, price_paid, total_bid_count, highest_bid, lowest_bid'
+
+
+class ResultsStore:
+    """
+    sqlite store of auction results
+        - path: database file, results already in it are kept
+        - commit_every: results inserted between commits
+    """
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.uncommitted = 0
+
+    def add(self, result, sequence):
+        """
+        Store an auction result
+            - sequence: listing sequence, the order the listing was made in
+        """
+        self.connection.execute(
+            'INSERT INTO results (sequence, {0}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(RESULT_COLUMNS),
+            (sequence,) + tuple(result))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit every stored result
+        """
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def clear(self):
+        """
+        Delete every stored result
+        """
+        self.connection.execute('DELETE FROM results')
+        self.flush()
+
+    def has_item(self, item):
+        """
+        True when a result has been stored for item
+        """
+        return self.connection.execute('SELECT 1 FROM results WHERE item = ? LIMIT 1', (item,)).fetchone() is not None
+
+    def results_for_item(self, item):
+        """
+        Every stored result for item, in the order the listings were made
+        """
+        rows = self.connection.execute(
+            'SELECT {0} FROM results WHERE item = ? ORDER BY sequence, id'.format(RESULT_COLUMNS), (item,))
+        return [AuctionResult._make(row) for row in rows]
+
+    def first_sequence(self, item):
+        """
+        Sequence of the first stored listing of item, or None
+        """
+        return self.connection.execute('SELECT MIN(sequence) FROM results WHERE item = ?', (item,)).fetchone()[0]
+
+    def latest_results(self):
+        """
+        The result of the latest listing of each item, ordered on the first listing of the item
+            - returns a list of (first sequence, result)
+        """
+        rows = self.connection.execute("""
+            SELECT first_sequence, {0} FROM results
+            JOIN (SELECT item AS listed_item, MIN(sequence) AS first_sequence, MAX(sequence) AS latest_sequence
+                  FROM results GROUP BY item)
+            ON item = listed_item AND sequence = latest_sequence
+            ORDER BY first_sequence, id""".format(RESULT_COLUMNS))
+        #the last row inserted wins if a sequence was stored twice for an item
+        latest = {}
+        for row in rows:
+            latest[row[2]] = (row[0], AuctionResult._make(row[1:]))
+        return list(latest.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query stored auction results')
+    parser.add_argument('database', type=str, help='results database file')
+    parser.add_argument('--item', type=str, default='', help='only print the results for this item')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.database)
+    if args.item:
+        results = store.results_for_item(args.item)
+    else:
+        results = [result for _, result in store.latest_results()]
+    for result in results:
+        print('{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}'.format(*result))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+Long running auction service accepting instructions over the network.
+
+Clients connect over TCP (or a unix socket) and send the same pipe
+delimited lines as the input file, one instruction per line:
+
+   timestamp|user_id|SELL|item|reserve_price|close_time
+   timestamp|user_id|BID|item|bid_amount
+   timestamp
+
+A client sending the line SUBSCRIBE is sent every auction result line
+(close_time|item|user_id|status|price_paid|total_bid_count|highest_bid|lowest_bid)
+as each listing closes.
+
+With --index-results closed results are indexed as listings close (see
+auction_index) and a client can query them mid-run, each query is
+answered with the matching result lines followed by END (or a single
+ERROR line). Queries are queued with the instructions, so an answer
+reflects every line queued before it, the client's own lines included:
+
+   TOP n                - the n sold results with the highest price paid
+   UNSOLD user_id       - unsold results of a seller
+   CLOSED start end     - results with a close_time from start to end
+
+UNSOLD and CLOSED cover the latest --index-capacity results.
+
+Lines from every client go through one bounded queue into a single
+processing loop, so instructions are processed in the order they arrive.
+When the queue is full the client handlers stop reading from their sockets,
+pushing the backpressure onto the senders. Each subscriber also has a
+bounded queue, a subscriber which cannot keep up is disconnected rather
+than allowed to hold results in memory.
+
+With --wal every processed instruction is appended to a write ahead log
+(see auction_wal), --recover rebuilds the auction state from that log
+before the service starts accepting connections. With --results-db closed
+listings are retired to a results database (see auction_results) so a long
+running service only keeps open listings in memory. With --metrics-port
+the processing loop is timed and Prometheus metrics are served over HTTP
+(see auction_metrics).
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+import asyncio
+import logging
+from auction_v2 import Server
+# -----------------------------------------
+#the optional features (write ahead log, results database, metrics, result
+#index) are imported in serve when enabled, as in auction_v2.main
+
+SUBSCRIBE = 'SUBSCRIBE'
+#query name: number of integer arguments
+QUERIES = {'TOP': 1, 'UNSOLD': 1, 'CLOSED': 2}
+
+
+class AuctionService:
+    """
+    asyncio front end feeding a Server
+        - server: Server processing the instructions, a new one by default
+        - max_queued_lines: lines buffered before clients are made to wait
+        - max_subscriber_results: results buffered per subscriber before it is dropped
+        - max_line_length: longest line accepted, longer lines close the connection
+        - result_index: ResultIndex attached to the server (see auction_index.ResultIndex.attach) answering
+          queries, None to refuse queries
+    """
+    def __init__(self, server=None, max_queued_lines=10000, max_subscriber_results=1000,
+                 max_line_length=4096, yield_every=1000, result_index=None):
+        self.server = server if server is not None else Server()
+        self.logger = logging.getLogger('auctionLogger')
+        self.max_queued_lines = max_queued_lines
+        self.max_subscriber_results = max_subscriber_results
+        self.max_line_length = max_line_length
+        self.yield_every = yield_every
+        self.instruction_queue = None
+        self.subscribers = {}
+        #writer of every connected client keyed on its handle_client task
+        self.clients = {}
+        self.listener = None
+        self.processor = None
+        self.lines_received = 0
+        self.lines_processed = 0
+        self.server.closed_listing_handlers.append(self.publish_result)
+        self.result_index = result_index
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """
+        Start listening on host/port, or on a unix socket when path is given
+            - returns the address being listened on
+        """
+        self.instruction_queue = asyncio.Queue(self.max_queued_lines)
+        self.processor = asyncio.ensure_future(self.process_lines())
+        if path:
+            self.listener = await asyncio.start_unix_server(self.handle_client, path=path,
+                                                            limit=self.max_line_length)
+        else:
+            self.listener = await asyncio.start_server(self.handle_client, host, port,
+                                                       limit=self.max_line_length)
+        address = self.listener.sockets[0].getsockname()
+        self.logger.info('Auction service listening on %s', address)
+        return address
+
+    async def stop(self):
+        """
+        Stop accepting connections, process every queued line then
+        disconnect the subscribers and any other clients still connected
+        """
+        if self.listener is not None:
+            self.listener.close()
+        await self.instruction_queue.join()
+        self.processor.cancel()
+        for subscription, sender in list(self.subscribers.items()):
+            try:
+                subscription.put_nowait(None)
+            except asyncio.QueueFull:
+                sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+        clients = list(self.clients.items())
+        for handler, writer in clients:
+            writer.close()
+            handler.cancel()
+        await asyncio.gather(*(handler for handler, _ in clients), return_exceptions=True)
+        if self.listener is not None:
+            #from python 3.12 this waits for every connection to close
+            await self.listener.wait_closed()
+        self.logger.info('Auction service stopped after %d lines', self.lines_processed)
+
+    async def handle_client(self, reader, writer):
+        """
+        Read lines from a client, queueing instructions for processing and
+        registering the client for results when it sends SUBSCRIBE
+        """
+        subscription = None
+        handler = asyncio.current_task()
+        self.clients[handler] = writer
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    self.logger.error('Line longer than %d bytes, closing connection', self.max_line_length)
+                    break
+                if not line:
+                    break
+                text = line.decode('utf-8', 'replace').strip()
+                if not text:
+                    continue
+                if text == SUBSCRIBE:
+                    if subscription is None:
+                        subscription = asyncio.Queue(self.max_subscriber_results)
+                        self.subscribers[subscription] = asyncio.ensure_future(
+                            self.send_results(subscription, writer))
+                    continue
+                if text.split(' ', 1)[0] in QUERIES:
+                    #answered by the processing loop once the lines queued before it are processed
+                    answered = asyncio.get_running_loop().create_future()
+                    await self.instruction_queue.put((text, answered))
+                    lines = await answered
+                    writer.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+                    await writer.drain()
+                    continue
+                self.lines_received += 1
+                await self.instruction_queue.put(text)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(handler, None)
+            sender = self.subscribers.get(subscription)
+            if sender is not None:
+                try:
+                    subscription.put_nowait(None)
+                except asyncio.QueueFull:
+                    sender.cancel()
+                await asyncio.gather(sender, return_exceptions=True)
+            else:
+                writer.close()
+
+    def answer_query(self, text):
+        """
+        Result lines answering a query (see QUERIES), ending with END, or a single ERROR line
+        """
+        if self.result_index is None:
+            return ['ERROR results are not indexed, start the service with --index-results']
+        name, *arguments = text.split()
+        try:
+            if len(arguments) != QUERIES[name]:
+                raise ValueError('expecting {0} arguments'.format(QUERIES[name]))
+            arguments = [int(argument) for argument in arguments]
+            if name == 'TOP':
+                results = self.result_index.top_by_price(arguments[0])
+            elif name == 'UNSOLD':
+                results = self.result_index.unsold_by_seller(arguments[0])
+            else:
+                results = self.result_index.closed_between(*arguments)
+        except ValueError as query_error:
+            return ['ERROR invalid query {0!r}: {1}'.format(text, query_error)]
+        return [self.server.format_auction_result(result) for result in results] + ['END']
+
+    async def process_lines(self):
+        """
+        Single processing loop, instructions and queries are handled in the order queued
+        """
+        server = self.server
+        while True:
+            text = await self.instruction_queue.get()
+            if type(text) is tuple:
+                #a query and the future its answer is set on
+                text, answered = text
+                try:
+                    if not answered.done():
+                        answered.set_result(self.answer_query(text))
+                finally:
+                    self.instruction_queue.task_done()
+                continue
+            try:
+                instruction = server.classify_instruction(text.split('|'))
+                if instruction is not None:
+                    server.process_instruction(instruction)
+            except Exception:
+                self.logger.exception('Error processing instruction %s', text)
+            finally:
+                self.instruction_queue.task_done()
+            self.lines_processed += 1
+            if self.lines_processed % self.yield_every == 0:
+                #let the client handlers run while the queue is busy
+                await asyncio.sleep(0)
+
+    def publish_result(self, listing):
+        """
+        closed_listing_handlers callback, queue the result for every subscriber
+        """
+        if not self.subscribers:
+            return
+        line = self.server.format_auction_result(listing.auction_result)
+        for subscription in list(self.subscribers):
+            try:
+                subscription.put_nowait(line)
+            except asyncio.QueueFull:
+                self.logger.error('Subscriber too slow, %d results queued, disconnecting', subscription.qsize())
+                self.subscribers.pop(subscription).cancel()
+
+    async def send_results(self, subscription, writer):
+        """
+        Write queued results to a subscriber until None is queued
+        """
+        try:
+            while True:
+                line = await subscription.get()
+                if line is None:
+                    break
+                writer.write(line.encode('utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.pop(subscription, None)
+            writer.close()
+
+
+async def serve(host='127.0.0.1', port=8765, path=None, wal_path='', wal_sync_interval=0.05,
+                recover=False, results_db='', metrics_port=0, index_results=False, index_capacity=100000,
+                **service_options):
+    """
+    Run the service until cancelled
+        - wal_path: write ahead log every processed instruction is appended to
+        - recover: replay the write ahead log into the server before accepting connections
+        - results_db: retire closed listings to this results database (see auction_results),
+          rebuilt from the write ahead log when recovering
+        - metrics_port: time the processing loop and serve its metrics on this port
+        - index_results: index closed results for TOP, UNSOLD and CLOSED queries, from
+          the recovered results too when recovering
+        - index_capacity: latest results the UNSOLD and CLOSED queries cover, 0 for every result
+    """
+    server = Server()
+    metrics = None
+    if metrics_port:
+        from auction_metrics import Metrics
+        metrics = Metrics(server).instrument()
+        metrics.serve(metrics_port, host=host)
+    if results_db:
+        from auction_results import ResultsStore
+        server.results_store = ResultsStore(results_db)
+    result_index = None
+    if index_results:
+        from auction_index import ResultIndex
+        result_index = ResultIndex(capacity=index_capacity).attach(server)
+    if wal_path:
+        from auction_wal import WriteAheadLog, replay
+        if recover:
+            if server.results_store is not None:
+                #every result is stored again as the log is replayed
+                server.results_store.clear()
+            replayed = replay(wal_path, server)
+            server.logger.info('Recovered %d instructions from %s', replayed, wal_path)
+        server.wal = WriteAheadLog(wal_path, sync_interval=wal_sync_interval)
+    service = AuctionService(server=server, result_index=result_index, **service_options)
+    await service.start(host=host, port=port, path=path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.stop()
+        if server.wal is not None:
+            server.wal.close()
+        if server.results_store is not None:
+            server.results_store.close()
+        if metrics is not None:
+            metrics.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Auction service, accepting instructions over the network')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--unix-socket', type=str, default=None,
+                        help='listen on a unix socket at this path instead of TCP')
+    parser.add_argument('--max-queued-lines', type=int, default=10000,
+                        help='lines buffered before clients are made to wait')
+    parser.add_argument('--max-subscriber-results', type=int, default=1000,
+                        help='results buffered per subscriber before it is disconnected')
+    parser.add_argument('--wal', type=str, default='',
+                        help='append every processed instruction to this write ahead log')
+    parser.add_argument('--wal-sync-interval', type=float, default=0.05,
+                        help='seconds between fsyncs of the write ahead log, default(0.05)')
+    parser.add_argument('--recover', action='store_true',
+                        help='rebuild the auction state from --wal before accepting connections')
+    parser.add_argument('--results-db', type=str, default='',
+                        help='retire closed listings to this results database so only open listings stay in memory')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='time the processing loop and serve Prometheus metrics on this port')
+    parser.add_argument('--index-results', action='store_true',
+                        help='index closed results so clients can query them (TOP n, UNSOLD user_id, CLOSED start end)')
+    parser.add_argument('--index-capacity', type=int, default=100000,
+                        help='latest results the UNSOLD and CLOSED queries cover, 0 for every result, default(100000)')
+    args = parser.parse_args()
+    if args.recover and not args.wal:
+        parser.error('--recover requires --wal')
+    try:
+        asyncio.run(serve(host=args.host, port=args.port, path=args.unix_socket,
+                          max_queued_lines=args.max_queued_lines,
+                          max_subscriber_results=args.max_subscriber_results,
+                          wal_path=args.wal, wal_sync_interval=args.wal_sync_interval, recover=args.recover,
+                          results_db=args.results_db, metrics_port=args.metrics_port,
+                          index_results=args.index_results, index_capacity=args.index_capacity))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
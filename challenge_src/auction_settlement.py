@@ -0,0 +1,542 @@
+# -*- coding: utf-8 -*-
+
+"""
+Vectorised batch settlement of a whole instruction file (needs numpy).
+
+Used for end of day re-settlement, instead of calling process_instruction
+row by row the file is loaded into columnar arrays and settled with
+group by operations over every listing at once:
+
+1. Close position of each listing - the first instruction after the
+   listing whose timestamp passes its close time (heartbeats close on
+   their own second), found by searching the running maximum of the
+   instruction times (a vectorised search of a max segment tree for the
+   listings already past their close time when listed)
+2. Bids are matched to the latest listing of their item before them and
+   counted when the listing is still open and the bid is within the
+   auction time
+3. Valid bids beat the reserve price and the user's own previous valid
+   bids, a running maximum per (listing, user) group
+4. Winner from the top valid bid per listing and second price from the
+   top valid bid of any other user (the reserve when there is none),
+   ties going to the earliest bid
+
+The output is the same list of lines as Server.auction_summary_report.
+
+The file is loaded without a python loop per row: it is memory mapped as
+a numpy byte array and, a block of lines at a time, the line and field
+boundaries are found from the positions of the new lines and pipes, the
+integer and price fields are parsed digit position by digit position
+across every row at once and item codes are dictionary encoded with
+np.unique. Only rows outside the plain form (quotes, carriage returns
+within a line, signs, spaces, unusual prices, more than 18 digits, long
+item codes) are parsed in python through csv.reader and parse_instruction,
+as auction_mmap does, so exactly the same rows are accepted as by the Server.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+import logging
+import os
+import sys
+import time
+from auction_records import UserListing, Bid, Heartbeat, ItemDictionary, format_money
+from auction_mmap import classify_row, csv_rows
+# -----------------------------------------
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#bytes of whole lines parsed at a time
+BLOCK_SIZE = 1 << 25
+#widest integer field parsed vectorised (fits an int64), item codes longer
+#than ITEM_WIDTH bytes are parsed in python
+MAX_DIGITS = 18
+ITEM_WIDTH = 64
+#instruction kinds of the parsed rows
+HEARTBEAT, BID, LISTING = 1, 2, 3
+RECORD_KINDS = {Heartbeat: HEARTBEAT, Bid: BID, UserListing: LISTING}
+NEW_LINE, CARRIAGE_RETURN, PIPE, QUOTE, DOT, ZERO = 10, 13, 124, 34, 46, 48
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required for batch settlement: pip install numpy')
+
+
+class SettlementColumns:
+    """
+    Columnar form of an instruction file
+        - trigger_times: per instruction, the latest close time it closes listings up to
+        - listing_*: one entry per user listing in input order
+        - bid_*: one entry per bid in input order
+        - listing_reserve / bid_amount: amounts in integer minor units (see auction_records)
+        - item_codes: item code of each item id
+    """
+    def __init__(self):
+        self.trigger_times = []
+        self.listing_position = []
+        self.listing_timestamp = []
+        self.listing_item = []
+        self.listing_reserve = []
+        self.listing_close_time = []
+        self.bid_position = []
+        self.bid_timestamp = []
+        self.bid_user_id = []
+        self.bid_item = []
+        self.bid_amount = []
+        self.item_codes = []
+
+    def finalise(self):
+        """
+        Convert the loaded lists into numpy arrays
+        """
+        int64 = np.int64
+        for column in ('trigger_times', 'listing_position', 'listing_timestamp', 'listing_item', 'listing_reserve',
+                       'listing_close_time', 'bid_position', 'bid_timestamp', 'bid_user_id', 'bid_item', 'bid_amount'):
+            setattr(self, column, np.array(getattr(self, column), dtype=int64))
+        return self
+
+
+def load_columns(file_name, block_size=BLOCK_SIZE):
+    """
+    Read an instruction file into SettlementColumns through a memory map,
+    malformed rows are skipped
+        - block_size: bytes of whole lines parsed at a time
+    """
+    require_numpy()
+    columns = SettlementColumns()
+    items = ItemDictionary()
+    columns.item_codes = items.codes
+    blocks = []
+    if os.path.getsize(file_name):
+        data = np.memmap(file_name, dtype=np.uint8, mode='r')
+        size = len(data)
+        position = 0
+        while position < size:
+            end = min(position + block_size, size)
+            if end < size:
+                new_lines = np.flatnonzero(data[position:end] == NEW_LINE)
+                #a line longer than the block runs on to its new line
+                end = position + new_lines[-1] + 1 if len(new_lines) else end
+                while end < size and data[end - 1] != NEW_LINE:
+                    end = min(end + block_size, size)
+                    new_lines = np.flatnonzero(data[position:end] == NEW_LINE)
+                    if len(new_lines):
+                        end = position + new_lines[-1] + 1
+            blocks.append(parse_block(np.asarray(data[position:end]), items))
+            position = end
+        del data
+    if blocks:
+        kinds, timestamps, user_ids, item_ids, amounts, close_times = (np.concatenate(column)
+                                                                        for column in zip(*blocks))
+    else:
+        kinds = timestamps = user_ids = item_ids = amounts = close_times = np.zeros(0, dtype=np.int64)
+
+    positions = np.arange(len(kinds), dtype=np.int64)
+    #bids and listings close auctions ending before their own second
+    columns.trigger_times = np.where(kinds == HEARTBEAT, timestamps, timestamps - 1)
+    bids = kinds == BID
+    columns.bid_position = positions[bids]
+    columns.bid_timestamp = timestamps[bids]
+    columns.bid_user_id = user_ids[bids]
+    columns.bid_item = item_ids[bids]
+    columns.bid_amount = amounts[bids]
+    listings = kinds == LISTING
+    columns.listing_position = positions[listings]
+    columns.listing_timestamp = timestamps[listings]
+    columns.listing_item = item_ids[listings]
+    columns.listing_reserve = amounts[listings]
+    columns.listing_close_time = close_times[listings]
+    return columns.finalise()
+
+
+def parse_block(block, items):
+    """
+    Parse a block of whole lines
+        - block: numpy byte array
+        - items: ItemDictionary the item codes are encoded with
+        - returns (kinds, timestamps, user_ids, item_ids, amounts, close_times)
+          arrays of the instructions in input order
+    """
+    size = len(block)
+    line_ends = np.flatnonzero(block == NEW_LINE)
+    if size and block[-1] != NEW_LINE:
+        line_ends = np.append(line_ends, size)
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1)).astype(np.int64)
+    #a carriage return ending the line is left out, as csv.reader does
+    ends = line_ends - ((line_ends > line_starts) & (block[np.maximum(line_ends - 1, 0)] == CARRIAGE_RETURN))
+    line_count = len(line_starts)
+    empty = np.zeros(0, dtype=np.int64)
+    if not line_count:
+        return (empty,) * 6
+
+    pipes = np.flatnonzero(block == PIPE)
+    first_pipe = np.searchsorted(pipes, line_starts)
+    pipe_count = np.searchsorted(pipes, ends) - first_pipe
+    #quotes, carriage returns and null bytes within a line need csv.reader
+    special = np.flatnonzero((block == QUOTE) | (block == CARRIAGE_RETURN) | (block == 0))
+    plain = np.ones(line_count, dtype=bool)
+    if len(special):
+        line_of = np.searchsorted(line_ends, special)
+        plain[line_of[special < ends[line_of]]] = False
+
+    kinds = np.zeros(line_count, dtype=np.int64)
+    timestamps = np.zeros(line_count, dtype=np.int64)
+    user_ids = np.zeros(line_count, dtype=np.int64)
+    item_ids = np.zeros(line_count, dtype=np.int64)
+    amounts = np.zeros(line_count, dtype=np.int64)
+    close_times = np.zeros(line_count, dtype=np.int64)
+    parsed = np.zeros(line_count, dtype=bool)
+
+    #heartbeats, a single integer field
+    lines = np.flatnonzero(plain & (pipe_count == 0))
+    values, ok = parse_integers(block, line_starts[lines], ends[lines])
+    lines = lines[ok]
+    kinds[lines] = HEARTBEAT
+    timestamps[lines] = values[ok]
+    parsed[lines] = True
+
+    item_lines = []
+    item_bounds = []
+    for kind, column_count, action in ((BID, 5, b'BID'), (LISTING, 6, b'SELL')):
+        lines = np.flatnonzero(plain & (pipe_count == column_count - 1))
+        bounds = [(line_starts[lines], pipes[first_pipe[lines]])]
+        bounds.extend((pipes[first_pipe[lines] + field - 1] + 1, pipes[first_pipe[lines] + field])
+                      for field in range(1, column_count - 1))
+        bounds.append((pipes[first_pipe[lines] + column_count - 2] + 1, ends[lines]))
+        timestamp, ok = parse_integers(block, *bounds[0])
+        user_id, user_ok = parse_integers(block, *bounds[1])
+        amount, amount_ok = parse_prices(block, *bounds[4])
+        ok &= user_ok & amount_ok & matches(block, *bounds[2], action)
+        ok &= bounds[3][1] - bounds[3][0] <= ITEM_WIDTH
+        if kind == LISTING:
+            close_time, close_ok = parse_integers(block, *bounds[5])
+            ok &= close_ok
+            close_times[lines[ok]] = close_time[ok]
+        lines = lines[ok]
+        kinds[lines] = kind
+        timestamps[lines] = timestamp[ok]
+        user_ids[lines] = user_id[ok]
+        amounts[lines] = amount[ok]
+        parsed[lines] = True
+        item_lines.append(lines)
+        item_bounds.append((bounds[3][0][ok], bounds[3][1][ok]))
+
+    #dictionary encode the item codes, each distinct code is decoded once
+    lines = np.concatenate(item_lines)
+    if len(lines):
+        starts = np.concatenate([start for start, _ in item_bounds])
+        lengths = np.concatenate([end for _, end in item_bounds]) - starts
+        width = max(int(lengths.max()), 1)
+        offsets = np.arange(width)
+        inside = offsets < lengths[:, None]
+        codes = np.where(inside, block[np.minimum(starts[:, None] + offsets, size - 1)], 0).astype(np.uint8)
+        unique_codes, inverse = np.unique(codes.view('S{0}'.format(width)).ravel(), return_inverse=True)
+        code_ids = np.array([items.encode(sys.intern(code.decode('utf-8'))) for code in unique_codes.tolist()],
+                            dtype=np.int64)
+        item_ids[lines] = code_ids[inverse.reshape(-1)]
+
+    #every other line is parsed as the Server would, the odd line giving more than one row
+    rows = []
+    for line in np.flatnonzero(~parsed).tolist():
+        for sub_row, data in enumerate(csv_rows(block[line_starts[line]:line_ends[line]].tobytes())):
+            instruction = classify_row(data)
+            if instruction is not None:
+                kind = RECORD_KINDS[type(instruction)]
+                rows.append((line, sub_row, kind, instruction.timestamp,
+                             instruction.user_id if kind != HEARTBEAT else 0,
+                             items.encode(instruction.item) if kind != HEARTBEAT else 0,
+                             instruction.bid_amount if kind == BID else
+                             instruction.reserve_price if kind == LISTING else 0,
+                             instruction.close_time if kind == LISTING else 0))
+    lines = np.flatnonzero(parsed)
+    columns = [kinds[lines], timestamps[lines], user_ids[lines], item_ids[lines], amounts[lines], close_times[lines]]
+    if not rows:
+        return tuple(columns)
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 8)
+    order = np.lexsort((np.concatenate((np.zeros(len(lines), dtype=np.int64), rows[:, 1])),
+                        np.concatenate((lines, rows[:, 0]))))
+    return tuple(np.concatenate((column, rows[:, index]))[order] for index, column in enumerate(columns, 2))
+
+
+def parse_integers(block, starts, ends):
+    """
+    Parse unsigned decimal integer fields of up to MAX_DIGITS digits
+        - returns (values, ok), ok is False for fields which are not plain digits
+    """
+    lengths = ends - starts
+    ok = (lengths > 0) & (lengths <= MAX_DIGITS)
+    values = np.zeros(len(starts), dtype=np.int64)
+    last = len(block) - 1
+    for offset in range(int(lengths.max(initial=0)) if len(lengths) else 0):
+        if offset >= MAX_DIGITS:
+            break
+        inside = offset < lengths
+        digits = block[np.minimum(starts + offset, last)].astype(np.int64) - ZERO
+        ok &= ~inside | ((digits >= 0) & (digits <= 9))
+        values = np.where(inside, values * 10 + digits, values)
+    return values, ok
+
+
+def parse_prices(block, starts, ends):
+    """
+    Parse price fields of the usual forms (12, 12.5, 12.50) into minor units
+        - returns (amounts, ok), ok is False for any other form (see parse_money)
+    """
+    last = len(block) - 1
+    lengths = ends - starts
+    #the decimal point, if any, is one or two places from the end
+    two_places = (lengths >= 4) & (block[np.clip(ends - 3, 0, last)] == DOT)
+    one_place = ~two_places & (lengths >= 3) & (block[np.clip(ends - 2, 0, last)] == DOT)
+    whole_ends = np.where(two_places, ends - 3, np.where(one_place, ends - 2, ends))
+    whole, ok = parse_integers(block, starts, whole_ends)
+    fraction, fraction_ok = parse_integers(block, whole_ends + 1, np.where(two_places | one_place, ends, whole_ends + 2))
+    fraction = np.where(two_places, fraction, np.where(one_place, fraction * 10, 0))
+    ok &= lengths - (ends - whole_ends) <= MAX_DIGITS - 3
+    ok &= ~(two_places | one_place) | fraction_ok
+    return whole * 100 + fraction, ok
+
+
+def matches(block, starts, ends, text):
+    """
+    True for the fields equal to the bytes text
+    """
+    ok = ends - starts == len(text)
+    last = len(block) - 1
+    for offset, byte in enumerate(text):
+        ok &= block[np.minimum(starts + offset, last)] == byte
+    return ok
+
+
+def close_positions(columns):
+    """
+    Position of the instruction which closes each listing, or the number
+    of instructions when the listing never closes
+    """
+    trigger_times = columns.trigger_times
+    instruction_count = len(trigger_times)
+    if not instruction_count:
+        return np.zeros(0, dtype=np.int64)
+    running_max = np.maximum.accumulate(trigger_times)
+    positions = np.searchsorted(running_max, columns.listing_close_time, side='left')
+    #listings already past their close time when listed close on the next instruction that passes it
+    late = np.flatnonzero(positions <= columns.listing_position)
+    if len(late):
+        positions[late] = first_at_least(trigger_times, columns.listing_position[late] + 1,
+                                         columns.listing_close_time[late])
+    return positions
+
+
+def first_at_least(values, starts, limits):
+    """
+    For each (start, limit) the first index from start on with a value of at
+    least limit, or len(values), found by descending a max segment tree of
+    values for every query at once (O(log n) vectorised steps)
+    """
+    count = len(values)
+    leaves = 1
+    while leaves < count:
+        leaves *= 2
+    tree = np.full(2 * leaves, np.iinfo(np.int64).min, dtype=np.int64)
+    tree[leaves:leaves + count] = values
+    level = leaves
+    while level > 1:
+        tree[level // 2:level] = np.maximum(tree[level:2 * level:2], tree[level + 1:2 * level:2])
+        level //= 2
+
+    found = np.full(len(starts), count, dtype=np.int64)
+    queries = np.flatnonzero(starts < count)
+    nodes = starts[queries] + leaves
+    query_limits = limits[queries]
+    #climb: move right to the next subtree until one holds a value of at least the limit
+    while len(queries):
+        hit = tree[nodes] >= query_limits
+        if hit.all():
+            break
+        missed = ~hit
+        following = nodes[missed] + 1
+        #climb while a right child, then step to the next sibling
+        following //= following & -following
+        exhausted = following == 1
+        nodes[missed] = following
+        keep = np.ones(len(queries), dtype=bool)
+        keep[np.flatnonzero(missed)[exhausted]] = False
+        queries, nodes, query_limits = queries[keep], nodes[keep], query_limits[keep]
+    #descend to the leftmost leaf holding a value of at least the limit
+    while len(nodes) and (nodes < leaves).any():
+        inner = nodes < leaves
+        left = 2 * nodes[inner]
+        nodes[inner] = left + (tree[left] < query_limits[inner])
+    found[queries] = nodes - leaves
+    return found
+
+
+def group_starts(sorted_keys):
+    """
+    Index of the first element of each run of equal keys
+    """
+    if not len(sorted_keys):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1))
+
+
+def settle(columns):
+    """
+    Settle every listing
+        - returns a dictionary of per listing arrays
+    """
+    listing_count = len(columns.listing_position)
+    closed_at = close_positions(columns)
+
+    #match each bid to the latest listing of its item listed before it
+    stride = max(len(columns.trigger_times), 1) + 1
+    listing_keys = columns.listing_item * stride + columns.listing_position
+    listing_order = np.argsort(listing_keys, kind='stable')
+    match = np.searchsorted(listing_keys[listing_order], columns.bid_item * stride + columns.bid_position) - 1
+    if listing_count:
+        has_listing = match >= 0
+        bid_listing = listing_order[np.where(has_listing, match, 0)]
+        has_listing &= columns.listing_item[bid_listing] == columns.bid_item
+        #bids counted by the listing: still open and within the auction time
+        counted = (has_listing
+                   & (closed_at[bid_listing] > columns.bid_position)
+                   & (columns.listing_timestamp[bid_listing] <= columns.bid_timestamp)
+                   & (columns.bid_timestamp <= columns.listing_close_time[bid_listing]))
+    else:
+        bid_listing = np.zeros(len(match), dtype=np.int64)
+        counted = np.zeros(len(match), dtype=bool)
+    counted_index = np.flatnonzero(counted)
+    counted_listing = bid_listing[counted_index]
+    counted_amount = columns.bid_amount[counted_index]
+
+    bid_count = np.bincount(counted_listing, minlength=listing_count)
+    lowest_bid = np.full(listing_count, -1, dtype=np.int64)
+    highest_bid = np.full(listing_count, -1, dtype=np.int64)
+    #earliest bid of the lowest and of the highest amount, positions are already ascending
+    order = np.lexsort((counted_amount, counted_listing))
+    starts = group_starts(counted_listing[order])
+    lowest_bid[counted_listing[order][starts]] = counted_index[order][starts]
+    order = np.lexsort((-counted_amount, counted_listing))
+    starts = group_starts(counted_listing[order])
+    highest_bid[counted_listing[order][starts]] = counted_index[order][starts]
+
+    #valid bids beat the reserve and the user's own running best on the listing
+    eligible = counted_amount > columns.listing_reserve[counted_listing]
+    eligible_index = counted_index[eligible]
+    eligible_listing = counted_listing[eligible]
+    eligible_amount = counted_amount[eligible]
+    order = np.lexsort((columns.bid_user_id[eligible_index], eligible_listing))
+    group_keys = np.stack((eligible_listing[order], columns.bid_user_id[eligible_index][order]))
+    is_start = np.ones(len(order), dtype=bool)
+    if len(order):
+        is_start[1:] = np.any(group_keys[:, 1:] != group_keys[:, :-1], axis=0)
+    group = np.cumsum(is_start) - 1
+    amounts = eligible_amount[order]
+    if len(amounts):
+        #rank the amounts so offsetting each group cannot overflow
+        ranks = np.unique(amounts, return_inverse=True)[1].reshape(-1)
+        shifted = ranks + group * (ranks.max() + 1)
+        previous_best = np.maximum.accumulate(shifted)
+        beats_previous = np.ones(len(order), dtype=bool)
+        beats_previous[1:] = shifted[1:] > previous_best[:-1]
+        valid_sorted = is_start | beats_previous
+    else:
+        valid_sorted = np.zeros(0, dtype=bool)
+    valid_index = np.sort(eligible_index[order][valid_sorted])
+    valid_listing = bid_listing[valid_index]
+    valid_amount = columns.bid_amount[valid_index]
+
+    valid_count = np.bincount(valid_listing, minlength=listing_count)
+    winning_bid = np.full(listing_count, -1, dtype=np.int64)
+    runner_up_bid = np.full(listing_count, -1, dtype=np.int64)
+    order = np.lexsort((-valid_amount, valid_listing))
+    starts = group_starts(valid_listing[order])
+    winning_bid[valid_listing[order][starts]] = valid_index[order][starts]
+    #runner up is the top valid bid of any user other than the winner
+    other_user = columns.bid_user_id[valid_index] != columns.bid_user_id[winning_bid[valid_listing]]
+    other_index = valid_index[other_user]
+    other_listing = valid_listing[other_user]
+    order = np.lexsort((-columns.bid_amount[other_index], other_listing))
+    starts = group_starts(other_listing[order])
+    runner_up_bid[other_listing[order][starts]] = other_index[order][starts]
+
+    return {
+        'closed': closed_at < len(columns.trigger_times),
+        'bid_count': bid_count,
+        'valid_count': valid_count,
+        'lowest_bid': lowest_bid,
+        'highest_bid': highest_bid,
+        'winning_bid': winning_bid,
+        'runner_up_bid': runner_up_bid,
+    }
+
+
+def summary_report(columns, settlement):
+    """
+    Format the settlement as Server.auction_summary_report does, one line per
+    item (the latest listing of the item) in the order items were first listed
+    """
+    latest_listing = {}
+    for listing, item_id in enumerate(columns.listing_item.tolist()):
+        latest_listing[item_id] = listing
+
+    bid_amounts = columns.bid_amount
+    bid_users = columns.bid_user_id
+    report = []
+    for item_id, listing in latest_listing.items():
+        bid_count = int(settlement['bid_count'][listing])
+        valid_count = int(settlement['valid_count'][listing])
+        winner = settlement['winning_bid'][listing]
+        user_id = int(bid_users[winner]) if winner >= 0 else ''
+        if settlement['closed'][listing]:
+            status = 'SOLD' if valid_count else 'UNSOLD'
+            runner_up = settlement['runner_up_bid'][listing]
+            if runner_up >= 0:
+                price_paid = format_money(int(bid_amounts[runner_up]))
+            elif valid_count:
+                price_paid = format_money(int(columns.listing_reserve[listing]))
+            else:
+                price_paid = format_money(0)
+            highest = format_money(int(bid_amounts[settlement['highest_bid'][listing]]) if bid_count else 0)
+            lowest = format_money(int(bid_amounts[settlement['lowest_bid'][listing]]) if bid_count else 0)
+        else:
+            status, price_paid, highest, lowest = 'UNSOLD', '', '', ''
+        report.append('{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}'.format(
+            int(columns.listing_close_time[listing]), columns.item_codes[item_id], user_id,
+            status, price_paid, bid_count, highest, lowest))
+    return report
+
+
+def settle_file(file_name):
+    """
+    Load and settle an instruction file
+        - returns the summary report lines
+    """
+    columns = load_columns(file_name)
+    return summary_report(columns, settle(columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vectorised batch settlement of an instruction file')
+    parser.add_argument('--filename', type=str, default='input.txt',
+                        help='name of the file to settle, default(input.txt)')
+    args = parser.parse_args()
+    logger = logging.getLogger('auctionLogger')
+
+    started = time.perf_counter()
+    columns = load_columns(args.filename)
+    loaded = time.perf_counter()
+    settlement = settle(columns)
+    settled = time.perf_counter()
+    for line in summary_report(columns, settlement):
+        sys.stdout.write(line + '\n')
+    rows = len(columns.trigger_times)
+    logger.info('Loaded %d instructions in %.3fs, settled in %.3fs (%.0f rows/sec)', rows, loaded - started,
+                settled - loaded, rows / (settled - loaded) if settled > loaded else 0.0)
+
+
+if __name__ == '__main__':
+    main()
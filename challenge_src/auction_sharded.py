@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run an instruction file across a pool of worker processes.
+
+Listings are independent of each other, so the instruction stream is
+hash partitioned by item across the workers (one Server per shard).
+Every instruction moves the auction clock on, closing the listings whose
+close time it has passed, so heartbeats are broadcast to every shard and
+the other shards are sent a clock advance for each bid or listing with a
+later timestamp than they have seen. Rows are parsed once here to route
+them, malformed rows are sent to the first shard where they are rejected
+(and logged) as usual.
+
+Each shard returns its closed auctions tagged with (close_time, input position
+of the listing), the shards are then merged on that key which gives the same
+order as a single process streaming run.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+from array import array
+import csv
+import heapq
+import multiprocessing
+import queue
+import sys
+from auction_v2 import Server
+from auction_records import UserListing, Heartbeat, parse_instruction
+# -----------------------------------------
+
+BATCH_SIZE = 5000
+QUEUED_BATCHES = 8
+#workers are spawned rather than forked, a fork can copy a lock held by
+#another thread (such as the log queue listener) and deadlock the worker
+PROCESS_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def run_shard(shard_queue, result_queue, keep_bid_history=False):
+    """
+    Worker process, runs every batch of (positions, lines) sent for this
+    shard through its own Server until a None batch is received, a negative
+    position is a clock advance, its line the time to close listings up to.
+    Puts a sorted list of (close_time, listing position, result line) on result_queue
+    """
+    server = Server(keep_bid_history=keep_bid_history)
+    closed_auctions = []
+    server.closed_listing_handlers.append(lambda listing: closed_auctions.append(
+        (listing.auction_result.close_time, listing.sequence, server.format_auction_result(listing.auction_result))))
+
+    batch = shard_queue.get()
+    while batch is not None:
+        positions, lines = batch
+        for position, row in zip(positions, csv.reader(lines, delimiter='|')):
+            if position < 0:
+                server.close_due_listings(int(row[0]))
+                continue
+            instruction = server.classify_instruction(row)
+            if instruction is None:
+                continue
+            if isinstance(instruction, UserListing):
+                #order listings by their position in the whole input, not within this shard
+                server.listing_sequence = position - 1
+            server.process_instruction(instruction)
+        batch = shard_queue.get()
+    closed_auctions.sort()
+    result_queue.put(closed_auctions)
+
+
+def shard_for_line(line, shards):
+    """
+    Route a row, parsed as the shards' csv.reader parses it
+        - returns (shard, timestamp), shard is None for heartbeats which go to
+          every shard, timestamp is None for malformed rows (sent to shard 0)
+    """
+    if '"' in line or '\r' in line:
+        row = next(csv.reader([line], delimiter='|'), [])
+    else:
+        row = line.rstrip('\n').split('|')
+    try:
+        instruction = parse_instruction(row)
+    except ValueError:
+        return 0, None
+    if type(instruction) is Heartbeat:
+        return None, instruction.timestamp
+    return hash(instruction.item) % shards, instruction.timestamp
+
+
+def put_batch(shard_queue, batch, worker):
+    """
+    Put a batch on a bounded shard queue, raising rather than blocking
+    forever if the worker for that shard has died
+    """
+    while True:
+        try:
+            shard_queue.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if not worker.is_alive():
+                raise Exception('Auction shard exited with code {0}'.format(worker.exitcode))
+
+
+def run_sharded(file_name, shards=None, output=None, keep_bid_history=False, batch_size=BATCH_SIZE):
+    """
+    Process file_name across shards worker processes
+        - output: file like object the merged closed auction lines are written to
+        - returns the merged list of closed auction lines
+    """
+    shards = shards or multiprocessing.cpu_count()
+    shard_queues = [PROCESS_CONTEXT.Queue(QUEUED_BATCHES) for _ in range(shards)]
+    result_queue = PROCESS_CONTEXT.Queue()
+    workers = [PROCESS_CONTEXT.Process(target=run_shard, args=(shard_queue, result_queue, keep_bid_history))
+               for shard_queue in shard_queues]
+    for worker in workers:
+        worker.start()
+
+    def new_batch():
+        return array('q'), []
+
+    try:
+        batches = [new_batch() for _ in range(shards)]
+
+        def add_line(target, position, line):
+            positions, lines = batches[target]
+            positions.append(position)
+            lines.append(line)
+            if len(lines) >= batch_size:
+                put_batch(shard_queues[target], batches[target], workers[target])
+                batches[target] = new_batch()
+
+        #time each shard has closed its listings up to, as far as the rows sent to it go
+        closed_through = [None] * shards
+        with open(file_name, newline='') as instruction_file:
+            for position, line in enumerate(instruction_file, 1):
+                shard, timestamp = shard_for_line(line, shards)
+                if shard is None:
+                    for target in range(shards):
+                        add_line(target, position, line)
+                        if closed_through[target] is None or timestamp > closed_through[target]:
+                            closed_through[target] = timestamp
+                    continue
+                add_line(shard, position, line)
+                if timestamp is None:
+                    continue
+                #bids and listings close what is due before their own second, on every shard
+                close_time = timestamp - 1
+                clock_line = None
+                for target in range(shards):
+                    if closed_through[target] is None or close_time > closed_through[target]:
+                        closed_through[target] = close_time
+                        if target != shard:
+                            clock_line = clock_line or '{0}\n'.format(close_time)
+                            add_line(target, -1, clock_line)
+        for shard_queue, batch, worker in zip(shard_queues, batches, workers):
+            if batch[1]:
+                put_batch(shard_queue, batch, worker)
+    finally:
+        for shard_queue, worker in zip(shard_queues, workers):
+            if worker.is_alive():
+                put_batch(shard_queue, None, worker)
+
+    shard_results = [result_queue.get() for worker in workers]
+    for worker in workers:
+        worker.join()
+    failed = [worker.exitcode for worker in workers if worker.exitcode]
+    if failed:
+        raise Exception('{0} auction shard(s) failed, exit codes {1}'.format(len(failed), failed))
+
+    closed_auction_lines = [line for _, _, line in heapq.merge(*shard_results)]
+    if output is not None:
+        for line in closed_auction_lines:
+            output.write(line + '\n')
+    return closed_auction_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Auction program, processing an instruction file across worker processes')
+    parser.add_argument('--filename', type=str, default='input.txt',
+                        help='name of the file to process, default(input.txt)')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='number of worker processes, default(number of cpus)')
+    parser.add_argument('--keep-bid-history', action='store_true',
+                        help='retain every bid on each listing rather than running statistics only')
+    args = parser.parse_args()
+    run_sharded(args.filename, shards=args.shards or None, output=sys.stdout,
+                keep_bid_history=args.keep_bid_history)
+
+
+if __name__ == '__main__':
+    main()
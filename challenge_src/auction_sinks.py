@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+Buffered result sinks, auction results are encoded as they arrive and
+written to the target in large chunks rather than a write per line.
+
+Formats (each encodes an AuctionResult, see auction_records, into bytes):
+
+   - pipe: the output syntax of the spec, one line per result
+     close_time|item|user_id|status|price_paid|total_bid_count|highest_bid|lowest_bid
+   - jsonl: one JSON object per line, keyed on the AuctionResult fields,
+     amounts are kept as their two decimal place strings
+   - binary: length prefixed records for downstream consumers, a little
+     endian uint32 length of the rest of the record, then
+     close_time (int64), user_id (int64, 0 when there is none), status
+     (uint8 flags, STATUS_SOLD when SOLD, STATUS_USER when user_id holds the
+     winning user, so any user id can be written), price_paid,
+     highest_bid, lowest_bid (int64 minor units),
+     total_bid_count (uint32) and the utf-8 item code filling the rest,
+     read back by read_binary_results (listings still open when written
+     carry zero amounts). Closed listings are encoded straight from their
+     minor unit amounts (encode_binary_listing), results which only exist
+     as an AuctionResult (e.g. retired to the results store) have their
+     amounts converted back
+
+Targets are stdout (or any stream), a file, or a rotating set of files.
+A sink writes its buffer when it holds buffer_size bytes, and optionally
+every flush_every results and/or once the oldest buffered result is
+flush_interval seconds old (checked from a background thread, so results
+are written even while no more arrive), and always on flush() and close():
+
+   sink = ResultSink(FileTarget('results.bin'), 'binary', flush_every=1000)
+   server.closed_listing_handlers.append(sink.add_listing)
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from auction_records import AuctionResult, format_money, parse_money
+# -----------------------------------------
+
+BUFFER_SIZE = 1 << 20
+SOLD = 'SOLD'
+UNSOLD = 'UNSOLD'
+#length prefix, then the fixed fields of a binary result record, the item code follows
+LENGTH_PREFIX = struct.Struct('<I')
+BINARY_RESULT = struct.Struct('<qqBqqqI')
+#flags of the status byte of a binary result record
+STATUS_SOLD = 1
+STATUS_USER = 2
+
+
+def encode_pipe(result):
+    #close_time|item|user_id|status|price_paid|total_bid_count|highest_bid|lowest_bid
+    return '{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}\n'.format(*result).encode('utf-8')
+
+
+def encode_jsonl(result):
+    return (json.dumps(result._asdict(), separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def encode_binary(result):
+    """
+    Length prefixed binary record of a result, amounts are converted back
+    into minor units so no precision is lost
+    """
+    item = result.item.encode('utf-8')
+    has_user = result.user_id != ''
+    record = BINARY_RESULT.pack(result.close_time,
+                                result.user_id if has_user else 0,
+                                (STATUS_SOLD if result.status == SOLD else 0) | (STATUS_USER if has_user else 0),
+                                parse_money(result.price_paid) if result.price_paid != '' else 0,
+                                parse_money(result.highest_bid) if result.highest_bid != '' else 0,
+                                parse_money(result.lowest_bid) if result.lowest_bid != '' else 0,
+                                result.total_bid_count)
+    return LENGTH_PREFIX.pack(len(record) + len(item)) + record + item
+
+
+def encode_binary_listing(listing):
+    """
+    Length prefixed binary record of a closed listing, from its minor unit amounts
+    """
+    item = listing.item_name.encode('utf-8')
+    winning_bid = listing.winning_bid
+    record = BINARY_RESULT.pack(listing.item_data.close_time,
+                                winning_bid.user_id if winning_bid is not None else 0,
+                                (STATUS_SOLD if listing.sale_status == SOLD else 0) |
+                                (STATUS_USER if winning_bid is not None else 0),
+                                listing.price_paid or 0, listing.highest_bid or 0, listing.lowest_bid or 0,
+                                listing.bid_count)
+    return LENGTH_PREFIX.pack(len(record) + len(item)) + record + item
+
+
+FORMATS = {'pipe': encode_pipe, 'jsonl': encode_jsonl, 'binary': encode_binary}
+#formats encoding a closed listing directly rather than its auction_result
+LISTING_FORMATS = {'binary': encode_binary_listing}
+
+
+def read_binary_results(binary_file):
+    """
+    Generator reading the records written in the binary format
+        - binary_file: file opened in binary mode
+        - yields AuctionResult, amounts formatted as in the pipe format
+        - raises ValueError if the file ends part way through a record
+    """
+    while True:
+        prefix = binary_file.read(LENGTH_PREFIX.size)
+        if not prefix:
+            return
+        if len(prefix) < LENGTH_PREFIX.size:
+            raise ValueError('Truncated binary result length')
+        length, = LENGTH_PREFIX.unpack(prefix)
+        record = binary_file.read(length)
+        if len(record) < length or length < BINARY_RESULT.size:
+            raise ValueError('Truncated binary result record')
+        close_time, user_id, status, price_paid, highest_bid, lowest_bid, total_bid_count = \
+            BINARY_RESULT.unpack_from(record)
+        yield AuctionResult(close_time=close_time, item=record[BINARY_RESULT.size:].decode('utf-8'),
+                            user_id=user_id if status & STATUS_USER else '',
+                            status=SOLD if status & STATUS_SOLD else UNSOLD,
+                            price_paid=format_money(price_paid), total_bid_count=total_bid_count,
+                            highest_bid=format_money(highest_bid), lowest_bid=format_money(lowest_bid))
+
+
+class StreamTarget:
+    """
+    Writes to an open stream such as sys.stdout, through its binary buffer
+    when it has one, the stream is flushed but not closed
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.binary = getattr(stream, 'buffer', None)
+
+    def write_records(self, records):
+        data = b''.join(records)
+        if self.binary is not None:
+            #anything already written through the text layer goes first
+            self.stream.flush()
+            self.binary.write(data)
+        else:
+            self.stream.write(data.decode('utf-8'))
+
+    def flush(self):
+        (self.binary or self.stream).flush()
+
+    def close(self):
+        self.flush()
+
+
+class FileTarget:
+    """
+    Writes to a file, the sink does the buffering so the file is unbuffered
+    """
+    def __init__(self, file_name, mode='wb'):
+        self.file_name = file_name
+        self.output = open(file_name, mode, buffering=0)
+
+    def write_records(self, records):
+        self.output.write(b''.join(records))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.output.close()
+
+
+class RotatingFileTarget:
+    """
+    Writes to a file which is rotated once it would grow beyond max_bytes,
+    as logging's RotatingFileHandler does: file_name.1 is the most recent
+    full file, up to backup_count of them are kept. Records are never split
+    across files, a file only exceeds max_bytes if one record does.
+    """
+    def __init__(self, file_name, max_bytes, backup_count=5):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.output = open(file_name, 'wb', buffering=0)
+        self.size = 0
+
+    def write_records(self, records):
+        pending = []
+        pending_size = self.size
+        for record in records:
+            if pending_size and pending_size + len(record) > self.max_bytes:
+                self.output.write(b''.join(pending))
+                self.rotate()
+                pending = []
+                pending_size = 0
+            pending.append(record)
+            pending_size += len(record)
+        self.output.write(b''.join(pending))
+        self.size = pending_size
+
+    def rotate(self):
+        self.output.close()
+        if self.backup_count > 0:
+            for number in range(self.backup_count - 1, 0, -1):
+                source = '{0}.{1}'.format(self.file_name, number)
+                if os.path.exists(source):
+                    os.replace(source, '{0}.{1}'.format(self.file_name, number + 1))
+            os.replace(self.file_name, self.file_name + '.1')
+        self.output = open(self.file_name, 'wb', buffering=0)
+        self.size = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.output.close()
+
+
+class ResultSink:
+    """
+    Encodes auction results into a buffer written to the target in chunks
+        - target: StreamTarget, FileTarget or RotatingFileTarget
+        - output_format: pipe, jsonl or binary (see FORMATS)
+        - buffer_size: bytes buffered before they are written
+        - flush_every: also write after this many results, 0 to only write a full buffer
+        - flush_interval: also write once the oldest buffered result is this many seconds old, 0 for never
+    Results may be added from one thread while the interval is checked from another.
+    """
+    def __init__(self, target, output_format='pipe', buffer_size=BUFFER_SIZE, flush_every=0, flush_interval=0):
+        if output_format not in FORMATS:
+            raise ValueError('Unknown output format {0}, expecting one of {1}'.format(
+                output_format, ', '.join(FORMATS)))
+        self.target = target
+        self.output_format = output_format
+        self.encode = FORMATS[output_format]
+        self.encode_listing = LISTING_FORMATS.get(output_format)
+        self.buffer_size = buffer_size
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.records = []
+        self.buffered = 0
+        self.first_buffered_at = 0
+        self.results_written = 0
+        #held while the buffer changes, the interval thread flushes it too
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.flusher_thread = None
+        if flush_interval:
+            self.flusher_thread = threading.Thread(target=self.flush_periodically, name='auction-sink-flush',
+                                                   daemon=True)
+            self.flusher_thread.start()
+
+    def add(self, result):
+        """
+        Buffer an AuctionResult, writing the buffer if it is due
+        """
+        self.add_record(self.encode(result))
+
+    def add_listing(self, listing):
+        """
+        Closed listing handler (see Server.closed_listing_handlers)
+        """
+        if self.encode_listing is not None:
+            self.add_record(self.encode_listing(listing))
+        else:
+            self.add_record(self.encode(listing.auction_result))
+
+    def add_record(self, record):
+        with self.lock:
+            records = self.records
+            if not records and self.flush_interval:
+                self.first_buffered_at = time.monotonic()
+            records.append(record)
+            self.buffered += len(record)
+            if self.buffered >= self.buffer_size or (self.flush_every and len(records) >= self.flush_every):
+                self.flush()
+
+    def flush_periodically(self):
+        """
+        Write the buffer once its oldest result is flush_interval seconds old, until close
+        """
+        wait = self.flush_interval
+        while not self.stopping.wait(wait):
+            with self.lock:
+                wait = self.flush_interval
+                if self.records:
+                    age = time.monotonic() - self.first_buffered_at
+                    if age >= self.flush_interval:
+                        self.flush()
+                    else:
+                        wait -= age
+
+    def add_all(self, results):
+        for result in results:
+            self.add(result)
+
+    def flush(self):
+        """
+        Write everything buffered to the target
+        """
+        with self.lock:
+            if self.records:
+                self.target.write_records(self.records)
+                self.results_written += len(self.records)
+                self.records = []
+                self.buffered = 0
+            self.target.flush()
+
+    def close(self):
+        self.stopping.set()
+        if self.flusher_thread is not None:
+            self.flusher_thread.join()
+            self.flusher_thread = None
+        self.flush()
+        self.target.close()
+
+
+def open_sink(output='', output_format='pipe', rotate_bytes=0, rotate_count=5, stream=None, **sink_options):
+    """
+    Sink writing to the file output, rotated every rotate_bytes when set, or
+    to stream (sys.stdout by default) when output is empty
+        - sink_options: buffer_size, flush_every, flush_interval (see ResultSink)
+    """
+    if output:
+        target = RotatingFileTarget(output, rotate_bytes, rotate_count) if rotate_bytes else FileTarget(output)
+    else:
+        target = StreamTarget(stream if stream is not None else sys.stdout)
+    return ResultSink(target, output_format, **sink_options)
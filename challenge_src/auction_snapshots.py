@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+Live, read only snapshots of the open auctions in shared memory (needs
+python 3.8+ for multiprocessing.shared_memory).
+
+A SnapshotPublisher copies the stats of every open listing of a Server
+into a fixed layout table in a named shared memory block, every interval
+seconds from a background thread (or whenever publish is called), so the
+bid path itself never writes to it or takes a lock. Readers in other
+processes attach to the block by name and unpack the table in place.
+
+Layout, all little endian:
+
+   header - magic (8s), version (uint32), capacity (uint32),
+            sequence (uint64), event_time (int64, the server's clock,
+            0 before the first instruction), published_at (float64, unix
+            time), open_count (uint32, listings open), row_count (uint32,
+            rows published, at most capacity)
+   rows   - capacity slots of item_id (uint32), item (32s, utf-8, null
+            padded and truncated to 32 bytes), seller (int64), close_time
+            (int64), highest_bid, leading_bid (int64 minor units, 0 before
+            any bid) and bid_count, valid_bid_count (uint32)
+
+When more listings are open than there are slots, those closing soonest
+are published.
+
+Consistency is a seqlock: the publisher makes sequence odd, writes the
+table, then makes it even again. A reader reads sequence, unpacks the
+table and reads sequence again, retrying if it was odd or changed, so a
+snapshot is never torn and the publisher never waits for readers.
+
+   python auction_v2.py --stream --snapshot-name auctions --snapshot-interval 0.5
+   python auction_snapshots.py auctions --watch 1
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+from collections import namedtuple as data_structure
+import heapq
+import logging
+from operator import attrgetter
+import struct
+import threading
+import time
+from auction_records import format_money
+# -----------------------------------------
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+MAGIC = b'AUCSNAP1'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQqdII')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = 16
+ROW = struct.Struct('<I32sqqqqII')
+ITEM_BYTES = 32
+READ_RETRIES = 1000
+#blocks created by publishers in this process, see attach
+created_names = set()
+
+OpenAuction = data_structure('open_auction', 'item item_id seller close_time time_to_close highest_bid leading_bid '
+                                             'bid_count valid_bid_count')
+Snapshot = data_structure('snapshot', 'sequence event_time published_at open_count auctions')
+
+
+def require_shared_memory():
+    if shared_memory is None:
+        raise ImportError('multiprocessing.shared_memory is required for auction snapshots (python 3.8+)')
+
+
+def attach(name):
+    """
+    Attach to an existing shared memory block without the resource tracker
+    unlinking it when this process exits, the publisher owns the block
+    """
+    require_shared_memory()
+    block = shared_memory.SharedMemory(name=name)
+    if name not in created_names:
+        try:
+            resource_tracker.unregister(block._name, 'shared_memory')
+        except Exception:
+            pass
+    return block
+
+
+class SnapshotPublisher:
+    """
+    Publishes the open listings of a server to shared memory
+        - server: Server being published
+        - name: name of the shared memory block, generated when empty
+        - capacity: rows in the table
+    """
+    def __init__(self, server, name=None, capacity=10000):
+        require_shared_memory()
+        self.server = server
+        self.capacity = capacity
+        self.logger = logging.getLogger('auctionLogger')
+        self.block = shared_memory.SharedMemory(name=name or None, create=True,
+                                                size=HEADER.size + capacity * ROW.size)
+        self.name = self.block.name
+        created_names.add(self.name)
+        self.sequence = 0
+        self.snapshots_published = 0
+        self.publish_lock = threading.Lock()
+        self.publisher_thread = None
+        self.stopping = threading.Event()
+        HEADER.pack_into(self.block.buf, 0, MAGIC, VERSION, capacity, 0, 0, 0.0, 0, 0)
+        self.logger.info('Publishing auction snapshots to shared memory %s (%d rows)', self.name, capacity)
+
+    def publish(self):
+        """
+        Write the current open listings into the table
+            - returns the number of rows published
+        """
+        server = self.server
+        #copied in one step so the processing thread can keep adding listings
+        listings = list(server.open_listings.values())
+        open_count = len(listings)
+        if open_count > self.capacity:
+            listings = heapq.nsmallest(self.capacity, listings, key=attrgetter('item_data.close_time'))
+        buffer = self.block.buf
+        pack_row = ROW.pack_into
+        with self.publish_lock:
+            sequence = self.sequence + 1
+            SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, sequence)
+            offset = HEADER.size
+            for listing in listings:
+                item_data = listing.item_data
+                winning_bid = listing.winning_bid
+                pack_row(buffer, offset, listing.item_id or 0, listing.item_name.encode('utf-8')[:ITEM_BYTES],
+                         item_data.user_id, item_data.close_time, listing.max_bid_amount or 0,
+                         winning_bid.bid_amount if winning_bid is not None else 0,
+                         listing.bid_count, listing.valid_bid_count)
+                offset += ROW.size
+            event_time = server.current_time
+            HEADER.pack_into(buffer, 0, MAGIC, VERSION, self.capacity, sequence,
+                             event_time if event_time is not None else 0, time.time(), open_count, len(listings))
+            self.sequence = sequence + 1
+            SEQUENCE.pack_into(buffer, SEQUENCE_OFFSET, self.sequence)
+            self.snapshots_published += 1
+        return len(listings)
+
+    def publish_periodically(self, interval):
+        """
+        Publish every interval seconds from a background thread, until stop
+        """
+        def publish():
+            while not self.stopping.wait(interval):
+                self.publish()
+        self.publisher_thread = threading.Thread(target=publish, name='auction-snapshots', daemon=True)
+        self.publisher_thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop publishing periodically, the table keeps its last snapshot
+        """
+        self.stopping.set()
+        if self.publisher_thread is not None:
+            self.publisher_thread.join()
+            self.publisher_thread = None
+
+    def close(self, unlink=True):
+        """
+        Stop publishing and release the block, removing it unless unlink is False
+        """
+        self.stop()
+        self.block.close()
+        if unlink:
+            self.block.unlink()
+            created_names.discard(self.name)
+
+
+class SnapshotReader:
+    """
+    Reads the table of a SnapshotPublisher, from any process
+        - name: name of the shared memory block
+    """
+    def __init__(self, name):
+        self.block = attach(name)
+        self.name = name
+        magic, version, self.capacity = HEADER.unpack_from(self.block.buf, 0)[:3]
+        if magic != MAGIC or version != VERSION:
+            self.block.close()
+            raise ValueError('{0} is not an auction snapshot table (version {1})'.format(name, VERSION))
+
+    def read(self, retries=READ_RETRIES):
+        """
+        A consistent snapshot of the open auctions, in table order
+            - retries: attempts before giving up while the publisher is writing
+            - raises RuntimeError if no consistent snapshot could be read
+        """
+        buffer = self.block.buf
+        unpack_sequence = SEQUENCE.unpack_from
+        for _ in range(retries):
+            sequence, = unpack_sequence(buffer, SEQUENCE_OFFSET)
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            _, _, _, _, event_time, published_at, open_count, row_count = HEADER.unpack_from(buffer, 0)
+            rows = list(ROW.iter_unpack(buffer[HEADER.size:HEADER.size + row_count * ROW.size]))
+            if unpack_sequence(buffer, SEQUENCE_OFFSET)[0] == sequence:
+                return Snapshot(sequence, event_time, published_at, open_count,
+                                [self.open_auction(row, event_time) for row in rows])
+        raise RuntimeError('No consistent auction snapshot after {0} attempts'.format(retries))
+
+    @staticmethod
+    def open_auction(row, event_time):
+        item_id, item, seller, close_time, highest_bid, leading_bid, bid_count, valid_bid_count = row
+        return OpenAuction(item.rstrip(b'\0').decode('utf-8', 'replace'), item_id, seller, close_time,
+                           close_time - event_time, highest_bid, leading_bid, bid_count, valid_bid_count)
+
+    def close(self):
+        self.block.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the open auctions published by auction_v2.py --snapshot-name')
+    parser.add_argument('name', help='name of the shared memory snapshot table')
+    parser.add_argument('--watch', type=float, default=0,
+                        help='read the table again every this many seconds until interrupted')
+    parser.add_argument('--top', type=int, default=20,
+                        help='auctions shown, those closing soonest first, default(20)')
+    args = parser.parse_args()
+
+    reader = SnapshotReader(args.name)
+    try:
+        while True:
+            snapshot = reader.read()
+            print('{0} open auctions at {1} (snapshot {2}, published {3:.1f}s ago)'.format(
+                snapshot.open_count, snapshot.event_time, snapshot.sequence // 2,
+                time.time() - snapshot.published_at))
+            #item|close_time|time_to_close|highest_bid|leading_bid|bid_count|valid_bid_count
+            for auction in sorted(snapshot.auctions, key=attrgetter('close_time'))[:args.top]:
+                print('{0}|{1}|{2}|{3}|{4}|{5}|{6}'.format(auction.item, auction.close_time, auction.time_to_close,
+                                                           format_money(auction.highest_bid),
+                                                           format_money(auction.leading_bid),
+                                                           auction.bid_count, auction.valid_bid_count))
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
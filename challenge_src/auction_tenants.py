@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Many independent auction houses (tenants) hosted in one process.
+
+Each line of the input is prefixed with the tenant it belongs to:
+
+   tenant|timestamp|user_id|SELL|item|reserve_price|close_time
+   tenant|timestamp|user_id|BID|item|bid_amount
+   tenant|timestamp
+
+Every tenant has its own Server, so listings, bids and heartbeats of one
+tenant never affect another. The servers share the process wide logger,
+the record types and parsers (see auction_records), a new tenant costs an
+empty Server rather than a process.
+
+Instructions are queued per tenant and processed by deficit round robin:
+each round a tenant with queued instructions is given quantum * weight
+credits and processes one instruction per credit, so a busy tenant cannot
+starve a quiet one. Tenants do not bank credit while their queue is empty.
+A tenant's queue holds at most max_pending instructions, submit returns
+False when it is full and the caller should run a round before retrying.
+
+   python auction_tenants.py --filename tenants.txt
+
+prints the summary report of every tenant, each line prefixed with its tenant.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+from collections import deque
+from functools import partial
+from auction_v2 import Server, configure_logging
+# -----------------------------------------
+
+
+class TenantEngine:
+    """
+    Hosts a Server per tenant and schedules their instructions fairly
+        - quantum: instructions a tenant of weight 1 may process per round
+        - max_pending: instructions queued per tenant before submit refuses more
+        - logger: logger shared by every tenant's Server, configure_logging() by default
+        - server_options: passed to each tenant's Server, e.g. keep_bid_history
+        - raises ValueError if quantum is not positive, no tenant would ever be given credit
+    """
+    def __init__(self, quantum=100, max_pending=10000, logger=None, **server_options):
+        if quantum <= 0:
+            raise ValueError('Quantum must be positive, got {0}'.format(quantum))
+        self.quantum = quantum
+        self.max_pending = max_pending
+        self.logger = logger if logger is not None else configure_logging()
+        self.server_options = server_options
+        self.servers = {}
+        self.pending = {}
+        self.deficits = {}
+        self.weights = {}
+        #tenants with queued instructions, in the order they are next scheduled
+        self.active = deque()
+        #called as handler(tenant, listing) when a listing of any tenant closes
+        self.result_handlers = []
+
+    def server(self, tenant):
+        """
+        The Server of a tenant, created on first use
+        """
+        server = self.servers.get(tenant)
+        if server is None:
+            server = self.servers[tenant] = Server(logger=self.logger, **self.server_options)
+            server.closed_listing_handlers.append(partial(self.publish_result, tenant))
+            self.pending[tenant] = deque()
+            self.deficits[tenant] = 0
+            self.logger.info('Created tenant %s (%d tenants)', tenant, len(self.servers))
+        return server
+
+    def set_weight(self, tenant, weight):
+        """
+        Share of the processing a tenant gets relative to weight 1 tenants
+            - raises ValueError if weight is not positive, the tenant's queue would never drain
+        """
+        if weight <= 0:
+            raise ValueError('Weight of tenant {0} must be positive, got {1}'.format(tenant, weight))
+        self.weights[tenant] = weight
+
+    def publish_result(self, tenant, listing):
+        for handler in self.result_handlers:
+            handler(tenant, listing)
+
+    def submit(self, tenant, instruction):
+        """
+        Queue a typed record (see auction_records) for a tenant
+            - returns False, without queueing it, if the tenant's queue is full
+        """
+        self.server(tenant)
+        queued = self.pending[tenant]
+        if len(queued) >= self.max_pending:
+            return False
+        if not queued:
+            self.active.append(tenant)
+        queued.append(instruction)
+        return True
+
+    def submit_line(self, line):
+        """
+        Parse and queue a tenant prefixed input line, malformed rows are
+        counted against their tenant and dropped
+            - returns False, without queueing it, if the tenant's queue is full
+        """
+        tenant, _, row = line.strip().partition('|')
+        if not tenant or not row:
+            self.logger.error('Invalid syntax for tenant instruction %s, expecting tenant|instruction', line)
+            return True
+        server = self.server(tenant)
+        if len(self.pending[tenant]) >= self.max_pending:
+            return False
+        instruction = server.classify_instruction(row.split('|'))
+        if instruction is None:
+            return True
+        return self.submit(tenant, instruction)
+
+    def run_round(self):
+        """
+        Give every tenant with queued instructions one turn
+            - returns the number of instructions processed
+        """
+        processed = 0
+        for _ in range(len(self.active)):
+            tenant = self.active.popleft()
+            queued = self.pending[tenant]
+            deficit = self.deficits[tenant] + self.quantum * self.weights.get(tenant, 1)
+            process_instruction = self.servers[tenant].process_instruction
+            while queued and deficit >= 1:
+                process_instruction(queued.popleft())
+                deficit -= 1
+                processed += 1
+            if queued:
+                self.deficits[tenant] = deficit
+                self.active.append(tenant)
+            else:
+                self.deficits[tenant] = 0
+        return processed
+
+    def run(self):
+        """
+        Run rounds until every queue is empty
+            - returns the number of instructions processed
+        """
+        processed = 0
+        while self.active:
+            processed += self.run_round()
+        return processed
+
+    def process_file(self, file_name):
+        """
+        Queue and process every line of a tenant prefixed input file
+            - returns the number of lines read
+        """
+        lines = 0
+        with open(file_name, 'r') as input_file:
+            for line in input_file:
+                if not line.strip():
+                    continue
+                lines += 1
+                while not self.submit_line(line):
+                    self.run_round()
+        self.run()
+        return lines
+
+    def summary_report(self):
+        """
+        Summary report of every tenant in the order the tenants were first
+        seen, each line prefixed with its tenant
+        """
+        return ['{0}|{1}'.format(tenant, line)
+                for tenant, server in self.servers.items() for line in server.complete_summary_report()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Auction engine hosting many tenants, each line prefixed with its tenant')
+    parser.add_argument('--filename', type=str, default='input_tenants.txt',
+                        help='name of the tenant prefixed file to process, default(input_tenants.txt)')
+    parser.add_argument('--quantum', type=int, default=100,
+                        help='instructions a tenant may process per scheduling round, default(100)')
+    parser.add_argument('--max-pending', type=int, default=10000,
+                        help='instructions queued per tenant before reading waits, default(10000)')
+    parser.add_argument('--keep-bid-history', action='store_true',
+                        help='retain every bid on each listing rather than running statistics only')
+    args = parser.parse_args()
+    if args.quantum <= 0:
+        parser.error('--quantum must be positive')
+
+    engine = TenantEngine(quantum=args.quantum, max_pending=args.max_pending,
+                          keep_bid_history=args.keep_bid_history)
+    lines = engine.process_file(args.filename)
+    engine.logger.info('Processed %d lines for %d tenants', lines, len(engine.servers))
+    for line in engine.summary_report():
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
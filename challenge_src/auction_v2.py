@@ -18,22 +18,126 @@ Given an input file containing instructions to both start auctions, and place bi
 # -----------------------------------------
 # Imported libraries from standard library
 # -----------------------------------------
+import atexit
 import logging
-from logging.config import fileConfig
-from collections import namedtuple as data_structure
-from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+from collections import defaultdict, deque, Counter
 import csv
-from decimal import Decimal as decimal
+import heapq
 import argparse
-from pprint import pprint as pp
+import sys
+import threading
+from time import perf_counter_ns
 from auction_listing import AuctionListing
+from auction_records import UserListing, Bid, Heartbeat, AuctionResult, ItemDictionary
+from auction_records import parse_instruction, parse_user_listing, parse_bid, format_money
+from auction_mmap import read_mapped_instructions
 # -----------------------------------------
+#the optional features (checkpoints, write ahead log, results store, metrics,
+#sinks, reorder buffer, snapshots) are imported in main when used, keeping
+#the import of the Server lean for the modules and shard workers using it
+
+
+_log_listener = None
+_logging_configured = False
+#logs directory next to challenge_src, whatever the working directory
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'logs', 'logfile.log')
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    QueueHandler which leaves the record untouched, so the message is only
+    formatted by the listener thread when it is written out
+    """
+    def prepare(self, record):
+        return record
+
+
+def queue_file_handlers(logger):
+    """
+    Move the file handlers of logger behind a DeferredQueueHandler, records
+    are written to file by a QueueListener thread rather than the auction loop
+    """
+    global _log_listener
+    file_handlers = [handler for handler in logger.handlers if isinstance(handler, logging.FileHandler)]
+    if not file_handlers:
+        return
+    log_queue = queue.Queue(-1)
+    for handler in file_handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    _log_listener = QueueListener(log_queue, *file_handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def stop_log_listener():
+    """
+    Flush any queued log records and stop the listener thread
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+atexit.register(stop_log_listener)
+
+
+def configure_logging(config_file=''):
+    """
+    Configure logging once per process, later calls return the same logger
+        - config_file: logging config file read instead of the defaults (see
+                       logging_config.ini), always applied even if logging
+                       has already been configured
+        - returns the auctionLogger logger
+
+    By default auctionLogger writes INFO and above to LOG_FILE, the file is
+    only opened when the first record is written, and WARNING and above to
+    stdout. File handlers are moved behind a queue (see queue_file_handlers).
+    """
+    global _logging_configured
+    logger = logging.getLogger('auctionLogger')
+    if _logging_configured and not config_file:
+        return logger
+    stop_log_listener()
+    if config_file:
+        from logging.config import fileConfig
+        fileConfig(config_file, disable_existing_loggers=False)
+    else:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setLevel(logging.WARNING)
+        console_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+        logger.addHandler(console_handler)
+        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+        file_handler = logging.FileHandler(LOG_FILE, delay=True)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(file_handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    queue_file_handlers(logger)
+    _logging_configured = True
+    return logger
+
+#reasons a bid (or any row) is rejected
+UNKNOWN_ITEM = 'unknown_item'
+OUTSIDE_WINDOW = 'outside_window'
+BELOW_RESERVE = 'below_reserve'
+NOT_ABOVE_PREVIOUS = 'not_above_previous'
+MALFORMED = 'malformed'
+INVALID_BID_SAMPLE_SIZE = 100
 
 
 class Server:
-    def __init__(self, input_file=""):
-        self.logger = self.set_up_logging()
+    def __init__(self, input_file="", keep_bid_history=False, logger=None):
+        self.logger = logger if logger is not None else configure_logging()
         self.file_name = input_file
+        self.keep_bid_history = keep_bid_history
         self.instruction_list = []
         self.instruction_loaded = False
         self.user_listings = {}
@@ -41,16 +145,41 @@ class Server:
         self.heartbeats = []
         self.valid_bid_list = {}
         self.all_listed_items = {}
-        self.all_invalid_bids = []
+        self.open_listings = {}
+        self.close_schedule = []
+        self.listing_sequence = 0
+        #timestamp of the latest instruction processed, the auction clock
+        self.current_time = None
+        #dense integer id of every item listed, in the order first listed, one entry per
+        #distinct item for the life of the server (see auction_records.ItemDictionary)
+        self.item_ids = ItemDictionary()
+        #rejected bids counted per reason (per listing on AuctionListing.invalid_bid_counts)
+        #with a ring buffer of sampled (reason, row) examples
+        self.invalid_bid_counts = Counter()
+        self.invalid_bid_samples = deque(maxlen=INVALID_BID_SAMPLE_SIZE)
+        self.invalid_bid_sample_every = 10
+        self.invalid_bids_seen = 0
         self.report_list = []
         self.heartbeats = []
-        self.within_listing_time = False
+        self.closed_listing_handlers = []
+        #listings listed, bid on or closed since the last checkpoint snapshot, when set (see auction_checkpoint)
+        self.changed_listings = None
+        #write ahead log every processed instruction is appended to (see auction_wal)
+        self.wal = None
+        #store closed listings are retired to, when set (see auction_results)
+        self.results_store = None
+        #processing loop instrumentation, when set (see auction_metrics)
+        self.metrics = None
+        #per instruction tracing is gated on these before any message is built
+        self.tracer = logging.getLogger('auctionLogger.trace')
+        self.trace_all = self.tracer.isEnabledFor(logging.DEBUG)
+        self.traced_items = set()
         
-        #data structure declarations
-        self.user_listing  = data_structure('user_listing', 'timestamp user_id action item reserve_price close_time')
-        self.bid = data_structure('bid', 'timestamp user_id action item bid_amount')
-        self.heartbeat = data_structure ('heartbeat', 'timestamp')
-        self.auction_result = data_structure('auction_result', 'close_time item user_id status price_paid total_bid_count highest_bid lowest_bid')
+        #data structure declarations, typed records shared by all servers
+        self.user_listing = UserListing
+        self.bid = Bid
+        self.heartbeat = Heartbeat
+        self.auction_result = AuctionResult
         self.logger.info('Auction program running')
 
 
@@ -59,76 +188,158 @@ class Server:
         Function used to initialise logging of activities in this object
             - returns a logger object
 
-        note: file called logging_config.ini should be available in the
-            working directory which contains the logging configuration.
+        note: logging is only configured once per process (see configure_logging)
         """
-        fileConfig('logging_config.ini')
-        logger = logging.getLogger('auctionLogger')
-        return logger
+        return configure_logging()
+
+
+    def enable_tracing(self, items=None):
+        """
+        Turn on per instruction tracing, written at DEBUG level to the
+        auctionLogger.trace logger
+            - items: item codes to trace, or None to trace everything
+        """
+        self.tracer.setLevel(logging.DEBUG)
+        if items is None:
+            self.trace_all = True
+        else:
+            self.traced_items.update(items)
 
 
-    def process_instruction_input_file(self,file_name=""):
+    def process_instruction_input_file(self,file_name="", memory_map=False):
         """
         Read input file, categorise by parsing each item
         for processing
+            - memory_map: parse the file through a memory map (see auction_mmap)
         """
         try:
             self.logger.info('Attempting to load instructions into memory')
-            with open(file_name, newline='') as csvfile:
-                csv_instructions = csv.reader(csvfile, delimiter='|')
-                list(map(self.data_classification, csv_instructions))
+            if memory_map:
+                self.instruction_list.extend(self.mapped_instructions(file_name))
+            else:
+                with open(file_name, newline='') as csvfile:
+                    csv_instructions = csv.reader(csvfile, delimiter='|')
+                    list(map(self.data_classification, csv_instructions))
             self.instruction_loaded = True
             self.logger.info('Successfully loaded instructions for processing')
             return self.instruction_list
         except IOError as file_error:
-            self.logger.error('Error reading input file {0}'.format(file_error))
+            self.logger.error('Error reading input file %s', file_error)
             raise Exception('Error reading input file {0}'.format(file_error))
 
 
+    def process_instruction_stream(self, file_name="", output=None, memory_map=False):
+        """
+        Stream the input file, each row is classified and passed straight
+        to process_instruction without being held in memory.
+        Closed auction lines are written to output (if given) as soon as
+        each listing closes.
+            - memory_map: parse the file through a memory map (see auction_mmap)
+            - returns the number of instructions processed
+        """
+        if output is not None:
+            self.write_closed_auctions(output)
+        processed = 0
+        for instruction in self.stream_instructions(file_name, memory_map=memory_map):
+            self.process_instruction(instruction)
+            processed += 1
+        self.logger.info('Successfully streamed %d instructions', processed)
+        return processed
+
+
+    def write_closed_auctions(self, output):
+        """
+        Write each auction result line to output as the listing closes
+        """
+        self.closed_listing_handlers.append(lambda listing: output.write(
+            self.format_auction_result(listing.auction_result) + '\n'))
+
+
+    def stream_instructions(self, file_name="", memory_map=False):
+        """
+        Generator reading the input file one row at a time
+            - memory_map: parse the file through a memory map (see auction_mmap)
+            - yields classified instructions (user_listing, bid, heartbeat)
+        """
+        try:
+            self.logger.info('Attempting to stream instructions from %s', file_name)
+            if memory_map:
+                yield from self.mapped_instructions(file_name)
+                return
+            metrics = self.metrics
+            with open(file_name, newline='') as csvfile:
+                for row in csv.reader(csvfile, delimiter='|'):
+                    started = metrics.stage_started('data_classification') if metrics is not None else 0
+                    instruction = self.classify_instruction(row)
+                    if started:
+                        metrics.stage_finished('data_classification', started)
+                    if instruction is not None:
+                        yield instruction
+        except IOError as file_error:
+            self.logger.error('Error reading input file %s', file_error)
+            raise Exception('Error reading input file {0}'.format(file_error))
+
+
+    def mapped_instructions(self, file_name):
+        """
+        Generator of the instructions read through a memory map (see auction_mmap),
+        timing the data_classification stage of each row when metrics are set
+        """
+        instructions = read_mapped_instructions(file_name, self.classify_instruction)
+        metrics = self.metrics
+        if metrics is None:
+            yield from instructions
+            return
+        #rows are parsed as the reader is advanced, so each step is the classification
+        while True:
+            started = metrics.stage_started('data_classification')
+            instruction = next(instructions, None)
+            if instruction is None:
+                return
+            if started:
+                metrics.stage_finished('data_classification', started)
+            yield instruction
+
+
     def data_classification(self, data=[]):
         """
         This function is used to store and classify data entered into memory
         using namedtuples, useful for easily accessing data.
+
+            input: list of data
+            output: classification type (user_listing, bid, heartbeat)
+        """
+        metrics = self.metrics
+        started = metrics.stage_started('data_classification') if metrics is not None else 0
+        instruction = self.classify_instruction(data)
+        if started:
+            metrics.stage_finished('data_classification', started)
+        if instruction is None:
+            return ''
+        self.instruction_list.append(instruction)
+        return type(instruction).__name__
+
+
+    def classify_instruction(self, data=[]):
+        """
+        Classify a single row of data as a typed record, each field is
+        converted exactly once (see auction_records).
         Rows with 6 columns are user listings
         Rows with 5 columns are bids
         Rows with a single column are heartbeats
 
             input: list of data
-            output: classification type (user_listing, bid, heartbeat)
+            output: namedtuple (user_listing, bid, heartbeat) or None
         """
-        data_type = ''
-        self.logger.info('Attempting to classify: {0}'.format(data))
-        #This section classifies an input as heartbeat, expecting integer
-        if len(data) == 1:
-            try:
-                value = data[0]
-                int(value)
-                self.instruction_list.append(self.heartbeat._make(data))
-                data_type = 'heartbeat'
-            except ValueError as input_error:
-                self.logger.error('{0}, expecting heartbeat with epoch timestamp'.format(input_error))
-        #This section classifies the input as a bid
-        if len(data) == 5:
-            is_bid_syntax_valid = self.validate_bid_format(data)
-            if is_bid_syntax_valid:
-                self.instruction_list.append(self.bid._make(data))
-                data_type = 'bid'
-            else:
-                self.logger.error('Invalid syntax for classifying object as a bid: {0}'.format(data))
-        # This section classifies the input as a user listing
-        if len(data) == 6:
-            is_listing_syntax_valid = self.validate_listing_format(data)
-            if is_listing_syntax_valid:
-                self.instruction_list.append(self.user_listing._make(data))
-                data_type = 'user_listing'
-            else:
-                self.logger.error('Invalid syntax for classifying object as a user listing: {0}'.format(data))
-        
-        if data_type:
-           self.logger.info('Successfully classified {0} as {1}'.format(self.instruction_list[-1], data_type))
-        else:
-           self.logger.debug('Unable to classify instruction: {0}'.format(data))
-        return data_type
+        try:
+            instruction = parse_instruction(data)
+        except ValueError as input_error:
+            self.logger.error('Invalid syntax for classifying instruction %s: %s', data, input_error)
+            self.reject_bid(MALFORMED, data)
+            return None
+        if self.trace_all:
+            self.tracer.debug('Classified %s as %s', instruction, type(instruction).__name__)
+        return instruction
 
 
     def validate_listing_format(self, validation_data=[]):
@@ -139,28 +350,17 @@ class Server:
             validation_data[1] = userid (int)
             validation_data[2] = action (str)
             validation_data[3] = item (str)
-            validation_data[4] = reserve_price (decimal)
+            validation_data[4] = reserve_price (decimal, parsed to minor units)
             validation_data[5] = close_time (int)
         output:
            boolean:
         """
-        is_valid=False
-        # need to think of how to validate 'item' is a unique string code
         try:
-            timestamp_check = validation_data[0]
-            int(timestamp_check)
-            user_id_check = validation_data[1]
-            int(user_id_check)
-            action_check = True if validation_data[2] == 'SELL' else False
-            reserve_price_check = validation_data[4]
-            decimal(reserve_price_check)
-            close_time_check = validation_data[5]
-            int(close_time_check)
-            if action_check:
-                is_valid=True
-            return is_valid
-        except ValueError as value_validation: 
-            self.logger.error('{0}'.format(value_validation))
+            parse_user_listing(validation_data)
+            return True
+        except ValueError as value_validation:
+            self.logger.error('%s', value_validation)
+            return False
 
 
     def validate_bid_format(self, validation_data=[]):
@@ -171,24 +371,16 @@ class Server:
            validation_data[1] (int): user_id
            validation_data[2] (int): action
            validation_data[3] (str): item
-           validation_data[4] (decimal): bid_amount
+           validation_data[4] (decimal, parsed to minor units): bid_amount
         Return: 
            boolean : True or False
         """
-        is_valid = False
         try:
-            timestamp_check = validation_data[0]
-            int(timestamp_check)
-            user_id_check = validation_data[1]
-            int(user_id_check)
-            action_check = True if validation_data[2] == 'BID' else False
-            bid_amount_check = validation_data[4]
-            decimal(bid_amount_check)
-            if action_check:
-                is_valid=True
-            return is_valid
-        except ValueError as value_validation: 
-            self.logger.error('{0}'.format(value_validation))
+            parse_bid(validation_data)
+            return True
+        except ValueError as value_validation:
+            self.logger.error('%s', value_validation)
+            return False
         
  
     def process_instruction(self, instruction):
@@ -199,124 +391,159 @@ class Server:
         - bid(timestamp=12, user_id=8, action='BID', item='toaster_1', bid_price=7.50)
         - heartbeat(timestamp=20)
       
-        Each intruction is processed accordigly with no return value
+        Each intruction is processed accordigly with no return value.
+        Before processing, every listing whose close time has been passed by
+        the instruction timestamp is closed (heartbeats also close listings
+        ending on that exact second).
+        The instruction is appended to the write ahead log first, if there is one.
         """
-        if isinstance(instruction, self.user_listing):
+        if self.wal is not None:
+            self.wal.append(instruction)
+        metrics = self.metrics
+        if metrics is None:
+            self.apply_instruction(instruction)
+            return
+        started = metrics.instruction_started(instruction)
+        self.apply_instruction(instruction)
+        if started:
+            metrics.instruction_finished(instruction, started)
+
+    def apply_instruction(self, instruction):
+        """
+        Process an instruction (see process_instruction) without appending it
+        to the write ahead log or timing it
+        """
+        timestamp = self.current_time = instruction.timestamp
+        if isinstance(instruction, self.heartbeat):
+            if self.trace_all:
+                self.tracer.debug('Heartbeat %s', timestamp)
+            self.close_due_listings(timestamp)
+            return
 
-            self.logger.info('User has listed "{0}"\nprice: £{1},\nstart time: {2}'.format(instruction.item, 
-                                                                                instruction.reserve_price, 
-                                                                                instruction.timestamp))
-        
+        #bids placed on the closing second are still valid
+        self.close_due_listings(timestamp - 1)
+        item = instruction.item
+        traced = self.trace_all or item in self.traced_items
+
+        if isinstance(instruction, self.user_listing):
             #Create an auction listing and add it to the dictionary of all listed items
-            self.all_listed_items[instruction.item] = AuctionListing(auction_item_name=instruction.item, auction_listing_data=instruction)
-            self.all_listed_items[instruction.item].is_open = True
-            self.logger.info('New listing {0}, now accepting bids'.format(instruction))
-            self.logger.info('There are currently {0} items listed, they are: {1}'.format(len(self.all_listed_items), self.all_listed_items))
-
-        if isinstance(instruction,self.bid):
-            self.logger.info('**************************************************************************************')
-            self.logger.info('User {0} has placed a bid on item {1}\ntime: {2}\nprice: £{3}'.format(instruction.user_id, 
-                                                                                         instruction.item, 
-                                                                                         instruction.timestamp, 
-                                                                                         instruction.bid_amount))
+            listing = AuctionListing(auction_item_name=item, auction_listing_data=instruction,
+                                     keep_bid_history=self.keep_bid_history, item_id=self.item_ids.encode(item))
+            listing.is_open = True
+            self.all_listed_items[item] = listing
+            self.open_listings[item] = listing
+            self.schedule_listing_close(listing)
+            if self.changed_listings is not None:
+                self.changed_listings.add(listing)
+            if traced:
+                self.tracer.debug('New listing %s, now accepting bids (%d items open)', instruction, len(self.open_listings))
+
+        elif isinstance(instruction, self.bid):
             bid = instruction
-            self.logger.debug('Processing bid item: {0}'.format(bid))
-            bid_price = bid.bid_amount
-            auction_items_listed = self.all_listed_items.keys()
-            self.logger.debug('All items currently listed: {0}'.format(auction_items_listed))
-
-            if bid.item in auction_items_listed:
-                valid_bid_list = self.all_listed_items[bid.item].valid_bids
-                self.logger.info('Attempting to check if bid on item {0} is valid'.format(bid.item))
-                
-                try:
-                    is_valid_bid = self.valid_bid_check(bid)
-                    self.logger.debug('Completed bid valid check, bid validity state is: {0}'.format(is_valid_bid))
-                    if is_valid_bid:
-                        self.logger.info('Bid for {0} status: valid, attempting to add bid to valid list'.format(bid.item))
-                        if not valid_bid_list:
-                            self.logger.info('This is the first bid for {0}, price is £{1}'.format(bid.item, bid_price))
-                            self.all_listed_items[bid.item].lowest_valid_bid = str(bid_price)
-                            self.logger.info('Lowest bid for {0} is set to £{1}'.format(bid.item, bid_price))
-                        
-                        self.logger.info('Attempting to add the following valid bid {0}'.format(bid))
-                        self.all_listed_items[bid.item].valid_bids.append(bid)
-
-                        self.logger.info('Added bid to valid bid list: {0}'.format(self.all_listed_items[bid.item].valid_bids))
-
-                        self.logger.info('Successfull validation of bid')
-                    if not self.all_listed_items[bid.item].all_bids:
-                        self.all_listed_items[bid.item].lowest_bid = str(bid_price)
-
-                except Exception as valid_bid_error:
-                    self.logger.error('Error whilst checking if bid is valid in process_instruction: {0}'.format(valid_bid_error))
-            else:
-               self.logger.error('There is currently no auction item listed for {0}'.format(bid.item))
-               self.all_invalid_bids.append(bid)
-
-            if self.within_listing_time:
-                self.logger.info('Appending {0} for item {1} to all bids.'.format(bid, bid.item))
-                self.all_listed_items[bid.item].all_bids.append(bid)
-                self.within_listing_time = False
-            else:
-                self.logger.info('Bid {0} outside listing time'.format(bid))
-                self.all_invalid_bids.append(bid)
-            
-        if isinstance(instruction, self.heartbeat):
-            heartbeat = instruction.timestamp
-            close_times = self.get_auction_closing_times() # return (item listed and timestamp) as a tuple
-            self.logger.info('Close times are as follows: {0}'.format(close_times))
-
-            for item_listed in close_times:
-                item_name = item_listed[0]
-                close_time = item_listed[1]
-                _listing = self.all_listed_items[item_name]
-                self.logger.info('Retrieved all items listed: {0}'.format(_listing))
-                if heartbeat == close_time:
-                    self.logger.info('############ Closing Listing {0} ########'.format(item_name))
-                    self.close_listing(item_name=item_name, heartbeat=heartbeat,close_time=close_time,listing=_listing)
-                    self.logger.info('Successfully completed listing check')
+            if traced:
+                self.tracer.debug('User %s has placed a bid on item %s, time: %s, price: £%s',
+                                  bid.user_id, item, bid.timestamp, format_money(bid.bid_amount))
+
+            listing = self.open_listings.get(item)
+            if listing is not None:
+                if self.changed_listings is not None:
+                    self.changed_listings.add(listing)
+                metrics = self.metrics
+                started = perf_counter_ns() if metrics is not None and metrics.sampling else 0
+                reason = self.bid_rejection_reason(bid, listing)
+                if started:
+                    metrics.stage_finished('valid_bid_check', started)
+                if reason != OUTSIDE_WINDOW:
+                    #every bid within the auction time is counted, valid or not
+                    listing.add_bid_to_all_bids_list(bid)
+                if reason is None:
+                    listing.add_bid_to_valid_bid_list(bid)
+                    if traced:
+                        self.tracer.debug('Valid bid added, %d valid bids for %s', listing.valid_bid_count, item)
                 else:
-                    self.logger.info('Auction is still open for listing {0}'.format(item_name))
-                
-                
-            #    self.get_summary_report()
-        self.logger.info('----------------------------------------------------------------------------------------')
+                    self.reject_bid(reason, bid, listing)
+                    if traced:
+                        self.tracer.debug('Bid %s rejected: %s', bid, reason)
+            elif item in self.all_listed_items or (self.results_store is not None and self.results_store.has_item(item)):
+               if traced:
+                   self.tracer.debug('Auction for %s has already closed', item)
+               listing = self.all_listed_items.get(item)
+               if listing is not None and self.changed_listings is not None:
+                   #the rejection is counted on the closed listing
+                   self.changed_listings.add(listing)
+               self.reject_bid(OUTSIDE_WINDOW, bid, listing)
+            else:
+               self.logger.error('There is currently no auction item listed for %s', item)
+               self.reject_bid(UNKNOWN_ITEM, bid)
 
     def close_listing(self, item_name, heartbeat, close_time, listing):
-        self.logger.info('Current timestamp {0} auction listing close time: {1}'.format(heartbeat, close_time))
-        listing.total_bid_count = len(listing.all_bids)
-        self.logger.info('Total bids counted for {0} is {1}'.format(listing.item_name, listing.total_bid_count))
-        
-        listing.highest_bid = str(listing.all_bids[-1].bid_amount) if len(listing.all_bids) > 1 else '0.00' 
-        self.logger.info('The HIGHEST bid upon closing is: {0}'.format(listing.highest_bid))
-
-        if listing.valid_bids:
-            self.logger.info('Listing has some valid bids')
-            if len(listing.valid_bids) >=2:
-                self.logger.info('Attempting to set price paid for {0}'.format(listing.item_name))
-                listing.price_paid = listing.valid_bids[-2].bid_amount
-                listing.sale_status = 'SOLD'
-                #listing.is_open = False
-                #listing.highest_bid = str(listing.valid_bids[-1].bid_amount)
-                self.logger.info('Successfully set price paid for {0} to £{1}, listing is now closed'.format(listing.item_name, listing.price_paid))
-            elif len(listing.valid_bids) == 1:
-                self.logger.info('Attempting to set price paid for {0}'.format(listing.item_name))
-                listing.price_paid = str(listing.item_data.reserve_price)
-                listing.sale_status = 'SOLD'
-                #listing.is_open = False
-                #listing.highest_bid = str(listing.valid_bids[-1].bid_amount)
-                self.logger.info('Successfully set price paid for {0} to £{1}, listing is now closed'.format(listing.item_name, listing.price_paid))
-            else:
-                self.logger.error('Unexpected result, needs investigation whilst closing listing')
+        metrics = self.metrics
+        started = metrics.stage_started('close_listing') if metrics is not None else 0
+        listing.total_bid_count = listing.bid_count
+        listing.set_highest_bid()
+        listing.set_lowest_bid()
+
+        if listing.runner_up_bid is not None:
+            listing.price_paid = listing.runner_up_bid.bid_amount
+            listing.sale_status = 'SOLD'
+        elif listing.valid_bid_count:
+            #only the winner bid, they pay the reserve
+            listing.price_paid = listing.item_data.reserve_price
+            listing.sale_status = 'SOLD'
         else:
-            listing.price_paid = '0.00'
-            #listing.lowest_bid = '0.00'
-            #listing.highest_bid = '0.00'
-            #listing.is_open = False
-            self.logger.info('No valid bids for {0}. Listing closed'.format(listing.item_name))
-        listing.set_open_status(False)         
+            listing.price_paid = 0
+        listing.set_open_status(False)
+        if self.open_listings.get(listing.item_name) is listing:
+            del self.open_listings[listing.item_name]
+        listing.auction_result = self.build_auction_result(listing)
+        if self.changed_listings is not None:
+            self.changed_listings.add(listing)
+        if self.trace_all or listing.item_name in self.traced_items:
+            self.tracer.debug('Closed listing %s at %s (close time %s): %s',
+                              listing.item_name, heartbeat, close_time, listing.auction_result)
+        for handler in self.closed_listing_handlers:
+            handler(listing)
+        if self.results_store is not None:
+            self.retire_listing(listing)
+        if started:
+            metrics.stage_finished('close_listing', started)
+
+    def retire_listing(self, listing):
+        """
+        Add a closed listing's result to the results store and drop the
+        listing from memory, only open listings stay in all_listed_items
+        """
+        self.results_store.add(listing.auction_result, listing.sequence)
+        if self.all_listed_items.get(listing.item_name) is listing:
+            del self.all_listed_items[listing.item_name]
         
+    def schedule_listing_close(self, listing):
+        """
+        Push a listing onto the close time priority queue, keyed on the
+        integer close time then the order it was listed in.
+        The sequence is stored on the listing so results from several
+        servers can be merged back into listing order (see auction_sharded)
+        """
+        self.listing_sequence += 1
+        listing.sequence = self.listing_sequence
+        heapq.heappush(self.close_schedule, (listing.item_data.close_time, listing.sequence, listing))
+
+
+    def close_due_listings(self, timestamp):
+        """
+        Pop and close every open listing with a close time on or before timestamp
+            - returns the number of listings closed
+        """
+        closed = 0
+        close_schedule = self.close_schedule
+        while close_schedule and close_schedule[0][0] <= timestamp:
+            close_time, _, listing = heapq.heappop(close_schedule)
+            if listing.is_open:
+                self.close_listing(item_name=listing.item_name, heartbeat=timestamp, close_time=close_time, listing=listing)
+                closed += 1
+        return closed
+
+
     def get_auction_closing_times(self):
         """
         Get all closed times
@@ -334,190 +561,330 @@ class Server:
             inputs:
                 bid: bid placed by user which is a namedtuple
         """
-        self.logger.info('Function called to validate bid: {0}'.format(bid))
-        is_valid = False
-        #check if there is a list of items to bid for
-        if self.all_listed_items:
-            self.logger.info('There are items currently listed')
-            self.logger.info('Attempting to check if an item is listed for this bid')
-            listed_items = self.all_listed_items.keys()
-            self.logger.info('The following items have been listed: {0}'.format(listed_items))
-            #check it bid item is listed
-            if bid.item in listed_items:
-                self.logger.info('{0} has been listed'.format(bid.item))
-                listing_open_time = self.all_listed_items[bid.item].item_data.timestamp
-                bid_time = bid.timestamp
-                bid_price = bid.bid_amount
-                listing_close_time = self.all_listed_items[bid.item].item_data.close_time
-                item_reserve_price = self.all_listed_items[bid.item].item_data.reserve_price
-                valid_bid_list = self.all_listed_items[bid.item].valid_bids
-                all_bids = self.all_listed_items[bid.item].all_bids
-
-                self.logger.info('---- Here are a list of valid bids ----: {0}'.format(valid_bid_list))
-                self.logger.info('.................')
-                self.logger.info('All bids for {0}: {1}'.format(bid.item, all_bids))
-                
-                self.logger.info('Attempting to check if bid for {0} is valid.'.format(bid.item))
-                """
-                  This section checks if a bid is valid under three different criterias
-                   1. Is it within the listed items auction times?
-                   2. Is it greater than the reserve price?
-                   3. Is it greater then existing bids? 
-                """
-                if self.is_within_auction_time(auction_open=listing_open_time, 
-                                               auction_close=listing_close_time, 
-                                               bid_time=bid_time) and \
-                    self.is_greater_than_reserve_price(reserve_price=item_reserve_price, 
-                                                       bid_price=bid_price) and \
-                    self.is_greater_than_existing_bids(valid_bid_list=valid_bid_list, current_bid=bid_price):
-                     
-                    #Executing commands as bid is valid
-                    is_valid = True
+        listing = self.open_listings.get(bid.item)
+        return listing is not None and self.bid_rejection_reason(bid, listing) is None
 
-                else:
-                    #add bid to to a list of all bids for a specific item
-                    #self.all_listed_items[bid.item].all_bids.append(bid)
-                    self.all_invalid_bids.append(bid) # later sub categorise invalid bids
-                    self.logger.info('{0} failed the validity check'.format(bid))                                                     
-            else:
-                #add bid to to a list of all bids for a specific item
-                #self.all_listed_items[bid.item].all_bids.append(bid)
-                self.all_invalid_bids.append(bid)
-                self.logger.error('Item is not listed, invalid bid')
+
+    def bid_rejection_reason(self, bid, listing):
+        """
+        Reason a bid on an open listing is invalid, or None if it is valid
+        """
+        listing_data = listing.item_data
+        bid_price = bid.bid_amount
+        """
+          This section checks if a bid is valid under three different criterias
+           1. Is it within the listed items auction times?
+           2. Is it greater than the reserve price?
+           3. Is it greater than the user's previous valid bids? 
+        """
+        if not self.is_within_auction_time(auction_open=listing_data.timestamp,
+                                           auction_close=listing_data.close_time,
+                                           bid_time=bid.timestamp):
+            reason = OUTSIDE_WINDOW
+        elif not self.is_greater_than_reserve_price(reserve_price=listing_data.reserve_price, bid_price=bid_price):
+            reason = BELOW_RESERVE
+        elif not self.is_greater_than_existing_bids(previous_bid=listing.get_user_best_bid(bid.user_id),
+                                                    current_bid=bid_price):
+            reason = NOT_ABOVE_PREVIOUS
         else:
-            self.all_invalid_bids.append(bid)
-            self.logger.error('No items listed currently, invalid bid')
-        return is_valid
-        
+            reason = None
+        if self.trace_all or bid.item in self.traced_items:
+            self.tracer.debug('Bid %s validity: %s (auction %s-%s, reserve £%s, previous bid £%s)',
+                              bid, reason or 'valid', listing_data.timestamp, listing_data.close_time,
+                              format_money(listing_data.reserve_price),
+                              listing.format_amount(listing.get_user_best_bid(bid.user_id)))
+        return reason
+
+
+    def reject_bid(self, reason, row, listing=None):
+        """
+        Count a rejected bid (or malformed row) against its reason and
+        listing, keeping every invalid_bid_sample_every one as an example
+        """
+        self.invalid_bid_counts[reason] += 1
+        if listing is not None:
+            if listing.invalid_bid_counts is None:
+                listing.invalid_bid_counts = Counter()
+            listing.invalid_bid_counts[reason] += 1
+        if self.invalid_bids_seen % self.invalid_bid_sample_every == 0:
+            self.invalid_bid_samples.append((reason, row))
+        self.invalid_bids_seen += 1
+
+
+    def invalid_bids_by_item(self):
+        """
+        Rejected bid counts of each item still in memory
+        """
+        return {item: listing.invalid_bid_counts for item, listing in self.all_listed_items.items()
+                if listing.invalid_bid_counts}
+
 
     def is_within_auction_time(self, auction_open, auction_close, bid_time):
         """
           Returns the status of a bid, by checking the auction time
         """
-        
-        if bid_time >= auction_open and bid_time <= auction_close:
-            self.within_listing_time = True
-            self.logger.info('Auction close time:{0}\n bid time:{1}\nbid has been place within auction time'.format(auction_close, bid_time))
-        else:
-            self.logger.info('Bid submitted outside auction time')
-        return self.within_listing_time
+        return auction_open <= bid_time <= auction_close
 
 
     def is_greater_than_reserve_price(self, reserve_price, bid_price):
         """
           Returns the status of a bid, by checking the reserve price
+          (both prices are minor units parsed once by auction_records)
         """
-        try: 
-            status = False
-            bid_price = decimal(bid_price)
-            reserve_price = decimal(reserve_price)
-            
-            if bid_price > reserve_price:
-                self.logger.info('Bid price £{0} is greater than reserve price £{1}'.format(bid_price, reserve_price))
-                status = True
-                #self.logger.info('Bid price £{0} is greater than reserve price £{1}'.format(bid_price, reserve_price))
-            else:
-                self.logger.info('Bid price £{0} is less than reserve price £{1} for the item'.format(bid_price, reserve_price))
-            return status
-        except Exception as is_greater_than_reserve_price_error:
-            output = str(is_greater_than_reserve_price_error)
-            self.logger.error('Error in is_greater_than_reserve_price function: {0}'.format(output))
+        return bid_price > reserve_price
 
 
-    def is_greater_than_existing_bids(self, valid_bid_list, current_bid):
+    def is_greater_than_existing_bids(self, previous_bid, current_bid):
         """
-          Returns the status of a bid, by comparing the highest bid to current bid
+          Returns the status of a bid, by comparing the user's best previous
+          valid bid (None if the user has no valid bids) to current bid
         """
-        status = False
-        if not valid_bid_list:
-            status = True
-            self.logger.info('Current highest bid submitted at £{0}'.format(current_bid))
-            return status
-        else:
-            try:
-                self.logger.info('Assigning variables(highest bid, current bid and converting to decimal)')
-                highest_bid = valid_bid_list[-1].bid_amount
-                item = valid_bid_list[-1].item
-                current_bid = decimal(current_bid)
-                highest_bid = decimal(highest_bid)
-                self.logger.info('Completed variable assignment, attempting to validate price')
-                if current_bid > highest_bid:
-                    self.logger.info('Bid price £{0} is greater than current highest bid price £{1}'.format(str(current_bid), str(highest_bid)))
-                    status = True
-                    self.logger.info('Attempting to make £{0} the highest bid so far'.format(str(current_bid)))
-                    self.all_listed_items[item].highest_bid = str(current_bid)
-                    self.logger.info('Successfully set £{0} as the highest bid so far for {1}'.format(str(current_bid), item))
-                else:
-                    self.logger.info('Bid price £{0} is less than current highest bid price £{1}'.format(current_bid, highest_bid))
-                    self.logger.info('Unfortunately this bid is unsuccessful')
-                return status
-            except Exception as existing_bids_error:
-                output = str(existing_bids_error)
-                self.logger.error('Error translating data from string to decimal: {0}'.format(output))
+        if previous_bid is None:
+            return True
+        return current_bid > previous_bid
             
     def auction_summary_report(self, auction):
-        #self.logger.info('##### - Attempting to print listing for {0}'.format(listing.item_name))
-        #listing.print_auction_data()
-        #self.logger.info(auction.all_listed_items['toaster_1'].all_bids)
+        metrics = self.metrics
+        started = metrics.stage_started('auction_summary_report') if metrics is not None else 0
         internal_list = []
-      
         for auction_item_name, auction_item  in auction.items():
-            #self.logger.info(auction_item)
-            
-            self.logger.info('------------- SUMMARY FOR {0} ------------'.format(auction_item.item_name))
-            self.logger.info("ALL BIDS: {0}".format(auction_item.all_bids))
-            self.logger.info("VALID BIDS: {0}".format(auction_item.valid_bids))
-            self.logger.info("PRICE PAID: £{0}".format(auction_item.price_paid))
-            self.logger.info("SALE STATUS: {0}".format(auction_item.sale_status))
-            self.logger.info("TOTAL BID COUNT: {0}".format(auction_item.total_bid_count))
-            self.logger.info("HIGHEST BID: £{0}".format(auction_item.highest_bid))
-            self.logger.info("LOWEST BID: £{0}".format(auction_item.lowest_bid))
-            self.logger.info('------------- END ------------')
-
-            bids_check = len(auction_item.valid_bids)
-            if bids_check > 0:
-                winning_user_id = auction_item.valid_bids[-1].user_id
-            else:
-                winning_user_id = ''
+            auction_summary_item = self.format_auction_result(self.listing_result(auction_item))
+            internal_list.append(auction_summary_item)
+        self.logger.info('Summary report built for %d listings', len(internal_list))
+        if started:
+            metrics.stage_finished('auction_summary_report', started)
+        return internal_list
+
 
-            #close_time|item|user_id|status|price_paid|total_bid_count|highest_bid|lowest_bid
+    def complete_summary_report(self):
+        """
+        Summary report of every item, including those retired to the results
+        store, in the same order as auction_summary_report(all_listed_items)
+        would give had nothing been retired
+        """
+        if self.results_store is None:
+            return self.auction_summary_report(self.all_listed_items)
+        return [self.format_auction_result(result) for result in self.complete_summary_results()]
 
 
-            auction_summary_item = '{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}'.format(auction_item.item_data.close_time, auction_item.item_name, winning_user_id, 
-                                                                            auction_item.sale_status, auction_item.price_paid, len(auction_item.all_bids), auction_item.highest_bid, 
-                                                                            auction_item.lowest_bid)
-            internal_list.append(auction_summary_item)
-        for i in internal_list:
-            self.logger.info(i)
-        return internal_list
+    def complete_summary_results(self):
+        """
+        The auction_result of every item in complete_summary_report order,
+        for writing through a result sink (see auction_sinks)
+        """
+        if self.results_store is None:
+            return [self.listing_result(listing) for listing in self.all_listed_items.values()]
+        metrics = self.metrics
+        started = metrics.stage_started('complete_summary_report') if metrics is not None else 0
+        report = {result.item: (first_sequence, result)
+                  for first_sequence, result in self.results_store.latest_results()}
+        for item, listing in self.all_listed_items.items():
+            first_sequence = report[item][0] if item in report else listing.sequence
+            report[item] = (first_sequence, self.listing_result(listing))
+        results = [result for _, result in sorted(report.values(), key=lambda entry: entry[0])]
+        self.logger.info('Summary report built for %d listings', len(results))
+        if started:
+            metrics.stage_finished('complete_summary_report', started)
+        return results
+
+
+    def listing_result(self, listing):
+        """
+        The auction_result of a listing, finalised once by close_listing
+        or built as it stands for a listing still open
+        """
+        result = listing.auction_result
+        if result is None or listing.is_open:
+            result = self.build_auction_result(listing)
+        return result
+
+
+    def build_auction_result(self, listing):
+        """
+        Function used to build the auction_result namedtuple for a listing,
+        amounts are formatted to two decimal places here on output
+            - listing: AuctionListing object
+        """
+        format_amount = listing.format_amount
+        return self.auction_result(close_time=listing.item_data.close_time, item=listing.item_name,
+                                   user_id=listing.get_winning_user_id(), status=listing.sale_status,
+                                   price_paid=format_amount(listing.price_paid), total_bid_count=listing.bid_count,
+                                   highest_bid=format_amount(listing.highest_bid),
+                                   lowest_bid=format_amount(listing.lowest_bid))
+
+
+    def format_auction_result(self, result):
+        """
+        Output syntax - (close_time|item|user_id|status|price_paid|total_bid_count|highest_bid|lowest_bid)
+        """
+        return '{0}|{1}|{2}|{3}|{4}|{5}|{6}|{7}'.format(*result)
             
 
+def write_profile(profiler, file_name):
+    profiler.stop()
+    with open(file_name, 'w') as profile_file:
+        profile_file.write(profiler.collapsed())
+    logging.getLogger('auctionLogger').info('Wrote %d profile samples to %s', profiler.samples, file_name)
+
+
 def main():
+    from auction_sinks import FORMATS, BUFFER_SIZE, open_sink
     parser = argparse.ArgumentParser(description='Auction program, that processes an instruction file')
     parser.add_argument('--filename', type=str, default='input.txt',
                         help='name of the file to process, default(input.txt)')
+    parser.add_argument('--stream', action='store_true',
+                        help='process the file row by row, printing each auction as it closes')
+    parser.add_argument('--keep-bid-history', action='store_true',
+                        help='retain every bid on each listing rather than running statistics only')
+    parser.add_argument('--trace', action='store_true',
+                        help='write a DEBUG trace of every instruction to the log file')
+    parser.add_argument('--trace-item', action='append', default=[], metavar='ITEM',
+                        help='write a DEBUG trace of instructions for ITEM only (repeatable)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='parse the file through a memory map rather than csv.reader')
+    parser.add_argument('--checkpoint-dir', type=str, default='',
+                        help='take periodic snapshots in this directory so a failed run can be resumed '
+                             '(the file is read through a memory map)')
+    parser.add_argument('--checkpoint-every', type=int, default=100000,
+                        help='instructions processed between snapshots, default(100000)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the latest snapshot in --checkpoint-dir')
+    parser.add_argument('--wal', type=str, default='',
+                        help='append every processed instruction to this write ahead log (replay with auction_wal.py)')
+    parser.add_argument('--wal-sync-interval', type=float, default=0.05,
+                        help='seconds between fsyncs of the write ahead log, default(0.05)')
+    parser.add_argument('--results-db', type=str, default='',
+                        help='retire closed listings to this results database rather than keeping them in memory')
+    parser.add_argument('--logging-config', type=str, default='',
+                        help='logging config file to use instead of the defaults, e.g. logging_config.ini')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='time the processing loop and serve Prometheus metrics on this port (see auction_metrics)')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='time the processing loop and log a summary of the metrics every this many seconds')
+    parser.add_argument('--profile', type=str, default='',
+                        help='sample the processing stack while running, writing collapsed stacks to this file')
+    parser.add_argument('--output', type=str, default='',
+                        help='write the auction results to this file rather than stdout (see auction_sinks)')
+    parser.add_argument('--output-format', choices=sorted(FORMATS), default='pipe',
+                        help='pipe delimited lines, JSON lines or length prefixed binary records, default(pipe)')
+    parser.add_argument('--rotate-bytes', type=int, default=0,
+                        help='rotate the --output file once it would grow beyond this many bytes')
+    parser.add_argument('--rotate-count', type=int, default=5,
+                        help='rotated --output files to keep, default(5)')
+    parser.add_argument('--output-buffer', type=int, default=BUFFER_SIZE,
+                        help='bytes of results buffered between writes, default({0})'.format(BUFFER_SIZE))
+    parser.add_argument('--flush-every', type=int, default=None,
+                        help='also write buffered results after this many results, '
+                             'default(1 when streaming to stdout, so each auction is printed as it closes, otherwise 0)')
+    parser.add_argument('--flush-interval', type=float, default=0,
+                        help='also write buffered results once they are this many seconds old')
+    parser.add_argument('--lateness', type=int, default=None,
+                        help='reorder input arriving up to this many seconds out of timestamp order, '
+                             'dropping anything later (see auction_reorder)')
+    parser.add_argument('--reorder-max', type=int, default=100000,
+                        help='instructions held for reordering before the earliest is forced out, default(100000)')
+    parser.add_argument('--snapshot-name', type=str, default='',
+                        help='publish the open auctions to this shared memory table for dashboards '
+                             '(read with auction_snapshots.py)')
+    parser.add_argument('--snapshot-interval', type=float, default=1.0,
+                        help='seconds between snapshots of the open auctions, default(1.0)')
+    parser.add_argument('--snapshot-capacity', type=int, default=10000,
+                        help='open auctions the snapshot table holds, those closing soonest first, default(10000)')
 
     args = parser.parse_args()
+    if args.resume and not args.checkpoint_dir:
+        parser.error('--resume requires --checkpoint-dir')
+    if args.rotate_bytes and not args.output:
+        parser.error('--rotate-bytes requires --output')
+    if args.lateness is not None and args.checkpoint_dir:
+        parser.error('--lateness cannot be used with --checkpoint-dir')
     
-    run_auction = Server(args.filename)
+    if args.flush_every is None:
+        args.flush_every = 1 if args.stream and not args.output else 0
+    
+    console_log = configure_logging(args.logging_config)
+    sink = open_sink(args.output, args.output_format, rotate_bytes=args.rotate_bytes, rotate_count=args.rotate_count,
+                     buffer_size=args.output_buffer, flush_every=args.flush_every,
+                     flush_interval=args.flush_interval)
+    run_auction = Server(args.filename, keep_bid_history=args.keep_bid_history, logger=console_log)
 
-    console_log = run_auction.set_up_logging()
     console_log.info("Attempting to initialise auction..")
+    if args.trace:
+        run_auction.enable_tracing()
+    elif args.trace_item:
+        run_auction.enable_tracing(args.trace_item)
+    if args.wal:
+        from auction_wal import WriteAheadLog
+        run_auction.wal = WriteAheadLog(args.wal, sync_interval=args.wal_sync_interval)
+        atexit.register(run_auction.wal.close)
+    if args.results_db:
+        from auction_results import ResultsStore
+        run_auction.results_store = ResultsStore(args.results_db)
+        atexit.register(run_auction.results_store.close)
+    reorder_buffer = None
+    if args.lateness is not None:
+        from auction_reorder import ReorderBuffer
+        reorder_buffer = ReorderBuffer(run_auction, args.lateness, max_buffered=args.reorder_max)
+    if args.metrics_port or args.stats_interval:
+        from auction_metrics import Metrics
+        metrics = Metrics(run_auction).instrument()
+        metrics.reorder_buffer = reorder_buffer
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        if args.stats_interval:
+            metrics.log_stats_periodically(args.stats_interval)
+        atexit.register(lambda: console_log.info('Metrics: %s', metrics.stats_line()))
+        atexit.register(metrics.stop)
+    if args.snapshot_name:
+        from auction_snapshots import SnapshotPublisher
+        publisher = SnapshotPublisher(run_auction, args.snapshot_name, capacity=args.snapshot_capacity)
+        publisher.publish_periodically(args.snapshot_interval)
+        atexit.register(publisher.close)
+    if args.profile:
+        from auction_metrics import SamplingProfiler
+        profiler = SamplingProfiler(threading.get_ident()).start()
+        atexit.register(write_profile, profiler, args.profile)
     console_log.info("Successfully initialised auction")
 
-    console_log.info("Attempting to read instruction file {0} into memory".format(args.filename))
-    instruction_set = run_auction.process_instruction_input_file(run_auction.file_name)
+    if args.checkpoint_dir:
+        from auction_checkpoint import process_with_checkpoints
+        console_log.info("Attempting to process instruction file %s with checkpoints in %s",
+                         args.filename, args.checkpoint_dir)
+        if args.stream:
+            run_auction.closed_listing_handlers.append(sink.add_listing)
+        process_with_checkpoints(run_auction, run_auction.file_name, args.checkpoint_dir,
+                                 checkpoint_every=args.checkpoint_every, resume=args.resume)
+        if not args.stream:
+            sink.add_all(run_auction.complete_summary_results())
+        sink.close()
+        console_log.info('----    Auction closed  -------')
+        return
+
+    if args.stream:
+        console_log.info("Attempting to stream instruction file %s", args.filename)
+        run_auction.closed_listing_handlers.append(sink.add_listing)
+        if reorder_buffer is not None:
+            reorder_buffer.process(run_auction.stream_instructions(run_auction.file_name, memory_map=args.mmap))
+        else:
+            run_auction.process_instruction_stream(run_auction.file_name, memory_map=args.mmap)
+        sink.close()
+        console_log.info('----    Auction closed  -------')
+        return
+
+    console_log.info("Attempting to read instruction file %s into memory", args.filename)
+    instruction_set = run_auction.process_instruction_input_file(run_auction.file_name, memory_map=args.mmap)
     console_log.info("Successfully read instruction file into memory")
-    #console_log.info(pp(instruction_set))
     console_log.info('    ')
     console_log.info('                        ############  START AUCTION ###############                       ')
    
     console_log.info('    ')
-    list(map(run_auction.process_instruction, instruction_set))
+    if reorder_buffer is not None:
+        reorder_buffer.process(instruction_set)
+    else:
+        list(map(run_auction.process_instruction, instruction_set))
     
-    summary = run_auction.auction_summary_report(run_auction.all_listed_items)
-    for auction_item in summary:
-        print(auction_item)
+    sink.add_all(run_auction.complete_summary_results())
+    sink.close()
     console_log.info('----    Auction closed  -------')
 
 
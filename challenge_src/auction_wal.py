@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append only write ahead log of the instructions processed by a Server.
+
+Once a WriteAheadLog is set as Server.wal every instruction passed to
+process_instruction is appended to it before being processed. Appends
+only pack the record into an in memory buffer, a background thread writes
+the buffer and fsyncs it every sync_interval seconds (group commit), so
+at most sync_interval seconds of instructions are lost on a crash.
+
+File layout, after the MAGIC header each group commit is one frame:
+
+   frame  - payload length (uint32), crc32 of the payload (uint32), payload
+   record - a one byte tag followed by its fields, little endian
+            I item definition - length (uint16), utf-8 item code, given the next item id
+            L user_listing    - timestamp, user_id, item id, close_time, price
+            B bid             - timestamp, user_id, item id, price
+            H heartbeat       - timestamp
+            prices are stored as their integer minor units (see auction_records)
+
+A frame which cannot be written (e.g. the disk is full) is truncated and
+its records, including any item definitions, kept buffered to be retried
+at the next commit, so no later frame refers to an undefined item.
+
+Replay reads the frames through a memory map, stopping at the first torn
+or corrupt frame (a crash part way through a write), and rebuilds the
+records without any of the text parsing.
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from auction_records import UserListing, Bid, Heartbeat, SELL, BID, ItemDictionary, format_money
+# -----------------------------------------
+
+MAGIC = b'AUCTIONWAL2\n'
+FRAME_HEADER = struct.Struct('<II')
+ITEM_RECORD = struct.Struct('<cH')
+LISTING_RECORD = struct.Struct('<cqqIqq')
+BID_RECORD = struct.Struct('<cqqIq')
+HEARTBEAT_RECORD = struct.Struct('<cq')
+ITEM_TAG, LISTING_TAG, BID_TAG, HEARTBEAT_TAG = b'I', b'L', b'B', b'H'
+ITEM_CODE, LISTING_CODE, BID_CODE, HEARTBEAT_CODE = ord(ITEM_TAG), ord(LISTING_TAG), ord(BID_TAG), ord(HEARTBEAT_TAG)
+tuple_new = tuple.__new__
+
+
+class WriteAheadLog:
+    """
+    Binary append only log with group commit
+        - path: log file, appended to if it already exists
+        - sync_interval: seconds between writes and fsyncs of the buffered records
+    """
+    def __init__(self, path, sync_interval=0.05):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.logger = logging.getLogger('auctionLogger')
+        self.items = ItemDictionary()
+        self.buffer = bytearray()
+        self.buffer_lock = threading.Lock()
+        self.records_appended = 0
+        self.frames_written = 0
+        self.log_file = self.open_log()
+        self.stopping = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically, name='auction-wal', daemon=True)
+        self.flusher.start()
+
+    def open_log(self):
+        """
+        Open the log for appending, a torn frame at the end of an existing
+        log is truncated and its item definitions are loaded
+            - raises ValueError if the file exists and is not a write ahead log
+        """
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            log_file = open(self.path, 'wb')
+            log_file.write(MAGIC)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+            return log_file
+        with open(self.path, 'rb') as log_file:
+            if log_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{0} is not a write ahead log'.format(self.path))
+        valid_size = len(MAGIC)
+        items = []
+        for valid_size, payload in read_frames(self.path):
+            decode_payload(payload, items)
+        self.items = ItemDictionary(items)
+        log_file = open(self.path, 'r+b')
+        if valid_size < os.path.getsize(self.path):
+            self.logger.error('Truncating torn write ahead log frame at byte %d of %s', valid_size, self.path)
+            log_file.truncate(valid_size)
+        log_file.seek(0, os.SEEK_END)
+        return log_file
+
+    def append(self, instruction):
+        """
+        Buffer an instruction, written at the next group commit
+        """
+        with self.buffer_lock:
+            buffer = self.buffer
+            if isinstance(instruction, Bid):
+                item_id = self.items.get(instruction.item)
+                if item_id is None:
+                    item_id = self.define_item(instruction.item)
+                buffer += BID_RECORD.pack(BID_TAG, instruction.timestamp, instruction.user_id, item_id,
+                                          instruction.bid_amount)
+            elif isinstance(instruction, UserListing):
+                item_id = self.items.get(instruction.item)
+                if item_id is None:
+                    item_id = self.define_item(instruction.item)
+                buffer += LISTING_RECORD.pack(LISTING_TAG, instruction.timestamp, instruction.user_id, item_id,
+                                              instruction.close_time, instruction.reserve_price)
+            else:
+                buffer += HEARTBEAT_RECORD.pack(HEARTBEAT_TAG, instruction.timestamp)
+            self.records_appended += 1
+
+    def define_item(self, item):
+        """
+        Buffer the definition of an item code, returning its id
+        """
+        item_id = self.items.encode(item)
+        encoded = item.encode('utf-8')
+        self.buffer += ITEM_RECORD.pack(ITEM_TAG, len(encoded))
+        self.buffer += encoded
+        return item_id
+
+    def flush_periodically(self):
+        while not self.stopping.wait(self.sync_interval):
+            self.commit()
+
+    def commit(self):
+        """
+        Write the buffered records as one frame and fsync it, a frame which
+        cannot be written is truncated from the log and its records kept
+        in the buffer to be retried at the next commit (later records may
+        use the items it defines)
+            - returns False if the frame could not be written
+        """
+        with self.buffer_lock:
+            payload = self.buffer
+            if not payload:
+                return True
+            self.buffer = bytearray()
+        log_file = self.log_file
+        frame_start = log_file.tell()
+        try:
+            log_file.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)))
+            log_file.write(payload)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+            self.frames_written += 1
+            return True
+        except OSError:
+            self.logger.exception('Error writing to the write ahead log %s, retrying at the next commit', self.path)
+        with self.buffer_lock:
+            self.buffer = payload + self.buffer
+        try:
+            #drop anything of the frame already written, replay would stop at the torn frame
+            log_file.seek(frame_start)
+            log_file.truncate(frame_start)
+        except (OSError, ValueError):
+            self.logger.exception('Error truncating the write ahead log %s at byte %d', self.path, frame_start)
+        return False
+
+    def close(self):
+        """
+        Stop the background commits, writing anything still buffered
+        """
+        if not self.stopping.is_set():
+            self.stopping.set()
+            self.flusher.join()
+            self.commit()
+            self.log_file.close()
+
+
+def read_frames(path):
+    """
+    Generator of the intact frames of a log
+        - yields (end, payload), the byte offset just after the frame and its payload
+    """
+    with open(path, 'rb') as log_file:
+        if os.path.getsize(path) < len(MAGIC):
+            return
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_log:
+            if mapped_log[:len(MAGIC)] != MAGIC:
+                raise ValueError('{0} is not a write ahead log'.format(path))
+            position = len(MAGIC)
+            size = len(mapped_log)
+            while position + FRAME_HEADER.size <= size:
+                length, checksum = FRAME_HEADER.unpack_from(mapped_log, position)
+                start = position + FRAME_HEADER.size
+                payload = mapped_log[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    break
+                position = start + length
+                yield position, payload
+
+
+def decode_payload(payload, items):
+    """
+    Convert the records of a frame payload into typed records
+        - items: item codes by id, extended with the items defined in the payload
+        - returns the list of records
+    """
+    records = []
+    append = records.append
+    position = 0
+    size = len(payload)
+    unpack_bid = BID_RECORD.unpack_from
+    unpack_listing = LISTING_RECORD.unpack_from
+    unpack_heartbeat = HEARTBEAT_RECORD.unpack_from
+    bid_size = BID_RECORD.size
+    listing_size = LISTING_RECORD.size
+    while position < size:
+        tag = payload[position]
+        if tag == BID_CODE:
+            _, timestamp, user_id, item_id, price = unpack_bid(payload, position)
+            position += bid_size
+            append(tuple_new(Bid, (timestamp, user_id, BID, items[item_id], price)))
+        elif tag == HEARTBEAT_CODE:
+            append(tuple_new(Heartbeat, (unpack_heartbeat(payload, position)[1],)))
+            position += HEARTBEAT_RECORD.size
+        elif tag == LISTING_CODE:
+            _, timestamp, user_id, item_id, close_time, price = unpack_listing(payload, position)
+            position += listing_size
+            append(tuple_new(UserListing, (timestamp, user_id, SELL, items[item_id], price, close_time)))
+        elif tag == ITEM_CODE:
+            _, length = ITEM_RECORD.unpack_from(payload, position)
+            position += ITEM_RECORD.size
+            items.append(sys.intern(payload[position:position + length].decode('utf-8')))
+            position += length
+        else:
+            raise ValueError('Unknown write ahead log record {0!r} at payload byte {1}'.format(tag, position))
+    return records
+
+
+def read_log(path):
+    """
+    Generator of every instruction in a log, in the order they were processed
+    """
+    items = []
+    for _, payload in read_frames(path):
+        yield from decode_payload(payload, items)
+
+
+def replay(path, server):
+    """
+    Rebuild a server's state by processing every instruction in a log
+        - returns the number of instructions replayed
+    """
+    replayed = 0
+    for instruction in read_log(path):
+        server.process_instruction(instruction)
+        replayed += 1
+    return replayed
+
+
+def format_instruction(instruction):
+    """
+    Pipe delimited input line of an instruction
+    """
+    if isinstance(instruction, Bid):
+        instruction = instruction._replace(bid_amount=format_money(instruction.bid_amount))
+    elif isinstance(instruction, UserListing):
+        instruction = instruction._replace(reserve_price=format_money(instruction.reserve_price))
+    return '|'.join(str(field) for field in instruction)
+
+
+def main():
+    from auction_v2 import Server
+
+    parser = argparse.ArgumentParser(description='Replay or dump an auction write ahead log')
+    parser.add_argument('log', type=str, help='write ahead log file')
+    parser.add_argument('--dump', action='store_true',
+                        help='print the logged instructions as input lines instead of replaying them')
+    args = parser.parse_args()
+
+    if args.dump:
+        for instruction in read_log(args.log):
+            sys.stdout.write(format_instruction(instruction) + '\n')
+        return
+    server = Server()
+    started = time.perf_counter()
+    replayed = replay(args.log, server)
+    server.logger.info('Replayed %d instructions in %.3fs', replayed, time.perf_counter() - started)
+    for auction_item in server.auction_summary_report(server.all_listed_items):
+        print(auction_item)
+
+
+if __name__ == '__main__':
+    main()
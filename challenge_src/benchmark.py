@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark harness for the auction Server.
+
+1. Generate a synthetic instruction file, tunable on
+   a. number of items listed
+   b. bids per item
+   c. heartbeat frequency
+   d. skew of bids toward hot items
+   e. share of invalid (malformed) rows
+
+2. Measure parsing, process_instruction and auction_summary_report separately
+   a. rows per second for each phase
+   b. latency per instruction type (user_listing, bid, heartbeat)
+   c. peak memory for each phase (a second pass run under tracemalloc)
+
+3. Append the results to a JSON lines file and compare them with the
+   previous run to catch regressions across releases
+"""
+# -----------------------------------------
+# Imported libraries from standard library
+# -----------------------------------------
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from auction_v2 import Server
+# -----------------------------------------
+
+MALFORMED_ROWS = ['x', '{0}|{1}|BID', '{0}|{1}|BID|unknown|ten', '{0}|{1}|SELL|bad|1.00|soon']
+
+
+def generate_instruction_file(file_name, items=1000, bids_per_item=50, heartbeat_every=10,
+                              hot_item_skew=1.0, invalid_share=0.01, auction_length=600, seed=0):
+    """
+    Write a synthetic instruction file in timestamp order
+        - items: number of listings
+        - bids_per_item: average bids per listing, total bids = items * bids_per_item
+        - heartbeat_every: seconds between heartbeats (0 for none)
+        - hot_item_skew: zipf exponent, 0 spreads bids evenly, higher values
+                         send more bids to the first (hot) items
+        - invalid_share: share of rows replaced with malformed rows
+        - auction_length: seconds each listing stays open
+    returns the number of rows written
+    """
+    rng = random.Random(seed)
+    start_time = 1549780000
+    events = []
+    listings = []
+    for item_number in range(items):
+        listed_at = start_time + item_number
+        reserve_price = rng.randint(5, 500)
+        listings.append((listed_at, reserve_price))
+        events.append((listed_at, '{0}|{1}|SELL|item_{2}|{3}.00|{4}'.format(
+            listed_at, rng.randint(1, 10000), item_number, reserve_price, listed_at + auction_length)))
+
+    weights = [1.0 / (rank + 1) ** hot_item_skew for rank in range(items)]
+    cumulative_weights = list(itertools.accumulate(weights))
+    total_weight = cumulative_weights[-1]
+    for _ in range(items * bids_per_item):
+        item_number = min(bisect.bisect(cumulative_weights, rng.random() * total_weight), items - 1)
+        listed_at, reserve_price = listings[item_number]
+        #a few bids land after the close time and are rejected by the server
+        bid_time = listed_at + rng.randint(1, auction_length + auction_length // 20)
+        amount = reserve_price * rng.uniform(0.5, 3.0)
+        events.append((bid_time, '{0}|{1}|BID|item_{2}|{3:.2f}'.format(
+            bid_time, rng.randint(1, 10000), item_number, amount)))
+
+    end_time = max(event[0] for event in events) + 1 if events else start_time
+    if heartbeat_every:
+        for heartbeat in range(start_time, end_time + heartbeat_every, heartbeat_every):
+            events.append((heartbeat, str(heartbeat)))
+    events.sort(key=lambda event: event[0])
+
+    with open(file_name, 'w') as instruction_file:
+        for timestamp, row in events:
+            if invalid_share and rng.random() < invalid_share:
+                row = rng.choice(MALFORMED_ROWS).format(timestamp, rng.randint(1, 10000))
+            instruction_file.write(row + '\n')
+    return len(events)
+
+
+def time_phases(file_name, memory_map=False):
+    """
+    Time each phase of a batch run over file_name
+        - memory_map: parse through a memory map rather than csv.reader
+        - returns (phase timings, instruction latencies, server)
+    """
+    server = Server(file_name)
+    started = time.perf_counter()
+    instruction_set = server.process_instruction_input_file(file_name, memory_map=memory_map)
+    parse_seconds = time.perf_counter() - started
+
+    latencies = {}
+    clock = time.perf_counter
+    started = clock()
+    for instruction in instruction_set:
+        instruction_started = clock()
+        server.process_instruction(instruction)
+        latencies.setdefault(type(instruction).__name__, []).append(clock() - instruction_started)
+    process_seconds = clock() - started
+
+    started = time.perf_counter()
+    summary = server.auction_summary_report(server.all_listed_items)
+    report_seconds = time.perf_counter() - started
+    phases = {'parse': (parse_seconds, len(instruction_set)),
+              'process': (process_seconds, len(instruction_set)),
+              'report': (report_seconds, len(summary))}
+    return phases, latencies, server
+
+
+def measure_peak_memory(file_name, memory_map=False):
+    """
+    Repeat a batch run under tracemalloc, recording the peak memory of each phase
+        - returns peak bytes keyed on phase
+    """
+    peaks = {}
+    server = Server(file_name)
+    tracemalloc.start()
+    try:
+        instruction_set = server.process_instruction_input_file(file_name, memory_map=memory_map)
+        peaks['parse'] = tracemalloc.get_traced_memory()[1]
+        list(map(server.process_instruction, instruction_set))
+        peaks['process'] = tracemalloc.get_traced_memory()[1]
+        server.auction_summary_report(server.all_listed_items)
+        peaks['report'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def summarise_latencies(latencies):
+    """
+    Mean, median and 99th percentile latency in microseconds per instruction type
+    """
+    summary = {}
+    for instruction_type, samples in latencies.items():
+        samples = sorted(samples)
+        count = len(samples)
+        summary[instruction_type] = {
+            'count': count,
+            'mean_us': sum(samples) / count * 1e6,
+            'p50_us': samples[count // 2] * 1e6,
+            'p99_us': samples[min(count - 1, int(count * 0.99))] * 1e6,
+        }
+    return summary
+
+
+def run_benchmark(file_name, measure_memory=True, memory_map=False):
+    """
+    Benchmark a batch run over file_name
+        - memory_map: parse through a memory map rather than csv.reader
+        - returns a dictionary of results ready to be stored
+    """
+    phases, latencies, server = time_phases(file_name, memory_map=memory_map)
+    results = {
+        'file': os.path.basename(file_name),
+        'rows': phases['parse'][1],
+        'phases': {},
+        'latency': summarise_latencies(latencies),
+    }
+    peaks = measure_peak_memory(file_name, memory_map=memory_map) if measure_memory else {}
+    for phase, (seconds, rows) in phases.items():
+        results['phases'][phase] = {
+            'seconds': seconds,
+            'rows_per_sec': rows / seconds if seconds else 0.0,
+            'peak_memory_bytes': peaks.get(phase),
+        }
+    return results
+
+
+def git_revision():
+    """
+    Current git revision of the working tree, if available
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def store_results(results, results_file, label=''):
+    """
+    Append results with run metadata to a JSON lines results file
+    """
+    record = dict(results)
+    record['label'] = label
+    record['revision'] = git_revision()
+    record['python'] = platform.python_version()
+    record['recorded_at'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    with open(results_file, 'a') as stored_results:
+        stored_results.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+
+def load_results(results_file):
+    """
+    Read every stored benchmark result
+    """
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as stored_results:
+        return [json.loads(line) for line in stored_results if line.strip()]
+
+
+def compare_results(current, previous, tolerance=0.10):
+    """
+    Compare rows per second of each phase against a previous result
+        - returns a list of regression messages, empty when within tolerance
+    """
+    regressions = []
+    for phase, stats in current['phases'].items():
+        baseline = previous.get('phases', {}).get(phase)
+        if not baseline or not baseline['rows_per_sec']:
+            continue
+        change = stats['rows_per_sec'] / baseline['rows_per_sec'] - 1
+        if change < -tolerance:
+            regressions.append('{0}: {1:,.0f} rows/sec is {2:.1%} slower than {3:,.0f} rows/sec ({4})'.format(
+                phase, stats['rows_per_sec'], -change, baseline['rows_per_sec'], previous['revision']))
+    return regressions
+
+
+def print_results(results):
+    print('{0}: {1:,} rows'.format(results['file'], results['rows']))
+    for phase, stats in results['phases'].items():
+        peak = stats['peak_memory_bytes']
+        print('  {0:<8} {1:>14,.0f} rows/sec {2:>10.3f}s  peak {3}'.format(
+            phase, stats['rows_per_sec'], stats['seconds'],
+            '{0:,.1f} MiB'.format(peak / 2 ** 20) if peak is not None else 'n/a'))
+    for instruction_type, stats in sorted(results['latency'].items()):
+        print('  {0:<13} {1:>10,} mean {2:8.2f}us  p50 {3:8.2f}us  p99 {4:8.2f}us'.format(
+            instruction_type, stats['count'], stats['mean_us'], stats['p50_us'], stats['p99_us']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the auction program on a synthetic workload')
+    parser.add_argument('--filename', type=str, default='',
+                        help='benchmark an existing instruction file instead of generating one')
+    parser.add_argument('--items', type=int, default=1000, help='number of items listed')
+    parser.add_argument('--bids-per-item', type=int, default=50, help='average bids per item')
+    parser.add_argument('--heartbeat-every', type=int, default=10, help='seconds between heartbeats')
+    parser.add_argument('--hot-item-skew', type=float, default=1.0, help='zipf exponent of bids per item')
+    parser.add_argument('--invalid-share', type=float, default=0.01, help='share of malformed rows')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generator')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--mmap', action='store_true', help='parse through a memory map rather than csv.reader')
+    parser.add_argument('--results', type=str, default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--label', type=str, default='', help='label stored with the results')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed slow down against the previous result before reporting a regression')
+    parser.add_argument('--with-logging', action='store_true',
+                        help='keep error logging for rejected rows on (off by default so it does not flood stdout)')
+    args = parser.parse_args()
+    if not args.with_logging:
+        logging.disable(logging.ERROR)
+
+    file_name = args.filename
+    if not file_name:
+        file_name = 'benchmark_input.txt'
+        generate_instruction_file(file_name, items=args.items, bids_per_item=args.bids_per_item,
+                                  heartbeat_every=args.heartbeat_every, hot_item_skew=args.hot_item_skew,
+                                  invalid_share=args.invalid_share, seed=args.seed)
+
+    results = run_benchmark(file_name, measure_memory=not args.no_memory, memory_map=args.mmap)
+    results['workload'] = {setting: getattr(args, setting) for setting in
+                           ('filename', 'items', 'bids_per_item', 'heartbeat_every',
+                            'hot_item_skew', 'invalid_share', 'seed', 'mmap')}
+    print_results(results)
+
+    #only compare against earlier runs of the same workload
+    previous_results = [previous for previous in load_results(args.results)
+                        if previous.get('workload') == results['workload']]
+    store_results(results, args.results, label=args.label)
+    if previous_results:
+        regressions = compare_results(results, previous_results[-1], tolerance=args.tolerance)
+        for regression in regressions:
+            print('REGRESSION - ' + regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
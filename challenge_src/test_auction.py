@@ -5,10 +5,38 @@ Purpose:
    This class is used to test the Auction module
 """
 
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import pickle
+import select
+import shutil
+import subprocess
+import sys
 import unittest
 from auction_v2 import Server
 from auction_listing import AuctionListing
-from decimal import Decimal as decimal
+import auction_records
+import benchmark
+import auction_sharded
+import auction_service
+import auction_settlement
+import auction_mmap
+import auction_checkpoint
+import auction_wal
+import auction_results
+import auction_metrics
+import auction_tenants
+import auction_batch
+import auction_sinks
+import auction_reorder
+import auction_snapshots
+import auction_index
+import time
+import urllib.request
 from collections import namedtuple as data_structure
 
 #variables
@@ -160,15 +188,1176 @@ class TestAuctionServer(unittest.TestCase):
         Check valid bid has been submitted
         output can be seen in the log file: thought_machine/logs
         """
+        self.auction_obj = Server(file_input, keep_bid_history=True)
         instruction_set = self.auction_obj.process_instruction_input_file(self.auction_obj.file_name)
     
         list(map(self.auction_obj.process_instruction, instruction_set))
         list_of_valid_bids = self.auction_obj.all_listed_items['toaster_1'].valid_bids  
         assert len(list_of_valid_bids) > 1, 'Expecting valid bids, list of valid bids is empty'
         assert list_of_valid_bids[0].item == 'toaster_1', 'Expected valid bids for toaster, {0} recieved'.format(list_of_valid_bids[0].item)
+
+    def test_13_process_instruction_stream(self):
+        """
+        Streaming the input file should write closed auctions as they close
+        and match the batch summary report
+        """
+        output = io.StringIO()
+        processed = self.auction_obj.process_instruction_stream(self.auction_obj.file_name, output=output)
+        assert processed == 10, 'Expecting 10 instructions streamed, got {0}'.format(processed)
+        assert self.auction_obj.instruction_list == [], 'Streaming should not hold instructions in memory'
+
+        batch_obj = Server(file_input)
+        list(map(batch_obj.process_instruction, batch_obj.process_instruction_input_file(file_input)))
+        expected = batch_obj.auction_summary_report(batch_obj.all_listed_items)
+        assert output.getvalue().splitlines() == expected, 'Streamed output does not match batch report'
+
+    def test_14_close_due_listings(self):
+        """
+        Listings close once any instruction passes their close time, even
+        without a heartbeat on the exact closing second
+        """
+        rows = [['10', '1', 'SELL', 'toaster_1', '10.00', '20'],
+                ['11', '2', 'SELL', 'tv_1', '10.00', '30'],
+                ['20', '8', 'BID', 'toaster_1', '12.50'],
+                ['25']]
+        for row in rows:
+            self.auction_obj.process_instruction(self.auction_obj.classify_instruction(row))
+
+        toaster = self.auction_obj.all_listed_items['toaster_1']
+        assert toaster.is_open == False, 'Expecting toaster_1 to be closed by the heartbeat at 25'
+        assert toaster.sale_status == 'SOLD', 'Bid on the closing second should be valid'
+        assert list(self.auction_obj.open_listings) == ['tv_1'], 'Closed listings should leave the open set'
+        assert len(self.auction_obj.close_schedule) == 1
+
+    def test_15_aggregate_only_listing(self):
+        """
+        By default listings keep running statistics rather than every bid
+        """
+        instruction_set = self.auction_obj.process_instruction_input_file(self.auction_obj.file_name)
+        list(map(self.auction_obj.process_instruction, instruction_set))
+        toaster = self.auction_obj.all_listed_items['toaster_1']
+        assert toaster.all_bids == [] and toaster.valid_bids == [], 'Bid history should be opt-in'
+        assert toaster.bid_count == 3 and toaster.valid_bid_count == 2
+        assert toaster.max_bid_amount == 2000 and toaster.min_bid_amount == 750
+        assert toaster.runner_up_bid.bid_amount == 1250
+        assert toaster.get_winning_user_id() == 8
+
+    def test_16_trace_single_item(self):
+        """
+        Tracing is off by default and can be turned on for a single item
+        """
+        assert self.auction_obj.trace_all == False, 'Per instruction tracing should be off by default'
+        self.auction_obj.enable_tracing(['tv_1'])
+        instruction_set = self.auction_obj.process_instruction_input_file(self.auction_obj.file_name)
+        with self.assertLogs('auctionLogger.trace', level='DEBUG') as trace_logs:
+            list(map(self.auction_obj.process_instruction, instruction_set))
+        assert all('toaster_1' not in message for message in trace_logs.output), 'Only tv_1 should be traced'
+        assert any('Closed listing tv_1' in message for message in trace_logs.output)
         
     
 
+    def test_17_per_user_bid_rule(self):
+        """
+        A bid only has to beat the same user's previous valid bid, the
+        winner pays the second highest valid bid
+        """
+        rows = [['10', '1', 'SELL', 'toaster_1', '10.00', '20'],
+                ['11', '5', 'BID', 'toaster_1', '30.00'],
+                ['12', '8', 'BID', 'toaster_1', '15.00'],
+                ['13', '8', 'BID', 'toaster_1', '14.00'],
+                ['14', '8', 'BID', 'toaster_1', '25.00'],
+                ['20']]
+        for row in rows:
+            self.auction_obj.process_instruction(self.auction_obj.classify_instruction(row))
+        toaster = self.auction_obj.all_listed_items['toaster_1']
+        assert toaster.valid_bid_count == 3, 'Lower bid than the same user\'s previous bid should be invalid'
+        assert toaster.get_user_best_bid(8) == 2500
+        assert self.auction_obj.format_auction_result(toaster.auction_result) == '20|toaster_1|5|SOLD|25.00|4|30.00|14.00'
+
+    def test_18_invalid_bid_counts(self):
+        """
+        Rejected bids are counted once under a single reason, overall and
+        per item, with a sample of the rejected rows kept
+        """
+        self.auction_obj.invalid_bid_sample_every = 1
+        rows = [['10', '1', 'SELL', 'toaster_1', '10.00', '20'],
+                ['11', '5', 'BID', 'toaster_1', '5.00'],
+                ['12', '5', 'BID', 'toaster_1', '15.00'],
+                ['13', '5', 'BID', 'toaster_1', '12.00'],
+                ['14', '5', 'BID', 'radio_1', '12.00'],
+                ['15', '5', 'BID', 'toaster_1'],
+                ['21', '6', 'BID', 'toaster_1', '30.00']]
+        for row in rows:
+            instruction = self.auction_obj.classify_instruction(row)
+            if instruction is not None:
+                self.auction_obj.process_instruction(instruction)
+        assert self.auction_obj.invalid_bid_counts == {'below_reserve': 1, 'not_above_previous': 1,
+                                                       'unknown_item': 1, 'malformed': 1, 'outside_window': 1}
+        assert self.auction_obj.invalid_bids_by_item() == {'toaster_1': {'below_reserve': 1, 'not_above_previous': 1,
+                                                                         'outside_window': 1}}
+        assert [reason for reason, _ in self.auction_obj.invalid_bid_samples][:2] == ['below_reserve', 'not_above_previous']
+        toaster = self.auction_obj.all_listed_items['toaster_1']
+        assert toaster.bid_count == 3 and toaster.valid_bid_count == 1, 'Rejected bids within the auction time still count'
+
+    def test_19_logging_configured_once(self):
+        """
+        Constructing a Server does not reconfigure logging, a logger can be injected
+        """
+        handlers = list(logging.getLogger('auctionLogger').handlers)
+        Server(file_input)
+        assert logging.getLogger('auctionLogger').handlers == handlers, 'Logging should only be configured once'
+        injected = logging.getLogger('auctionLogger.injected')
+        assert Server(file_input, logger=injected).logger is injected
+
+    def test_20_money_formatting(self):
+        """
+        Prices are output to two decimal places whatever form they were
+        input in, a listing without bids reports 0.00 for both bid columns
+        """
+        rows = [['10', '1', 'SELL', 'toaster_1', '10', '20'],
+                ['11', '1', 'SELL', 'lamp_1', '5.5', '20'],
+                ['12', '5', 'BID', 'toaster_1', '12.5'],
+                ['13', '8', 'BID', 'toaster_1', '15.'],
+                ['20']]
+        for row in rows:
+            self.auction_obj.process_instruction(self.auction_obj.classify_instruction(row))
+        assert self.auction_obj.auction_summary_report(self.auction_obj.all_listed_items) == \
+            ['20|toaster_1|8|SOLD|12.50|2|15.00|12.50', '20|lamp_1||UNSOLD|0.00|0|0.00|0.00']
+
+    def test_21_winner_raising_own_bid(self):
+        """
+        The winner pays the best bid of another user, never their own
+        earlier bid, and the reserve when nobody else bid
+        """
+        rows = [['10', '1', 'SELL', 'toaster_1', '10.00', '20'],
+                ['10', '1', 'SELL', 'lamp_1', '5.00', '20'],
+                ['11', '5', 'BID', 'toaster_1', '11.00'],
+                ['12', '8', 'BID', 'toaster_1', '12.00'],
+                ['13', '8', 'BID', 'toaster_1', '20.00'],
+                ['14', '5', 'BID', 'lamp_1', '6.00'],
+                ['15', '5', 'BID', 'lamp_1', '9.00'],
+                ['20']]
+        for row in rows:
+            self.auction_obj.process_instruction(self.auction_obj.classify_instruction(row))
+        assert self.auction_obj.auction_summary_report(self.auction_obj.all_listed_items) == \
+            ['20|toaster_1|8|SOLD|11.00|3|20.00|11.00', '20|lamp_1|5|SOLD|5.00|2|9.00|6.00']
+
+
+class TestAuctionRecords(unittest.TestCase):
+    """
+       TestAuctionRecords is used to test rows are parsed
+          once into typed records
+    """
+    def test_01_parse_bid(self):
+        """
+        Bid fields are converted to int on parsing, prices to minor units
+        """
+        bid = auction_records.parse_instruction(['17', '8', 'BID', 'toaster_1', '20.00'])
+        assert isinstance(bid, auction_records.Bid)
+        assert bid.timestamp == 17 and bid.user_id == 8
+        assert bid.bid_amount == 2000
+        assert [auction_records.parse_money(price) for price in ('12.5', '12.', '.5', '7', '3.100')] == [1250, 1200, 50, 700, 310]
+        assert auction_records.format_money(1250) == '12.50' and auction_records.format_money(5) == '0.05'
+
+    def test_02_parse_malformed_rows(self):
+        """
+        Malformed rows raise ValueError, including invalid or too precise prices
+        """
+        malformed_rows = [['10', '1', 'SELL', 'toaster_1', 'ten', '20'],
+                          ['10', '1', 'BID', 'toaster_1', '10.00', '20'],
+                          ['x'],
+                          ['10', '1', 'BID', 'toaster_1', '10.005'],
+                          ['10', '1', 'BID', 'toaster_1', 'NaN'],
+                          ['10', '1', 'SELL'],
+                          ['10', '99999999999999999999', 'BID', 'toaster_1', '10.00'],
+                          ['10', '1', 'BID', 'toaster_1', '999999999999999999.00'],
+                          ['10', '1', 'SELL', 'x' * 70000, '10.00', '20'],
+                          ['-9223372036854775809']]
+        for row in malformed_rows:
+            with self.assertRaises(ValueError):
+                auction_records.parse_instruction(row)
+
+    def test_03_item_dictionary(self):
+        """
+        Items get dense ids in the order first listed, which survive pickling
+        """
+        server = Server(file_input)
+        server.process_instruction_stream(file_input)
+        items = server.item_ids
+        assert items.codes == ['toaster_1', 'tv_1'] and len(items) == 2
+        assert [listing.item_id for listing in server.all_listed_items.values()] == [0, 1]
+        assert items.encode('tv_1') == 1 and items.get('lamp_1') is None
+        assert items.encode('lamp_1') == 2 and items.decode(2) == 'lamp_1'
+        restored = pickle.loads(pickle.dumps(items))
+        assert restored.codes == items.codes and restored.get('lamp_1') == 2
+
+class TestBenchmark(unittest.TestCase):
+    """
+       TestBenchmark is used to test the synthetic workload
+          generator and benchmark harness
+    """
+    def setUp(self):
+        self.file_name = 'benchmark_test_input.txt'
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def test_01_generate_and_run_benchmark(self):
+        """
+        Generated files are in timestamp order and every phase is measured
+        """
+        rows = benchmark.generate_instruction_file(self.file_name, items=20, bids_per_item=10,
+                                                   heartbeat_every=5, invalid_share=0.0)
+        with open(self.file_name) as generated:
+            timestamps = [int(line.split('|')[0]) for line in generated]
+        assert len(timestamps) == rows and timestamps == sorted(timestamps)
+
+        results = benchmark.run_benchmark(self.file_name)
+        assert set(results['phases']) == {'parse', 'process', 'report'}
+        assert results['phases']['process']['peak_memory_bytes'] > 0
+        assert results['latency']['bid']['count'] == 200
+
+    def test_02_compare_results(self):
+        """
+        A drop in rows/sec beyond the tolerance is reported as a regression
+        """
+        previous = {'phases': {'process': {'rows_per_sec': 1000.0}}, 'revision': 'abc1234'}
+        current = {'phases': {'process': {'rows_per_sec': 800.0}}}
+        regressions = benchmark.compare_results(current, previous, tolerance=0.1)
+        assert len(regressions) == 1 and regressions[0].endswith('(abc1234)'), regressions
+        assert benchmark.compare_results(current, previous, tolerance=0.25) == []
+
+class TestAuctionSharded(unittest.TestCase):
+    """
+       TestAuctionSharded is used to test the multi process
+          runner gives the same output as a single Server
+    """
+    def setUp(self):
+        self.file_name = 'sharded_test_input.txt'
+        benchmark.generate_instruction_file(self.file_name, items=50, bids_per_item=20,
+                                            heartbeat_every=3, invalid_share=0.02)
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def test_01_sharded_output_matches_stream(self):
+        """
+        Merged shard output is identical to a single process streaming run
+        """
+        for file_name in (file_input, self.file_name):
+            output = io.StringIO()
+            Server(file_name).process_instruction_stream(file_name, output=output)
+            expected = output.getvalue().splitlines()
+            result = auction_sharded.run_sharded(file_name, shards=3, batch_size=7)
+            assert result == expected, 'Sharded output differs from single process for {0}'.format(file_name)
+
+    def test_02_only_heartbeats_broadcast(self):
+        """
+        Single field rows go to every shard only when they are a valid heartbeat,
+        items are routed on their parsed value
+        """
+        assert [auction_sharded.shard_for_line(line, 3) for line in ('20\n', '"20"\n', ' 21 \r\n')] == \
+            [(None, 20), (None, 20), (None, 21)]
+        assert [auction_sharded.shard_for_line(line, 3) for line in ('x\n', '\n', '1e3\n')] == [(0, None)] * 3
+        assert auction_sharded.shard_for_line('5|1|BID|"lamp_1"|2.00\n', 3) == \
+            auction_sharded.shard_for_line('5|1|BID|lamp_1|2.00\n', 3)
+
+    def test_03_sparse_heartbeats(self):
+        """
+        A bid on one shard closes the listings due on every shard, without a heartbeat
+        """
+        with open(self.file_name, 'w') as instruction_file:
+            instruction_file.write('\n'.join(['1|1|SELL|{0}|1.00|20'.format(item) for item in 'abcdefgh'] +
+                                             ['2|2|BID|a|5.00', '21|3|BID|a|9.00']) + '\n')
+        output = io.StringIO()
+        Server(self.file_name).process_instruction_stream(self.file_name, output=output)
+        expected = output.getvalue().splitlines()
+        assert len(expected) == 8
+        for shards in (3, 4):
+            assert auction_sharded.run_sharded(self.file_name, shards=shards) == expected, shards
+
+class TestAuctionService(unittest.TestCase):
+    """
+       TestAuctionService is used to test the asyncio
+          service over loopback
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_01_results_pushed_to_subscribers(self):
+        """
+        Lines sent by several clients are processed and results are
+        pushed to a subscribed client as listings close
+        """
+        async def scenario():
+            service = auction_service.AuctionService(server=Server(), max_queued_lines=2)
+            host, port = (await service.start(host='127.0.0.1', port=0))[:2]
+            subscriber_reader, subscriber_writer = await asyncio.open_connection(host, port)
+            subscriber_writer.write(b'SUBSCRIBE\n')
+            await subscriber_writer.drain()
+            await asyncio.sleep(0.05)
+
+            with open(file_input) as instruction_file:
+                lines = instruction_file.read().splitlines()
+            sellers = [line for line in lines if '|SELL|' in line]
+            others = [line for line in lines if '|SELL|' not in line]
+            _, seller_writer = await asyncio.open_connection(host, port)
+            seller_writer.write(('\n'.join(sellers) + '\n').encode())
+            await seller_writer.drain()
+            await asyncio.sleep(0.05)
+            _, bidder_writer = await asyncio.open_connection(host, port)
+            bidder_writer.write(('\n'.join(others) + '\n').encode())
+            await bidder_writer.drain()
+
+            results = [await asyncio.wait_for(subscriber_reader.readline(), 5) for _ in range(2)]
+            seller_writer.close()
+            bidder_writer.close()
+            await service.stop()
+            return [result.decode().strip() for result in results]
+
+        results = self.loop.run_until_complete(scenario())
+        assert results == ['20|toaster_1|8|SOLD|12.50|3|20.00|7.50',
+                           '20|tv_1||UNSOLD|0.00|2|200.00|150.00'], results
+
+    def test_02_stop_with_clients_connected(self):
+        """
+        Stopping processes the queued lines then disconnects a subscriber
+        and a client which are still connected, rather than waiting for them
+        """
+        async def scenario():
+            service = auction_service.AuctionService(server=Server())
+            host, port = (await service.start(host='127.0.0.1', port=0))[:2]
+            subscriber_reader, subscriber_writer = await asyncio.open_connection(host, port)
+            subscriber_writer.write(b'SUBSCRIBE\n')
+            await subscriber_writer.drain()
+            client_reader, client_writer = await asyncio.open_connection(host, port)
+            client_writer.write(b'10|1|SELL|lamp_1|5.00|20\n12|2|BID|lamp_1|8.00\n')
+            await client_writer.drain()
+            await asyncio.sleep(0.05)
+            await asyncio.wait_for(service.stop(), 5)
+            pushed = await asyncio.wait_for(subscriber_reader.read(), 5)
+            client_closed = await asyncio.wait_for(client_reader.read(), 5)
+            subscriber_writer.close()
+            client_writer.close()
+            return service.lines_processed, pushed, client_closed
+
+        lines_processed, pushed, client_closed = self.loop.run_until_complete(scenario())
+        assert lines_processed == 2, lines_processed
+        assert pushed == b'' and client_closed == b'', (pushed, client_closed)
+
+@unittest.skipIf(auction_settlement.np is None, 'numpy is not installed')
+class TestAuctionSettlement(unittest.TestCase):
+    """
+       TestAuctionSettlement is used to test the vectorised batch
+          settlement gives the same report as the Server
+    """
+    def setUp(self):
+        self.file_name = 'settlement_test_input.txt'
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def expected_report(self, file_name):
+        server = Server(file_name)
+        server.process_instruction_stream(file_name)
+        return server.auction_summary_report(server.all_listed_items)
+
+    def test_01_settlement_matches_server(self):
+        """
+        Settled report is identical to the Server report, including open listings
+        """
+        benchmark.generate_instruction_file(self.file_name, items=50, bids_per_item=20, heartbeat_every=7,
+                                            invalid_share=0.05, auction_length=40)
+        for file_name in (file_input, self.file_name):
+            assert auction_settlement.settle_file(file_name) == self.expected_report(file_name), file_name
+
+    def test_02_relisted_and_out_of_order(self):
+        """
+        Relisted items, bids on closed listings and out of order timestamps settle as the Server does
+        """
+        with open(self.file_name, 'w') as instruction_file:
+            instruction_file.write('\n'.join([
+                '10|1|SELL|lamp_1|5.00|20',
+                '12|2|BID|lamp_1|8.00',
+                '15|3|BID|lamp_1|9.50',
+                '15|2|BID|lamp_1|7.00',
+                '21|4|BID|lamp_1|30.00',
+                '22|1|SELL|lamp_1|1.00|21',
+                '18|5|BID|lamp_1|2.00',
+                '23',
+                '24|1|SELL|lamp_1|2.00|40',
+                '25|6|BID|lamp_1|3.50',
+            ]) + '\n')
+        report = auction_settlement.settle_file(self.file_name)
+        assert report == self.expected_report(self.file_name), report
+
+    def test_03_winner_raising_own_bid(self):
+        """
+        The runner up comes from another user, as with the Server
+        """
+        with open(self.file_name, 'w') as instruction_file:
+            instruction_file.write('\n'.join([
+                '10|1|SELL|toaster_1|10.00|20',
+                '10|1|SELL|lamp_1|5.00|20',
+                '11|5|BID|toaster_1|11.00',
+                '12|8|BID|toaster_1|12.00',
+                '13|8|BID|toaster_1|20.00',
+                '14|5|BID|lamp_1|6.00',
+                '15|5|BID|lamp_1|9.00',
+                '20',
+            ]) + '\n')
+        report = auction_settlement.settle_file(self.file_name)
+        assert report == ['20|toaster_1|8|SOLD|11.00|3|20.00|11.00', '20|lamp_1|5|SOLD|5.00|2|9.00|6.00'], report
+        assert report == self.expected_report(self.file_name)
+
+    def test_04_rows_parsed_in_python(self):
+        """
+        Rows outside the plain form and listings closing before they are listed settle as the Server does,
+        whatever the block size
+        """
+        with open(self.file_name, 'wb') as instruction_file:
+            instruction_file.write(b'\r\n'.join([
+                b'10|1|SELL|toaster_1|10.00|20', b'', b'11|2|BID|toaster_1|NaN', b'"12"|3|BID|toaster_1|12.5',
+                b'13| 4 |BID|toaster_1|+14', b'14|5|BID|caf\xc3\xa9_1|9.00\r15', b'15|1|SELL|caf\xc3\xa9_1|1.00|9',
+                b'16|6|BID|' + b'x' * 80 + b'|5.00', b'17|1|SELL|' + b'x' * 80 + b'|1.00|30',
+                b'18|7|BID|caf\xc3\xa9_1|2.00', b'19|8|BID|tv_1|99999999999999999999', b'21']))
+        expected = self.expected_report(self.file_name)
+        for block_size in (1, 7, auction_mmap.CHUNK_SIZE):
+            settlement = auction_settlement.load_columns(self.file_name, block_size=block_size)
+            report = auction_settlement.summary_report(settlement, auction_settlement.settle(settlement))
+            assert report == expected, (block_size, report)
+
+    def test_05_first_at_least(self):
+        """
+        The segment tree search finds the first value of at least each limit from each start
+        """
+        values = auction_settlement.np.array([3, 1, 4, 1, 5, 9, 2, 6, 5], dtype='int64')
+        starts = auction_settlement.np.array([0, 1, 2, 6, 6, 8, 9, 0], dtype='int64')
+        limits = auction_settlement.np.array([4, 2, 9, 6, 7, 5, 0, 10], dtype='int64')
+        found = auction_settlement.first_at_least(values, starts, limits)
+        assert found.tolist() == [2, 2, 5, 7, 9, 8, 9, 9], found
+
+class TestAuctionMmap(unittest.TestCase):
+    """
+       TestAuctionMmap is used to test the memory mapped reader
+          accepts and rejects the same rows as csv.reader
+    """
+    def setUp(self):
+        self.file_name = 'mmap_test_input.txt'
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+    def csv_instructions(self, file_name):
+        with open(file_name, newline='') as csvfile:
+            instructions = map(auction_mmap.classify_row, csv.reader(csvfile, delimiter='|'))
+            return [instruction for instruction in instructions if instruction is not None]
+
+    def test_01_same_rows_as_csv(self):
+        """
+        Malformed rows, quotes, blank lines and carriage returns give the same records as csv.reader
+        """
+        with open(self.file_name, 'wb') as instruction_file:
+            instruction_file.write(b'\r\n'.join([
+                b'10|1|SELL|toaster_1|10.00|20', b'', b'   ', b'11|2|BID|toaster_1|NaN',
+                b'12|2|BID|toaster_1|1e1', b'"13"|3|BID|toaster_1|12.50', b'14|4|BUY|toaster_1|5',
+                b'15|x|BID|toaster_1|5', b'16| 5 |BID|toaster_1| 13.00 ', b'17|1|SELL|tv_1|1.00|20|',
+                b'18|6|BID|caf\xc3\xa9_1|9.00\r19', b'20', b'21|99999999999999999999|BID|toaster_1|5.00',
+                b'22|7|BID|' + b'x' * 70000 + b'|5.00']))
+        expected = self.csv_instructions(self.file_name)
+        assert len(expected) == 6, 'Expecting NaN and exponent prices to be rejected'
+        for chunk_size in (1, 7, auction_mmap.CHUNK_SIZE):
+            result = list(auction_mmap.read_mapped_instructions(self.file_name, chunk_size=chunk_size))
+            assert result == expected, chunk_size
+        assert result[0].item is result[2].item, 'Expecting item codes to be interned'
+
+    def test_02_empty_file_and_server_stream(self):
+        """
+        Empty files give no instructions, a mapped stream matches the csv stream
+        """
+        open(self.file_name, 'w').close()
+        assert list(auction_mmap.read_mapped_instructions(self.file_name)) == []
+        outputs = []
+        for memory_map in (False, True):
+            output = io.StringIO()
+            Server(file_input).process_instruction_stream(file_input, output=output, memory_map=memory_map)
+            outputs.append(output.getvalue())
+        assert outputs[0] == outputs[1] and outputs[1], outputs
+
+class TestAuctionCheckpoint(unittest.TestCase):
+    """
+       TestAuctionCheckpoint is used to test a run resumed from a
+          snapshot gives the same report as an uninterrupted run
+    """
+    def setUp(self):
+        self.file_name = 'checkpoint_test_input.txt'
+        self.checkpoint_dir = 'checkpoint_test'
+        benchmark.generate_instruction_file(self.file_name, items=40, bids_per_item=10, heartbeat_every=5,
+                                            invalid_share=0.02, auction_length=30)
+
+    def tearDown(self):
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+
+    def test_01_resume_after_failure(self):
+        """
+        Fail part way through, resuming from the latest snapshot completes the same report
+        """
+        expected = Server(self.file_name)
+        expected.process_instruction_stream(self.file_name)
+
+        failing = Server(self.file_name)
+        process_instruction = failing.process_instruction
+        processed = []
+        def fail_part_way(instruction):
+            processed.append(instruction)
+            if len(processed) == 300:
+                raise KeyboardInterrupt
+            process_instruction(instruction)
+        failing.process_instruction = fail_part_way
+        with self.assertRaises(KeyboardInterrupt):
+            auction_checkpoint.process_with_checkpoints(failing, self.file_name, self.checkpoint_dir,
+                                                        checkpoint_every=50, chunk_size=500)
+
+        resumed = Server(self.file_name)
+        checkpointer = auction_checkpoint.process_with_checkpoints(resumed, self.file_name, self.checkpoint_dir,
+                                                                   checkpoint_every=50, chunk_size=500, resume=True)
+        assert 0 < checkpointer.processed < 300, 'Expecting to resume part way through the file'
+        assert resumed.auction_summary_report(resumed.all_listed_items) == \
+            expected.auction_summary_report(expected.all_listed_items)
+        assert resumed.invalid_bid_counts == expected.invalid_bid_counts
+
+    def test_02_snapshots_hold_changed_listings(self):
+        """
+        Each snapshot pickles only the listings changed since the previous one
+        """
+        server = Server(self.file_name)
+        checkpointer = auction_checkpoint.Checkpointer(server, self.checkpoint_dir, self.file_name)
+        checkpointer.start()
+        server.process_instruction(auction_records.UserListing(10, 1, 'SELL', 'toaster_1', 1000, 20))
+        server.process_instruction(auction_records.UserListing(10, 1, 'SELL', 'tv_1', 1000, 30))
+        assert checkpointer.snapshot(100, 2)
+        checkpointer.stop()
+        assert checkpointer.start(resume=True) == 100
+        server.process_instruction(auction_records.Bid(12, 2, 'BID', 'tv_1', 1500))
+        assert server.changed_listings == {server.all_listed_items['tv_1']}
+        assert checkpointer.snapshot(200, 3)
+        checkpointer.stop()
+
+        resumed = Server(self.file_name)
+        offset = auction_checkpoint.Checkpointer(resumed, self.checkpoint_dir, self.file_name).restore()
+        assert offset == 200 and resumed.all_listed_items['tv_1'].valid_bid_count == 1
+        assert [listing.item_name for _, _, listing in sorted(resumed.close_schedule)] == ['toaster_1', 'tv_1']
+
+class TestAuctionWal(unittest.TestCase):
+    """
+       TestAuctionWal is used to test the write ahead log
+          replays to the same state as the original run
+    """
+    def setUp(self):
+        self.log_file = 'wal_test.log'
+
+    def tearDown(self):
+        if os.path.exists(self.log_file):
+            os.remove(self.log_file)
+
+    def test_01_replay_rebuilds_listings(self):
+        """
+        Every processed instruction is logged and replaying the log gives the same report
+        """
+        server = Server(file_input)
+        server.wal = auction_wal.WriteAheadLog(self.log_file, sync_interval=0.01)
+        server.process_instruction_stream(file_input)
+        server.wal.close()
+        assert list(auction_wal.read_log(self.log_file)) == list(server.stream_instructions(file_input))
+
+        replayed = Server()
+        assert auction_wal.replay(self.log_file, replayed) == 10
+        assert replayed.auction_summary_report(replayed.all_listed_items) == \
+            server.auction_summary_report(server.all_listed_items)
+
+    def test_02_torn_frame_truncated(self):
+        """
+        A partly written frame is ignored on replay and truncated when the log is reopened
+        """
+        instructions = list(Server(file_input).stream_instructions(file_input))
+        wal = auction_wal.WriteAheadLog(self.log_file)
+        for instruction in instructions[:4]:
+            wal.append(instruction)
+        wal.close()
+        with open(self.log_file, 'ab') as log_file:
+            log_file.write(auction_wal.FRAME_HEADER.pack(100, 0) + b'BX')
+        assert list(auction_wal.read_log(self.log_file)) == instructions[:4]
+
+        wal = auction_wal.WriteAheadLog(self.log_file)
+        for instruction in instructions[4:]:
+            wal.append(instruction)
+        wal.close()
+        assert list(auction_wal.read_log(self.log_file)) == instructions
+
+    def test_03_out_of_range_rows_rejected(self):
+        """
+        Rows too wide for the log records are rejected as malformed rather than failing the run
+        """
+        input_file = self.log_file + '.txt'
+        with open(input_file, 'w') as instruction_file:
+            instruction_file.write('10|1|SELL|lamp_1|5.00|20\n11|99999999999999999999|BID|lamp_1|6.00\n'
+                                   '12|2|SELL|' + 'x' * 70000 + '|5.00|20\n13|2|BID|lamp_1|6.00\n20\n')
+        server = Server()
+        server.wal = auction_wal.WriteAheadLog(self.log_file)
+        output = io.StringIO()
+        try:
+            server.process_instruction_stream(input_file, output=output)
+        finally:
+            server.wal.close()
+            os.remove(input_file)
+        assert output.getvalue() == '20|lamp_1|2|SOLD|5.00|1|6.00|6.00\n', output.getvalue()
+        assert len(list(auction_wal.read_log(self.log_file))) == 3
+
+    def test_04_failed_commit_retried(self):
+        """
+        A frame which cannot be written is truncated and retried with its item definitions,
+        a file which is not a log is not overwritten
+        """
+        class FailingFile:
+            def __init__(self, log_file):
+                self.log_file = log_file
+                self.failures = 1
+            def write(self, data):
+                self.log_file.write(data[:3])
+                if self.failures:
+                    self.failures -= 1
+                    raise OSError('No space left on device')
+                return self.log_file.write(data[3:])
+            def __getattr__(self, name):
+                return getattr(self.log_file, name)
+
+        instructions = list(Server(file_input).stream_instructions(file_input))
+        wal = auction_wal.WriteAheadLog(self.log_file, sync_interval=60)
+        wal.log_file = FailingFile(wal.log_file)
+        for instruction in instructions[:4]:
+            wal.append(instruction)
+        assert not wal.commit()
+        for instruction in instructions[4:]:
+            wal.append(instruction)
+        wal.close()
+        assert list(auction_wal.read_log(self.log_file)) == instructions
+
+        with open(self.log_file, 'wb') as log_file:
+            log_file.write(b'AUC')
+        with self.assertRaises(ValueError):
+            auction_wal.WriteAheadLog(self.log_file)
+        with open(self.log_file, 'rb') as log_file:
+            assert log_file.read() == b'AUC'
+
+class TestAuctionResults(unittest.TestCase):
+    """
+       TestAuctionResults is used to test closed listings retired
+          to the results store
+    """
+    def test_01_closed_listings_retired(self):
+        """
+        Only open listings stay in memory, the complete report matches a run without retiring
+        """
+        expected = Server(file_input)
+        expected.process_instruction_stream(file_input)
+
+        server = Server(file_input)
+        server.results_store = auction_results.ResultsStore(':memory:')
+        rows = [['21', '3', 'BID', 'toaster_1', '30.00'],
+                ['22', '1', 'SELL', 'toaster_1', '5.00', '40'],
+                ['23', '4', 'BID', 'toaster_1', '6.00']]
+        instructions = list(server.stream_instructions(file_input)) + [server.classify_instruction(row) for row in rows]
+        list(map(server.process_instruction, instructions[:10]))
+        assert server.all_listed_items == {}, 'Expecting closed listings to be retired'
+        assert server.complete_summary_report() == expected.auction_summary_report(expected.all_listed_items)
+        assert server.results_store.results_for_item('toaster_1')[0].price_paid == '12.50'
+
+        list(map(server.process_instruction, instructions[10:]))
+        assert server.invalid_bid_counts['outside_window'] == expected.invalid_bid_counts['outside_window'] + 1, \
+            'Expecting a bid on a retired listing to be rejected as closed'
+        assert list(server.all_listed_items) == ['toaster_1']
+        assert server.complete_summary_report() == ['40|toaster_1|4|UNSOLD||1||',
+                                                    '20|tv_1||UNSOLD|0.00|2|200.00|150.00']
+
+
+class TestAuctionMetrics(unittest.TestCase):
+    """
+       TestAuctionMetrics is used to test the processing loop
+          instrumentation and its metrics endpoint
+    """
+    def test_01_instrumented_server(self):
+        """
+        Timings are recorded per instruction type and stage without changing the output
+        """
+        server = Server(file_input)
+        metrics = auction_metrics.Metrics(server, sample_every=1).instrument()
+        list(map(server.process_instruction, server.process_instruction_input_file(file_input)))
+        expected = Server(file_input)
+        expected.process_instruction_stream(file_input)
+        assert server.complete_summary_report() == expected.auction_summary_report(expected.all_listed_items)
+
+        assert metrics.instructions_processed() == 10 and metrics.instructions_processed('bid') == 6
+        assert metrics.instruction_latency['bid'].count == 6
+        assert metrics.stage_latency['close_listing'].count == 2
+        assert metrics.stage_latency['data_classification'].count == 10
+        assert metrics.stage_latency['valid_bid_check'].count == 5, 'Expecting bids on open listings to be validated'
+        assert metrics.stage_latency['auction_summary_report'].count == 1
+        address = metrics.serve(0)
+        try:
+            with urllib.request.urlopen('http://{0}:{1}/metrics'.format(*address)) as response:
+                body = response.read().decode('utf-8')
+        finally:
+            metrics.stop()
+        assert 'auction_instructions_total{type="bid"} 6' in body
+        assert 'auction_instruction_seconds_count{type="bid"} 6' in body
+        assert 'auction_open_listings 0' in body
+        assert 'auction_item_dictionary_size 2' in body
+        assert 'auction_instruction_seconds_bucket{type="heartbeat",le="+Inf"} 2' in body
+
+    def test_02_streamed_classification_timed(self):
+        """
+        Rows classified while streaming, through csv.reader or a memory map, are timed too
+        """
+        for memory_map in (False, True):
+            server = Server(file_input)
+            metrics = auction_metrics.Metrics(server, sample_every=1).instrument()
+            assert server.process_instruction_stream(file_input, memory_map=memory_map) == 10
+            assert metrics.stage_latency['data_classification'].count == 10, memory_map
+
+    def test_03_sampling_profiler(self):
+        """
+        The profiler samples the stack of another thread
+        """
+        profiler = auction_metrics.SamplingProfiler(auction_metrics.threading.get_ident(), interval=0.001).start()
+        finish = time.perf_counter() + 0.1
+        while time.perf_counter() < finish or profiler.samples == 0:
+            pass
+        profiler.stop()
+        assert 'test_auction.py:test_03_sampling_profiler' in profiler.collapsed()
+
+
+class TestAuctionTenants(unittest.TestCase):
+    """
+       TestAuctionTenants is used to test tenants hosted in one
+          engine are isolated and scheduled fairly
+    """
+    def test_01_tenants_isolated(self):
+        """
+        Interleaved tenants give the same reports as separate servers
+        """
+        engine = auction_tenants.TenantEngine(quantum=3)
+        assert engine.process_file('input_tenants.txt') == 22
+        for tenant, file_name in (('market_a', 'input.txt'), ('market_b', 'input_2.txt')):
+            expected = Server(file_name)
+            expected.process_instruction_stream(file_name)
+            assert engine.servers[tenant].complete_summary_report() == \
+                expected.auction_summary_report(expected.all_listed_items)
+        assert engine.servers['market_a'].logger is engine.servers['market_b'].logger
+
+    def test_02_fair_scheduling(self):
+        """
+        A busy tenant does not hold up a quiet one, weights share out the rounds
+        """
+        engine = auction_tenants.TenantEngine(quantum=5, max_pending=100)
+        for timestamp in range(100):
+            assert engine.submit_line('busy|{0}'.format(timestamp))
+        assert not engine.submit_line('busy|100'), 'Expecting the full queue to be refused'
+        for timestamp in range(8):
+            engine.submit_line('quiet|{0}'.format(timestamp))
+        engine.set_weight('heavy', 2)
+        for timestamp in range(20):
+            engine.submit_line('heavy|{0}'.format(timestamp))
+        assert engine.run_round() == 5 + 5 + 10
+        assert [len(engine.pending[tenant]) for tenant in ('busy', 'quiet', 'heavy')] == [95, 3, 10]
+        engine.run_round()
+        assert len(engine.pending['quiet']) == 0 and engine.deficits['quiet'] == 0
+        assert engine.run() == 90
+
+    def test_03_weight_must_be_positive(self):
+        """
+        A weight or quantum which would never drain a queue is refused
+        """
+        engine = auction_tenants.TenantEngine(quantum=5)
+        for weight in (0, -1):
+            with self.assertRaises(ValueError):
+                engine.set_weight('idle', weight)
+        assert 'idle' not in engine.weights
+        with self.assertRaises(ValueError):
+            auction_tenants.TenantEngine(quantum=0)
+
+
+class TestAuctionBatch(unittest.TestCase):
+    """
+       TestAuctionBatch is used to test many files are processed
+          independently or as one merged stream
+    """
+    def setUp(self):
+        self.output_dir = 'batch_test_output'
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def expected_report(self, file_name):
+        server = Server(file_name)
+        server.process_instruction_stream(file_name)
+        return server.auction_summary_report(server.all_listed_items)
+
+    def test_01_independent_files(self):
+        """
+        Each file gets its own report, the same as running it alone
+        """
+        files = auction_batch.expand_inputs(['input_2.txt', 'input.tx?', 'input.txt'])
+        assert files == ['input_2.txt', 'input.txt']
+        runs = auction_batch.run_files(files, self.output_dir, workers=2)
+        assert [(name, processed) for name, processed, _ in runs] == [('input_2.txt', 12), ('input.txt', 10)]
+        for file_name, output_file in zip(files, auction_batch.results_files(files, self.output_dir)):
+            with open(output_file) as results:
+                assert results.read().splitlines() == self.expected_report(file_name)
+
+    def test_02_merged_files(self):
+        """
+        Timestamp ordered files merged into one stream give the report of the combined file
+        """
+        os.makedirs(self.output_dir)
+        with open(file_input) as instruction_file:
+            rows = instruction_file.read().splitlines()
+        regions = {'region_a.txt': [row for row in rows if 'tv_1' not in row],
+                   'region_b.txt': [row for row in rows if 'tv_1' in row or '|' not in row]}
+        for name, region_rows in regions.items():
+            with open(os.path.join(self.output_dir, name), 'w') as region_file:
+                region_file.write('\n'.join(region_rows) + '\n')
+        files = auction_batch.expand_inputs([self.output_dir])
+        merged = os.path.join(self.output_dir, 'merged.results')
+        name, processed, _ = auction_batch.run_merged(files, merged)
+        assert processed == 12, 'Expecting the heartbeats in both files to be processed'
+        with open(merged) as results:
+            assert results.read().splitlines() == self.expected_report(file_input)
+
+    def test_03_same_named_files(self):
+        """
+        Same named files in different directories get their own reports
+        """
+        inputs = os.path.join(self.output_dir, 'inputs')
+        for region in ('us', 'eu'):
+            os.makedirs(os.path.join(inputs, region))
+        shutil.copy(file_input, os.path.join(inputs, 'us', 'hour01.txt'))
+        shutil.copy('input_2.txt', os.path.join(inputs, 'eu', 'hour01.txt'))
+        files = auction_batch.expand_inputs([os.path.join(inputs, 'us'), os.path.join(inputs, 'eu')])
+        output_files = auction_batch.results_files(files, self.output_dir)
+        assert output_files == [os.path.join(self.output_dir, 'us', 'hour01.txt.results'),
+                                os.path.join(self.output_dir, 'eu', 'hour01.txt.results')], output_files
+        auction_batch.run_files(files, self.output_dir, workers=2)
+        for file_name, output_file in zip(files, output_files):
+            with open(output_file) as results:
+                assert results.read().splitlines() == self.expected_report(file_name)
+
+
+class TestAuctionSinks(unittest.TestCase):
+    """
+       TestAuctionSinks is used to test closed auctions are written
+          through a buffered result sink in each format
+    """
+    def setUp(self):
+        self.output_dir = 'sink_test_output'
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+    def closed_results(self):
+        server = Server(file_input)
+        server.process_instruction_stream(file_input)
+        return server.complete_summary_results()
+
+    def test_01_formats(self):
+        """
+        Pipe output matches the summary report, binary records read back unchanged
+        """
+        results = self.closed_results()
+        output = io.StringIO()
+        sink = auction_sinks.open_sink(stream=output, flush_every=1)
+        sink.add_all(results)
+        assert output.getvalue().splitlines() == ['20|toaster_1|8|SOLD|12.50|3|20.00|7.50',
+                                                  '20|tv_1||UNSOLD|0.00|2|200.00|150.00']
+        json_file = os.path.join(self.output_dir, 'results.jsonl')
+        sink = auction_sinks.open_sink(json_file, 'jsonl')
+        sink.add_all(results)
+        sink.close()
+        with open(json_file) as json_lines:
+            assert [json.loads(line) for line in json_lines] == [result._asdict() for result in results]
+        binary_file = os.path.join(self.output_dir, 'results.bin')
+        sink = auction_sinks.open_sink(binary_file, 'binary')
+        sink.add_all(results)
+        sink.close()
+        with open(binary_file, 'rb') as binary_results:
+            assert list(auction_sinks.read_binary_results(binary_results)) == results
+        server = Server(file_input)
+        server.process_instruction_stream(file_input)
+        assert [auction_sinks.encode_binary_listing(listing) for listing in server.all_listed_items.values()] == \
+            [auction_sinks.encode_binary(result) for result in results]
+        #a negative user id and the leading user of a listing still open survive the round trip
+        edge_results = [results[0]._replace(user_id=-1), results[1]._replace(user_id=5)]
+        encoded = io.BytesIO(b''.join(auction_sinks.encode_binary(result) for result in edge_results))
+        assert list(auction_sinks.read_binary_results(encoded)) == edge_results
+
+    def test_02_buffering_and_rotation(self):
+        """
+        Results are only written when the buffer is due, rotated files never split a record
+        """
+        result = self.closed_results()[0]
+        record = auction_sinks.encode_pipe(result)
+        output_file = os.path.join(self.output_dir, 'results.txt')
+        sink = auction_sinks.open_sink(output_file, flush_every=3)
+        sink.add_all([result] * 2)
+        assert os.path.getsize(output_file) == 0
+        sink.add(result)
+        assert os.path.getsize(output_file) == 3 * len(record)
+        sink.close()
+        sink = auction_sinks.open_sink(output_file, rotate_bytes=2 * len(record) + 1, rotate_count=2)
+        sink.add_all([result] * 7)
+        sink.close()
+        sizes = [os.path.getsize(output_file + suffix) for suffix in ('', '.1', '.2')]
+        assert sizes == [len(record), 2 * len(record), 2 * len(record)]
+        assert not os.path.exists(output_file + '.3')
+
+    def test_03_flush_interval(self):
+        """
+        Buffered results are written once flush_interval has passed, without waiting for another result
+        """
+        result = self.closed_results()[0]
+        output_file = os.path.join(self.output_dir, 'results.txt')
+        sink = auction_sinks.open_sink(output_file, flush_interval=0.05)
+        #the flusher cannot write while the lock is held, however long this takes
+        with sink.lock:
+            sink.add(result)
+            assert os.path.getsize(output_file) == 0
+        deadline = time.monotonic() + 5
+        while not os.path.getsize(output_file) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sink.results_written == 1 and os.path.getsize(output_file) == len(auction_sinks.encode_pipe(result))
+        sink.close()
+        assert sink.flusher_thread is None
+
+    @unittest.skipIf(not hasattr(os, 'mkfifo'), 'named pipes are not supported')
+    def test_04_stream_result_before_end_of_input(self):
+        """
+        Streaming to stdout prints each result as its auction closes, not at the end of input
+        """
+        fifo = os.path.join(self.output_dir, 'instructions.fifo')
+        os.mkfifo(fifo)
+        process = subprocess.Popen([sys.executable, 'auction_v2.py', '--stream', '--filename', fifo],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            with open(fifo, 'w') as instructions:
+                instructions.write('10|1|SELL|lamp_1|5.00|20\n12|2|BID|lamp_1|8.00\n21\n')
+                instructions.flush()
+                lines = []
+                deadline = time.monotonic() + 10
+                while '20|lamp_1|2|SOLD|5.00|1|8.00|8.00' not in lines and time.monotonic() < deadline:
+                    if select.select([process.stdout], [], [], 0.1)[0]:
+                        lines.append(process.stdout.readline().decode().strip())
+                assert process.poll() is None, 'Expecting the input to still be open'
+                assert '20|lamp_1|2|SOLD|5.00|1|8.00|8.00' in lines, lines
+        finally:
+            process.stdout.close()
+            process.wait(10)
+
+
+class TestAuctionReorder(unittest.TestCase):
+    """
+       TestAuctionReorder is used to test out of order input is put back
+          in timestamp order before it is processed
+    """
+    def setUp(self):
+        self.expected = Server(file_input)
+        self.instructions = list(self.expected.stream_instructions(file_input))
+        list(map(self.expected.process_instruction, self.instructions))
+
+    def test_01_reordered_within_lateness(self):
+        """
+        Rows swapped by up to the lateness give the report of the ordered file
+        """
+        shuffled = list(self.instructions)
+        shuffled[2], shuffled[4] = shuffled[4], shuffled[2]
+        shuffled[7], shuffled[8] = shuffled[8], shuffled[7]
+        assert [row.timestamp for row in shuffled] != sorted(row.timestamp for row in shuffled)
+        server = Server(file_input)
+        reorder_buffer = auction_reorder.ReorderBuffer(server, lateness=5)
+        assert reorder_buffer.process(shuffled) == len(shuffled)
+        assert reorder_buffer.late == 0 and reorder_buffer.buffered == 0
+        assert server.auction_summary_report(server.all_listed_items) == \
+            self.expected.auction_summary_report(self.expected.all_listed_items)
+
+    def test_02_watermark_closes_and_drops_late(self):
+        """
+        Listings close once the watermark passes close time, later rows for them are dropped
+        """
+        server = Server(file_input)
+        metrics = auction_metrics.Metrics(server).instrument()
+        reorder_buffer = metrics.reorder_buffer = auction_reorder.ReorderBuffer(server, lateness=3)
+        for instruction in self.instructions:
+            if instruction.timestamp <= 12:
+                reorder_buffer.push(instruction)
+        assert reorder_buffer.watermark == 9
+        assert reorder_buffer.buffered == 2 and 'toaster_1' not in server.all_listed_items
+        reorder_buffer.push(auction_records.Heartbeat(timestamp=16))
+        assert server.all_listed_items['toaster_1'].is_open
+        reorder_buffer.push(auction_records.Heartbeat(timestamp=24))
+        assert not server.all_listed_items['toaster_1'].is_open, 'Expecting the watermark 21 to close toaster_1'
+        assert not reorder_buffer.push(auction_records.parse_instruction(['19', '3', 'BID', 'toaster_1', '30.00']))
+        assert reorder_buffer.late == 1
+        assert 'auction_reorder_late_total 1' in metrics.render()
+
+    def test_03_max_buffered_bound(self):
+        """
+        A full buffer releases its earliest second even when the watermark is already there
+        """
+        server = Server(file_input)
+        reorder_buffer = auction_reorder.ReorderBuffer(server, lateness=0, max_buffered=5)
+        server.process_instruction(auction_records.parse_instruction(['10', '1', 'SELL', 'lamp_1', '5.00', '40']))
+        for user_id in range(20):
+            reorder_buffer.push(auction_records.parse_instruction(['12', str(user_id), 'BID', 'lamp_1', '6.00']))
+            assert reorder_buffer.buffered <= 5, reorder_buffer.buffered
+        reorder_buffer.flush()
+        assert reorder_buffer.released == 20 and server.all_listed_items['lamp_1'].bid_count == 20
+
+
+class TestAuctionSnapshots(unittest.TestCase):
+    """
+       TestAuctionSnapshots is used to test open auctions are published
+          to shared memory and read back consistently
+    """
+    def setUp(self):
+        self.server = Server(file_input)
+        self.publisher = auction_snapshots.SnapshotPublisher(self.server, capacity=1)
+
+    def tearDown(self):
+        self.publisher.close()
+
+    def test_01_publish_open_auctions(self):
+        """
+        Readers see the open listings as of the last publish, closing soonest first when over capacity
+        """
+        reader = auction_snapshots.SnapshotReader(self.publisher.name)
+        assert reader.read().auctions == []
+        for instruction in self.server.stream_instructions(file_input):
+            if instruction.timestamp > 17:
+                break
+            self.server.process_instruction(instruction)
+        assert self.publisher.publish() == 1
+        snapshot = reader.read()
+        assert snapshot.event_time == 17 and snapshot.open_count == 2
+        assert snapshot.auctions == [auction_snapshots.OpenAuction(item='toaster_1', item_id=0, seller=1, close_time=20,
+                                                                   time_to_close=3, highest_bid=2000, leading_bid=2000,
+                                                                   bid_count=3, valid_bid_count=2)]
+        reader.close()
+
+    def test_02_torn_snapshot_not_read(self):
+        """
+        A snapshot being written (odd sequence) is never returned
+        """
+        reader = auction_snapshots.SnapshotReader(self.publisher.name)
+        auction_snapshots.SEQUENCE.pack_into(self.publisher.block.buf, auction_snapshots.SEQUENCE_OFFSET, 1)
+        with self.assertRaises(RuntimeError):
+            reader.read(retries=3)
+        self.publisher.publish()
+        assert reader.read().sequence == 2
+        reader.close()
+
+
+class TestAuctionIndex(unittest.TestCase):
+    """
+       TestAuctionIndex is used to test closed results are indexed as
+          listings close and queried without rescanning
+    """
+    def setUp(self):
+        self.server = Server()
+        self.index = auction_index.ResultIndex(top_capacity=2).attach(self.server)
+        rows = [['1', '1', 'SELL', 'lamp_1', '5.00', '10'],
+                ['2', '1', 'SELL', 'chair_1', '50.00', '12'],
+                ['3', '2', 'SELL', 'desk_1', '20.00', '11'],
+                ['4', '7', 'BID', 'lamp_1', '6.00'],
+                ['5', '8', 'BID', 'desk_1', '30.00'],
+                ['6', '9', 'BID', 'desk_1', '25.00'],
+                ['13']]
+        for row in rows:
+            self.server.process_instruction(self.server.classify_instruction(row))
+
+    def test_01_queries(self):
+        """
+        Top by price, unsold by seller and close_time ranges come from the indexes
+        """
+        assert len(self.index) == 3
+        assert [result.item for result in self.index.top_by_price(2)] == ['desk_1', 'lamp_1']
+        assert [result.item for result in self.index.top_by_price(1)] == ['desk_1']
+        with self.assertRaises(ValueError):
+            self.index.top_by_price(3)
+        assert [result.item for result in self.index.unsold_by_seller(1)] == ['chair_1']
+        assert self.index.unsold_by_seller(2) == []
+        assert [result.close_time for result in self.index.closed_between(11, 12)] == [11, 12]
+        assert self.index.closed_between(13, 20) == []
+        report = self.server.auction_summary_report(self.server.all_listed_items)
+        assert report == [self.server.format_auction_result(listing.auction_result)
+                          for listing in self.server.all_listed_items.values()]
+
+    def test_02_bounded(self):
+        """
+        Seller and close_time queries cover the latest capacity results, top prices every result
+        """
+        server = Server()
+        index = auction_index.ResultIndex(top_capacity=2, capacity=3).attach(server)
+        for number in range(10):
+            item = 'lamp_{0}'.format(number)
+            server.process_instruction(server.classify_instruction([str(number), '1', 'SELL', item, '5.00', str(number)]))
+            if number in (0, 1):
+                server.process_instruction(server.classify_instruction([str(number), '2', 'BID', item, '9.00']))
+        server.process_instruction(server.classify_instruction(['20']))
+        assert len(index) == 3 and len(index.results) < 6
+        assert [result.item for result in index.unsold_by_seller(1)] == ['lamp_7', 'lamp_8', 'lamp_9']
+        assert [result.close_time for result in index.closed_between(0, 20)] == [7, 8, 9]
+        assert [result.item for result in index.top_by_price(2)] == ['lamp_0', 'lamp_1']
+
+    def test_03_service_queries(self):
+        """
+        Clients query the index of a running service
+        """
+        async def scenario():
+            server = Server()
+            service = auction_service.AuctionService(
+                server=server, result_index=auction_index.ResultIndex().attach(server))
+            host, port = (await service.start(host='127.0.0.1', port=0))[:2]
+            reader, writer = await asyncio.open_connection(host, port)
+            with open(file_input) as instruction_file:
+                writer.write(instruction_file.read().encode())
+            writer.write(b'TOP 5\nUNSOLD 8\nTOP x\nTOP 5000\n')
+            await writer.drain()
+            lines = [(await asyncio.wait_for(reader.readline(), 5)).decode().strip() for _ in range(6)]
+            writer.close()
+            await asyncio.sleep(0.05)
+            await service.stop()
+            return lines
+
+        loop = asyncio.new_event_loop()
+        try:
+            lines = loop.run_until_complete(scenario())
+        finally:
+            loop.close()
+        #queries are answered once the lines the client sent before them are processed
+        assert lines[:4] == ['20|toaster_1|8|SOLD|12.50|3|20.00|7.50', 'END',
+                             '20|tv_1||UNSOLD|0.00|2|200.00|150.00', 'END'], lines
+        assert lines[4].startswith('ERROR invalid query')
+        assert lines[5].startswith("ERROR invalid query 'TOP 5000'"), lines
+
+
     #class TestAuctionListing(unittest.TestCase):
     """
        TestAuctionListing is used to test the individual functions